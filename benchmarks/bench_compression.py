@@ -0,0 +1,140 @@
+""" Benchmark the tar file compression on synthetic inventories.
+
+    Stages the pages of an inventory of N hosts the way the staged
+    TarWriter does, then creates the tar file with every codec, once
+    inline on the event loop (the old flush) and once through
+    TarWriter.compress which runs it in a thread. A ticker task measures
+    how late the event loop wakes it up while compressing, the worst
+    delay is the loop stall every other in flight task would see.
+
+    python -m benchmarks.bench_compression [--hosts 10000 100000 1000000]
+        [--codecs gzip:6 gzip:1 bz2 xz zstd:3]
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import shutil
+import tempfile
+import time
+from catalog_mqtt_client.handlers import tar_writer
+
+PAGE_SIZE = 200
+TICK = 0.005
+
+
+def synthetic_hosts(start, count):
+    """ Hosts with the fields the catalog usually keeps """
+    return [
+        dict(
+            id=i,
+            type="host",
+            url=f"/api/v2/hosts/{i}/",
+            name=f"host-{i}.example.com",
+            inventory=i % 10,
+            enabled=True,
+            variables=json.dumps({"ansible_host": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"}),
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def stage_inventory(dirname, hosts):
+    """ Write the inventory as Tower sized pages, returns the bytes written """
+    total = 0
+    basedir = os.path.join(dirname, "api/v2/hosts")
+    os.makedirs(basedir)
+    for page, start in enumerate(range(0, hosts, PAGE_SIZE)):
+        data = json.dumps(
+            dict(count=hosts, results=synthetic_hosts(start, min(PAGE_SIZE, hosts - start)))
+        )
+        with open(os.path.join(basedir, f"page{page + 1}"), "w") as file_handle:
+            file_handle.write(data)
+        total = total + len(data)
+    return total
+
+
+def codec_config(codec):
+    """ Config for a staged writer with codec given as name[:level] """
+    compression, _, level = codec.partition(":")
+    config = configparser.ConfigParser()
+    config["AUTH"] = {"username": "bench", "password": "bench", "verify_ssl": "False"}
+    config["TAR_WRITER"] = {"mode": "staged", "compression": compression}
+    if level:
+        config["TAR_WRITER"]["compression_level"] = level
+    return config
+
+
+async def ticker(stop, delays):
+    """ Sleep TICK at a time and record how late we were woken up """
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        delays.append(time.perf_counter() - started - TICK)
+
+
+async def measure(writer, offloaded):
+    """ Compress once, returns the seconds taken and the worst loop stall """
+    stop = asyncio.Event()
+    delays = []
+    tick_task = asyncio.create_task(ticker(stop, delays))
+    await asyncio.sleep(TICK * 2)
+    started = time.perf_counter()
+    if offloaded:
+        await writer.compress()
+    else:
+        writer.create_tar()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick_task
+    return elapsed, max(delays, default=0.0)
+
+
+async def run(dirname, raw_bytes, codec):
+    """ Inline and offloaded runs for a codec """
+    rows = []
+    for offloaded in (False, True):
+        with tempfile.NamedTemporaryFile(suffix=".tar") as tar_file:
+            writer = tar_writer.TarWriter(
+                codec_config(codec), None, None, dirname, tar_file.name
+            )
+            elapsed, stall = await measure(writer, offloaded)
+            ratio = raw_bytes / os.path.getsize(tar_file.name)
+        rows.append((codec, "thread" if offloaded else "inline", elapsed, ratio, stall))
+    return rows
+
+
+def main():
+    """ Print a table per inventory size """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument(
+        "--codecs", nargs="+", default=["gzip", "gzip:1", "bz2", "xz", "zstd:3"]
+    )
+    args = parser.parse_args()
+    codecs = [
+        codec for codec in args.codecs
+        if not codec.startswith("zstd") or tar_writer.zstandard is not None
+    ]
+
+    print(f"{'hosts':>8} {'raw MB':>8} {'codec':>8} {'where':>7} "
+          f"{'seconds':>8} {'ratio':>6} {'stall ms':>9}")
+    for hosts in args.hosts:
+        dirname = tempfile.mkdtemp(prefix="bench")
+        try:
+            raw_bytes = stage_inventory(dirname, hosts)
+            for codec in codecs:
+                for codec_name, where, elapsed, ratio, stall in asyncio.run(
+                    run(dirname, raw_bytes, codec)
+                ):
+                    print(
+                        f"{hosts:>8} {raw_bytes / 2**20:>8.1f} {codec_name:>8} {where:>7} "
+                        f"{elapsed:>8.3f} {ratio:>6.1f} {stall * 1000:>9.1f}"
+                    )
+        finally:
+            shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+""" End to end benchmark of the client against local fake services.
+
+    Starts a fake Tower, catalog task endpoint and ingress upload (see
+    fake_services.py) in this process, then for every response format
+    runs the client in a fresh process: a FakeBroker thread publishes the
+    task payloads to a Dispatcher, which runs a MessageHandler per task
+    exactly as App does. Reports tasks/sec, p50/p99 receive-to-finish
+    latency and the peak RSS of the client process. The fake services
+    live in the parent and the client process is spawned, not forked,
+    so none of their memory is counted.
+
+    Results can be saved with --output and a later run compared against
+    them with --compare, the file records the commit it was taken on.
+
+    python -m benchmarks.bench_end_to_end [--tasks 50] [--objects 2000]
+        [--page-size 200] [--tower-latency 0.01] [--formats json tar]
+        [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import time
+from catalog_mqtt_client import dispatcher
+from benchmarks import fake_services
+
+APPLY_FILTER = "results[].{id:id, name:name, type:type, url:url}"
+KINDS = ("hosts", "job_templates")
+REPORTED = ("tasks_per_sec", "p50_ms", "p99_ms", "peak_rss_mb")
+
+
+class TimedDispatcher(dispatcher.Dispatcher):
+    """ A Dispatcher which records the receive to finish latency of
+        every task and signals once all of them are done
+    """
+
+    def __init__(self, config, expected):
+        super().__init__(config)
+        self.expected = expected
+        self.latencies = []
+        self.done = None
+
+    async def start(self):
+        self.done = asyncio.Event()
+        await super().start()
+
+    async def handle(self, payload, received=None):
+        await super().handle(payload, received)
+        self.latencies.append(time.monotonic() - received)
+        if len(self.latencies) == self.expected:
+            self.done.set()
+
+
+def client_config(args, tower_url):
+    """ The config of the client under test """
+    config = configparser.ConfigParser()
+    config["AUTH"] = {
+        "x_rh_identity": "bench",
+        "username": "bench",
+        "password": "bench",
+        "verify_ssl": "False",
+    }
+    config["ANSIBLE_TOWER"] = {"url": tower_url, "token": "bench", "verify_ssl": "False"}
+    config["CLIENT"] = {
+        "max_concurrent_tasks": str(args.concurrency),
+        "max_backlog": str(args.tasks),
+    }
+    config["TAR_WRITER"] = {"mode": args.tar_mode}
+    return config
+
+
+def task_input(response_format, upload_url, page_size):
+    """ A task fetching every page of each kind """
+    return {
+        "response_format": response_format,
+        "upload_url": upload_url,
+        "jobs": [
+            {
+                "href_slug": f"/api/v2/{kind}/?page_size={page_size}",
+                "method": "get",
+                "fetch_all_pages": True,
+                "apply_filter": APPLY_FILTER,
+            }
+            for kind in KINDS
+        ],
+    }
+
+
+async def drive(args, tower_url, task_urls):
+    """ Publish every task and wait till they have all finished """
+    timed = TimedDispatcher(client_config(args, tower_url), len(task_urls))
+    await timed.start()
+    broker = fake_services.FakeBroker(timed.submit, args.rate)
+    started = time.perf_counter()
+    broker.publish([json.dumps({"url": url}) for url in task_urls])
+    try:
+        await asyncio.wait_for(timed.done.wait(), args.timeout)
+    finally:
+        elapsed = time.perf_counter() - started
+        broker.join()
+        await timed.stop()
+    return elapsed, timed.latencies, timed.dropped
+
+
+def run_client(args, tower_url, task_urls, result):
+    """ Run the client for the tasks in this process """
+    elapsed, latencies, dropped = asyncio.run(drive(args, tower_url, task_urls))
+    latencies.sort()
+    result.update(
+        tasks=len(latencies),
+        seconds=elapsed,
+        tasks_per_sec=len(latencies) / elapsed,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        dropped=dropped,
+    )
+
+
+def percentile(ordered, percent):
+    """ Nearest rank percentile of a sorted list """
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+async def run_format(args, tower, cloud, response_format):
+    """ Create the tasks and run the client against them in a new process """
+    upload_url = cloud.url + fake_services.UPLOAD_PATH
+    task_urls = [
+        cloud.add_task(
+            f"{response_format}-{i}",
+            task_input(response_format, upload_url, args.page_size),
+        )
+        for i in range(args.tasks)
+    ]
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        result = manager.dict()
+        process = context.Process(
+            target=run_client, args=(args, tower.url, task_urls, result)
+        )
+        process.start()
+        await asyncio.get_running_loop().run_in_executor(None, process.join)
+        result = dict(result)
+    if not result:
+        raise Exception(f"The {response_format} client failed, exit code {process.exitcode}")
+
+    statuses = [cloud.results.get(f"{response_format}-{i}") for i in range(args.tasks)]
+    result["failed"] = len([status for status in statuses if status != "ok"])
+    return result
+
+
+async def run(args):
+    """ Start the fake services and measure each format """
+    tower = fake_services.FakeTower(args.objects, args.object_bytes, args.tower_latency)
+    cloud = fake_services.FakeCloud(args.cloud_latency)
+    await tower.start()
+    await cloud.start()
+    try:
+        results = {}
+        for response_format in args.formats:
+            results[response_format] = await run_format(args, tower, cloud, response_format)
+        return results
+    finally:
+        await tower.stop()
+        await cloud.stop()
+
+
+def current_commit():
+    """ The commit the benchmark runs on, None outside a git checkout """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline):
+    """ Print a table, with the change against the baseline if given """
+    print(f"{'format':>7} {'tasks':>6} {'failed':>6} {'tasks/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>8}")
+    for response_format, result in results.items():
+        print(
+            f"{response_format:>7} {result['tasks']:>6} {result['failed']:>6} "
+            f"{result['tasks_per_sec']:>8.2f} {result['p50_ms']:>8.1f} "
+            f"{result['p99_ms']:>8.1f} {result['peak_rss_mb']:>8.1f}"
+        )
+        previous = baseline["results"].get(response_format) if baseline else None
+        if previous:
+            changes = " ".join(
+                f"{(result[key] - previous[key]) / previous[key] * 100:>+7.1f}%"
+                if previous[key] else f"{'n/a':>8}"
+                for key in REPORTED
+            )
+            print(f"{'vs ' + str(baseline['commit']):>21} {changes}")
+
+
+def main():
+    """ Run the benchmark and report it """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="messages per second, 0 publishes all at once")
+    parser.add_argument("--objects", type=int, default=2000,
+                        help="objects in each Tower list")
+    parser.add_argument("--object-bytes", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--tower-latency", type=float, default=0.01)
+    parser.add_argument("--cloud-latency", type=float, default=0.01)
+    parser.add_argument("--formats", nargs="+", default=["json", "tar"])
+    parser.add_argument("--tar-mode", default="stream", choices=["stream", "staged"])
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="results saved by an earlier run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file_handle:
+            baseline = json.load(file_handle)
+
+    results = asyncio.run(run(args))
+    print_results(results, baseline)
+
+    if args.output:
+        parameters = {
+            key: value for key, value in vars(args).items() if key not in ("output", "compare")
+        }
+        with open(args.output, "w") as file_handle:
+            json.dump(
+                dict(
+                    commit=current_commit(),
+                    python=platform.python_version(),
+                    parameters=parameters,
+                    results=results,
+                ),
+                file_handle,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
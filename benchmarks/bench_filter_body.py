@@ -0,0 +1,79 @@
+""" Micro benchmark of filter_body with and without compiled expressions.
+
+    Uses the fixtures from catalog_mqtt_client/tests/test_data.py: a dict
+    style apply_filter over job pages and a string apply_filter over job
+    template pages. Each filter is run as many times as a task with the
+    given number of pages would run it.
+
+    python -m benchmarks.bench_filter_body [--pages 200] [--repeat 5]
+"""
+import argparse
+import copy
+import os
+import sys
+import timeit
+import jmespath
+from catalog_mqtt_client.handlers import tower_api_worker
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "catalog_mqtt_client", "tests")
+)
+from test_data import TestData  # noqa: E402 pylint: disable=C0413
+
+# A dict style filter of 20 keys, built from the job filter fixture
+WIDE_JOB_FILTER = {
+    f"{key}_{i}": expression
+    for i in range(4)
+    for key, expression in TestData.JOB_FILTER.items()
+}
+
+CASES = [
+    ("dict filter, 5 keys", TestData.JOB_FILTER, TestData.JOB_1_SUCCESSFUL),
+    ("dict filter, 20 keys", WIDE_JOB_FILTER, TestData.JOB_1_SUCCESSFUL),
+    (
+        "string filter",
+        TestData.JOB_TEMPLATE_PAYLOAD_ALL_PAGES["apply_filter"],
+        TestData.JOB_TEMPLATES_PAGE1_RESPONSE,
+    ),
+]
+
+
+def uncached_filter_body(apply_filters, json_body):
+    """ filter_body as it was, searching with the expression text """
+    if isinstance(apply_filters, dict):
+        return {
+            key: jmespath.search(jmes_filter, json_body)
+            for key, jmes_filter in apply_filters.items()
+        }
+    json_body["results"] = jmespath.search(apply_filters, json_body)
+    return json_body
+
+
+def main():
+    """ Print the time per task for both versions """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'case':>22} {'uncached ms':>12} {'compiled ms':>12} {'speedup':>8}")
+    for name, apply_filter, page in CASES:
+        timings = []
+        for func in (uncached_filter_body, tower_api_worker.filter_body):
+            timings.append(
+                min(
+                    timeit.repeat(
+                        lambda: func(apply_filter, copy.copy(page)),
+                        number=args.pages,
+                        repeat=args.repeat,
+                    )
+                )
+            )
+        print(
+            f"{name:>22} {timings[0] * 1000:>12.2f} {timings[1] * 1000:>12.2f} "
+            f"{timings[0] / timings[1]:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
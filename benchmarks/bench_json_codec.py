@@ -0,0 +1,71 @@
+""" Benchmark the JSON backends on Tower list pages.
+
+    Every page goes through a decode, when the worker parses the Tower
+    response, and an encode, when the worker hands a filtered page to the
+    writers as bytes. Both are timed for each installed backend of
+    json_codec on synthetic Tower host pages of the given sizes. The CPU
+    time per page and the CPU saved per page compared to the standard
+    json module are printed.
+
+    python -m benchmarks.bench_json_codec [--hosts 25 200 1000] [--repeat 50]
+"""
+import argparse
+import time
+from catalog_mqtt_client.handlers import json_codec
+from benchmarks.bench_streaming_parse import synthetic_page
+
+
+def cpu_per_call(func, arg, repeat):
+    """ Best of three runs of repeat calls, CPU seconds per call """
+    best = None
+    for _ in range(3):
+        started = time.process_time()
+        for _ in range(repeat):
+            func(arg)
+        elapsed = (time.process_time() - started) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(backend, body, repeat):
+    """ CPU seconds to decode a Tower body and to encode the page """
+    page = backend.loads(body)
+    return (
+        cpu_per_call(backend.loads, body, repeat),
+        cpu_per_call(backend.dumps, page, repeat),
+    )
+
+
+def main():
+    """ Print a table comparing the installed backends """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[25, 200, 1000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"installed backends: {', '.join(sorted(json_codec.BACKENDS))}")
+    print(
+        f"{'hosts':>6} {'page KB':>8} {'backend':>8} {'decode us':>10} "
+        f"{'encode us':>10} {'total us':>10} {'saved us':>10} {'speedup':>8}"
+    )
+    for hosts in args.hosts:
+        body = synthetic_page(hosts).decode("utf-8")
+        results = {
+            name: measure(backend, body, args.repeat)
+            for name, backend in json_codec.BACKENDS.items()
+        }
+        baseline = sum(results["json"])
+        for name in json_codec.PREFERRED:
+            if name not in results:
+                continue
+            decode, encode = results[name]
+            total = decode + encode
+            print(
+                f"{hosts:>6} {len(body) / 1024:>8.1f} {name:>8} {decode * 1e6:>10.1f} "
+                f"{encode * 1e6:>10.1f} {total * 1e6:>10.1f} "
+                f"{(baseline - total) * 1e6:>10.1f} {baseline / total:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+""" Benchmark the streaming page parser against reading the whole page.
+
+    Compares the current path (response text, json.loads, JMESPath filter,
+    json.dumps) with the streaming path (bytes fed in chunks, results
+    filtered per item, json.dumps) on synthetic Tower pages. Every run
+    happens in a fresh process which only loads the raw page bytes, so the
+    peak RSS growth of each path is comparable. The heap peak is taken with
+    tracemalloc in a second, untimed pass.
+
+    python -m benchmarks.bench_streaming_parse [--hosts 1000 10000 50000]
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+import tracemalloc
+from catalog_mqtt_client.handlers import stream_parser
+from catalog_mqtt_client.handlers import tower_api_worker
+
+APPLY_FILTER = "results[].{id:id, name:name, inventory:inventory, type:type, url:url}"
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_page(hosts):
+    """ A Tower list page with the fields Tower returns for hosts """
+    results = [
+        dict(
+            id=i,
+            type="host",
+            url=f"/api/v2/hosts/{i}/",
+            name=f"host-{i}.example.com",
+            description="x" * 200,
+            inventory=i % 10,
+            enabled=True,
+            variables=json.dumps({"ansible_host": f"10.0.{i // 256 % 256}.{i % 256}"}),
+            related={key: f"/api/v2/hosts/{i}/{key}/" for key in (
+                "job_events", "job_host_summaries", "groups", "all_groups",
+                "ad_hoc_commands", "ansible_facts", "insights",
+            )},
+            summary_fields=dict(
+                inventory=dict(id=i % 10, name="Demo", description="d" * 100),
+                last_job=dict(id=i, name="Demo Job", status="successful"),
+            ),
+        )
+        for i in range(hosts)
+    ]
+    return json.dumps(
+        dict(count=hosts, next=None, previous=None, results=results)
+    ).encode("utf-8")
+
+
+def current_path(raw):
+    """ Whole body as text, parsed, filtered and encoded again """
+    text = raw.decode("utf-8")
+    json_body = json.loads(text)
+    json_body = tower_api_worker.filter_body(APPLY_FILTER, json_body)
+    return json.dumps(json_body)
+
+
+def streaming_path(raw):
+    """ Chunks fed to the streaming parser, results filtered per item """
+    parser = stream_parser.StreamingPageParser(
+        stream_parser.results_item_filter(APPLY_FILTER)
+    )
+    view = memoryview(raw)
+    for i in range(0, len(raw), CHUNK_SIZE):
+        parser.feed(bytes(view[i:i + CHUNK_SIZE]))
+    return json.dumps(parser.close())
+
+
+def measure(mode, filename, result):
+    """ Run one path in this process and report latency and memory """
+    with open(filename, "rb") as file_handle:
+        raw = file_handle.read()
+    func = current_path if mode == "current" else streaming_path
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    output = func(raw)
+    elapsed = time.perf_counter() - started
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss
+    del output
+
+    tracemalloc.start()
+    func(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result.update(
+        page_bytes=len(raw), seconds=elapsed, peak_heap_bytes=peak, rss_growth_kb=rss_growth
+    )
+
+
+def run(mode, filename):
+    """ Measure in a separate process """
+    with multiprocessing.Manager() as manager:
+        result = manager.dict()
+        process = multiprocessing.Process(target=measure, args=(mode, filename, result))
+        process.start()
+        process.join()
+        return dict(result)
+
+
+def main():
+    """ Print a table comparing both paths """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    print(f"{'hosts':>8} {'mode':>10} {'page MB':>8} {'seconds':>8} "
+          f"{'heap MB':>8} {'RSS+ MB':>8}")
+    for hosts in args.hosts:
+        with tempfile.NamedTemporaryFile(suffix=".json") as page_file:
+            page_file.write(synthetic_page(hosts))
+            page_file.flush()
+            results = [(mode, run(mode, page_file.name)) for mode in ("current", "streaming")]
+        for mode, result in results:
+            print(
+                f"{hosts:>8} {mode:>10} {result['page_bytes'] / 2**20:>8.1f} "
+                f"{result['seconds']:>8.3f} {result['peak_heap_bytes'] / 2**20:>8.1f} "
+                f"{result['rss_growth_kb'] / 1024:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
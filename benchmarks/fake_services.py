@@ -0,0 +1,167 @@
+""" Local stand-ins for the services the client talks to, used by the
+    end to end benchmark.
+
+    FakeTower serves synthetic paginated lists for any /api/v2/<kind>/
+    path. FakeCloud serves the catalog tasks, records the PATCHes sent
+    back and accepts uploads on the ingress endpoint. Both wait a
+    configurable latency before answering. FakeBroker publishes MQTT
+    payloads from its own thread, the way the paho network thread hands
+    them to App.on_message.
+"""
+import asyncio
+import functools
+import json
+import threading
+import time
+from aiohttp import web
+
+TASK_PATH = "/api/catalog/v1/tasks/"
+UPLOAD_PATH = "/api/ingress/v1/upload"
+
+
+class FakeServer:
+    """ An aiohttp application listening on a random local port """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.app = web.Application(client_max_size=2 ** 30)
+        self.runner = None
+        self.url = None
+        self.requests = 0
+
+    async def start(self):
+        """ Start listening, sets the base url """
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        """ Stop listening """
+        await self.runner.cleanup()
+
+    async def delay(self):
+        """ Count the request and wait the configured latency """
+        self.requests = self.requests + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeTower(FakeServer):
+    """ Paginated Tower lists of count synthetic objects each """
+
+    def __init__(self, count, item_bytes=200, latency=0.0):
+        super().__init__(latency)
+        self.count = count
+        self.item_bytes = item_bytes
+        self.app.router.add_get("/api/v2/{kind}/", self.handle_list)
+
+    async def handle_list(self, request):
+        """ A single page of a list """
+        await self.delay()
+        kind = request.match_info["kind"]
+        page = int(request.query.get("page", 1))
+        page_size = int(request.query.get("page_size", 25))
+        return web.Response(
+            text=self.page(kind, page, page_size), content_type="application/json"
+        )
+
+    @functools.lru_cache(maxsize=4096)
+    def page(self, kind, page, page_size):
+        """ The page body, cached so the server's JSON encoding isn't measured """
+        start = (page - 1) * page_size
+        stop = min(self.count, start + page_size)
+        next_link = (
+            f"/api/v2/{kind}/?page={page + 1}&page_size={page_size}"
+            if stop < self.count
+            else None
+        )
+        results = [
+            dict(
+                id=i,
+                type=kind.rstrip("s"),
+                url=f"/api/v2/{kind}/{i}/",
+                name=f"{kind}-{i}",
+                description="x" * self.item_bytes,
+                created="2020-06-01T12:00:00.000000Z",
+                modified="2020-06-01T12:00:00.000000Z",
+            )
+            for i in range(start, stop)
+        ]
+        return json.dumps(
+            dict(count=self.count, next=next_link, previous=None, results=results)
+        )
+
+
+class FakeCloud(FakeServer):
+    """ The catalog task endpoint and the ingress upload """
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.tasks = {}
+        self.results = {}
+        self.uploaded_bytes = 0
+        self.app.router.add_get(TASK_PATH + "{task_id}", self.handle_get_task)
+        self.app.router.add_patch(TASK_PATH + "{task_id}", self.handle_patch_task)
+        self.app.router.add_post(UPLOAD_PATH, self.handle_upload)
+
+    def add_task(self, task_id, task_input):
+        """ Create a task, returns its url """
+        self.tasks[task_id] = task_input
+        return self.url + TASK_PATH + task_id
+
+    async def handle_get_task(self, request):
+        """ The task with its input """
+        await self.delay()
+        task_input = self.tasks.get(request.match_info["task_id"])
+        if task_input is None:
+            raise web.HTTPNotFound()
+        return web.json_response({"input": task_input})
+
+    async def handle_patch_task(self, request):
+        """ Record the final state of the task """
+        await self.delay()
+        data = await request.json()
+        if data.get("state") == "completed":
+            self.results[request.match_info["task_id"]] = data.get("status")
+        return web.json_response({})
+
+    async def handle_upload(self, request):
+        """ Read and drop the uploaded file """
+        await self.delay()
+        body = await request.read()
+        self.uploaded_bytes = self.uploaded_bytes + len(body)
+        return web.json_response(
+            {"request_id": str(self.requests), "upload": {"account_number": "bench"}},
+            status=202,
+        )
+
+
+class FakeBroker:
+    """ Publishes payloads to a callback from a separate thread, at rate
+        messages per second or all at once when rate is 0
+    """
+
+    def __init__(self, callback, rate=0.0):
+        self.callback = callback
+        self.rate = rate
+        self.thread = None
+
+    def publish(self, payloads):
+        """ Start publishing the payloads """
+        self.thread = threading.Thread(target=self.run, args=(payloads,), daemon=True)
+        self.thread.start()
+
+    def run(self, payloads):
+        """ The publishing thread """
+        for payload in payloads:
+            self.callback(payload, time.monotonic())
+            if self.rate:
+                time.sleep(1.0 / self.rate)
+
+    def join(self):
+        """ Wait till every payload has been published """
+        self.thread.join()
+
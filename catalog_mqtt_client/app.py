@@ -3,14 +3,16 @@
    via REST API and send back responsed to cloud.redhat.com
  """
 import os
+import time
 import asyncio
 import configparser
 import logging
-import sys
 import signal
 from urllib.parse import urlparse
 import paho.mqtt.client as mqtt
-from catalog_mqtt_client.handlers import message_handler
+from catalog_mqtt_client import dispatcher
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client.handlers import json_codec
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +32,9 @@ class App:
             raise Exception("Please set env variable CATALOG_MQTT_CONF")
 
         self.config.read(os.getenv('CATALOG_MQTT_CONF'))
+        json_codec.select_backend(
+            self.config.get("CLIENT", "json_backend", fallback=json_codec.AUTO)
+        )
 
         p_url = urlparse(self.config["MQTT_BROKER"]["URL"])
         self.host = p_url.hostname
@@ -37,6 +42,8 @@ class App:
         self.topic = "out/" + self.config["MQTT_BROKER"]["UUID"]
         self.qos = 0
         self.client = mqtt.Client(self.config["MQTT_BROKER"]["UUID"])
+        self.dispatcher = dispatcher.Dispatcher(self.config)
+        self.stopping = asyncio.Event()
 
     def connect(self):
         """Connect to the MQTT Broker"""
@@ -77,15 +84,16 @@ class App:
             client.bad_connection_flag = True
 
     def on_message(self, _client, _userdata, message):
-        """When a new MQTT Message comes in this callback is invoked"""
+        """When a new MQTT Message comes in this callback is invoked
+           The message is handed over to the dispatcher's event loop so
+           the MQTT network thread is never blocked
+        """
         self.message_count = self.message_count + 1
+        metrics.MESSAGES_RECEIVED.inc()
+        received = time.monotonic()
         try:
             logger.info("MQTT Message Received")
-            handler = message_handler.MessageHandler(
-                self.config, str(message.payload.decode("utf-8"))
-            )
-            asyncio.run(handler.start())
-            logger.info("MQTT Message Finished Processing")
+            self.dispatcher.submit(str(message.payload.decode("utf-8")), received)
         except:
             logger.error("Error handling MQTT Message", exc_info=True)
 
@@ -99,19 +107,32 @@ class App:
         logger.info("Stopping MQTT Client Worker")
         self.client.loop_stop()
 
-    def signal_handler(self, signum, _frame):
-        """Signale handler to stop the MQTT Client loop"""
+    def signal_handler(self, signum):
+        """Signal handler, wakes up run to stop the MQTT Client loop
+           and the dispatcher
+        """
         logger.info("Received Signal %s", str(signum))
-        signal.signal(signum, signal.SIG_IGN)
+        self.stopping.set()
+
+    async def shutdown(self):
+        """Stop taking MQTT messages, then cancel the in flight tasks
+           and close the HTTP sessions
+        """
         self.stop()
-        sys.exit(0)
+        await self.dispatcher.stop()
 
 
 async def run():
-    """ Run the App forever till we catch a signal to end """
+    """ Run the App till we catch a signal to end """
     app = App()
-    signal.signal(signal.SIGINT, app.signal_handler)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, app.signal_handler, signal.SIGINT)
+    runner = await metrics.start_server(app.config)
+    await app.dispatcher.start()
     app.connect()
     app.start()
-    while True:
-        await asyncio.sleep(10)
+    await app.stopping.wait()
+    loop.remove_signal_handler(signal.SIGINT)
+    await app.shutdown()
+    if runner is not None:
+        await runner.cleanup()
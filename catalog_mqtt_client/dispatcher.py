@@ -0,0 +1,121 @@
+""" Dispatcher, hands the MQTT payloads received on the paho network
+    thread to a long lived event loop, which runs the MessageHandlers
+    concurrently so the MQTT loop is never blocked by a Tower round trip
+"""
+import time
+import asyncio
+import logging
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client.handlers import message_handler
+from catalog_mqtt_client.handlers import http_session
+from catalog_mqtt_client.handlers import backpressure
+from catalog_mqtt_client.handlers import job_journal
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """ Owns the execution of all MessageHandlers on one event loop.
+        Payloads are queued thread safely into a bounded backlog and a
+        fixed number of consumers caps how many catalog tasks run at once
+    """
+
+    DEFAULT_MAX_CONCURRENT_TASKS = 4
+    DEFAULT_MAX_BACKLOG = 100
+
+    def __init__(self, config):
+        self.config = config
+        self.max_concurrent_tasks = config.getint(
+            "CLIENT", "max_concurrent_tasks", fallback=self.DEFAULT_MAX_CONCURRENT_TASKS
+        )
+        self.max_backlog = config.getint(
+            "CLIENT", "max_backlog", fallback=self.DEFAULT_MAX_BACKLOG
+        )
+        self.loop = None
+        self.queue = None
+        self.consumers = []
+        self.in_flight = 0
+        self.dropped = 0
+        self.processed = 0
+
+    async def start(self):
+        """ Start the consumers on the currently running event loop """
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.max_backlog)
+        logger.info(
+            "Starting dispatcher with %d concurrent tasks and backlog of %d",
+            self.max_concurrent_tasks,
+            self.max_backlog,
+        )
+        self.consumers = [
+            asyncio.create_task(self.consume())
+            for _ in range(self.max_concurrent_tasks)
+        ]
+        metrics.TASKS_IN_FLIGHT.set_function(lambda: self.in_flight)
+        metrics.TASKS_BACKLOG.set_function(self.queue.qsize)
+        self.resume_tasks()
+
+    def resume_tasks(self):
+        """ Queue the tasks the journal recorded as unfinished """
+        journal = job_journal.get_journal(self.config)
+        if journal is None:
+            return
+        payloads = journal.unfinished()
+        if payloads:
+            logger.info("Resuming %d unfinished tasks", len(payloads))
+        for payload in payloads:
+            self.enqueue(payload, time.monotonic())
+
+    async def stop(self):
+        """ Cancel the consumers, any queued payloads are discarded
+            and close the shared HTTP session
+        """
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+        self.consumers = []
+        await http_session.close_sessions()
+
+    def submit(self, payload, received=None):
+        """ Hand over a payload, safe to call from any thread. received
+            is the monotonic time the MQTT message arrived
+        """
+        if self.loop is None:
+            raise Exception("Dispatcher has not been started")
+        self.loop.call_soon_threadsafe(
+            self.enqueue, payload, received or time.monotonic()
+        )
+
+    def enqueue(self, payload, received):
+        """ Add the payload to the backlog, runs on the event loop """
+        try:
+            self.queue.put_nowait((payload, received))
+        except asyncio.QueueFull:
+            self.dropped = self.dropped + 1
+            logger.error(
+                "Backlog of %d messages is full, dropping MQTT Message", self.max_backlog
+            )
+
+    async def consume(self):
+        """ Pick payloads from the backlog one at a time and process them """
+        while True:
+            payload, received = await self.queue.get()
+            try:
+                await self.handle(payload, received)
+            finally:
+                self.queue.task_done()
+
+    async def handle(self, payload, received=None):
+        """ Run a MessageHandler for a single payload """
+        self.in_flight = self.in_flight + 1
+        try:
+            handler = message_handler.MessageHandler(self.config, payload, received)
+            await handler.start()
+            logger.info("MQTT Message Finished Processing")
+        except Exception:
+            logger.error("Error handling MQTT Message", exc_info=True)
+        finally:
+            self.in_flight = self.in_flight - 1
+            self.processed = self.processed + 1
+            logger.debug("HTTP connection stats %s", http_session.stats())
+            logger.debug("Pipeline buffer stats %s", backpressure.stats())
@@ -0,0 +1,134 @@
+""" Backpressure, a byte budget for the pages handed from the
+    TowerApiWorkers to the writers. A writer takes the size of every page
+    from the budget in write and gives it back once the page has left
+    memory, workers wait in write while the budget is used up. All the
+    catalog tasks on an event loop share one budget so it caps the pages
+    buffered by the whole client
+"""
+import time
+import asyncio
+import logging
+import collections
+from catalog_mqtt_client import metrics
+
+logger = logging.getLogger(__name__)
+
+BUDGETS = {}
+
+
+class ByteBudget:
+    """ Counts the buffered bytes against a limit and keeps the high water
+        mark. Bytes are handed out first come first served, a page bigger
+        than the whole budget is let through when nothing else is buffered
+    """
+
+    DEFAULT_MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BUFFERED_BYTES):
+        self.max_bytes = max_bytes
+        self.loop = None
+        self.used = 0
+        self.high_water = 0
+        self.waiters = collections.deque()
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def fits(self, size):
+        """ Can size bytes be buffered right now """
+        return self.used == 0 or self.used + size <= self.max_bytes
+
+    async def acquire(self, size):
+        """ Take size bytes from the budget, waiting till they are available """
+        self.loop = asyncio.get_running_loop()
+        if not self.waiters and self.fits(size):
+            self.take(size)
+            return
+
+        waiter = self.loop.create_future()
+        self.waiters.append((size, waiter))
+        self.waits = self.waits + 1
+        started = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if (size, waiter) in self.waiters:
+                self.waiters.remove((size, waiter))
+                self.wake()
+            elif waiter.done() and not waiter.cancelled():
+                self.free(size)
+            raise
+        finally:
+            self.wait_time = self.wait_time + (time.monotonic() - started)
+
+    def release(self, size):
+        """ Give size bytes back, safe to call from a writer thread """
+        if size == 0 or self.loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.free(size)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.free, size)
+
+    def take(self, size):
+        """ Account for buffered bytes """
+        self.used = self.used + size
+        self.high_water = max(self.high_water, self.used)
+
+    def free(self, size):
+        """ Account for released bytes and hand them to the waiting writers """
+        self.used = self.used - size
+        self.wake()
+
+    def wake(self):
+        """ Let the waiting writers in, in order, while their pages fit """
+        while self.waiters and self.fits(self.waiters[0][0]):
+            size, waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.take(size)
+                waiter.set_result(None)
+
+    def stats(self):
+        """ Gauges for the buffered bytes """
+        return dict(
+            buffered_bytes=self.used,
+            max_buffered_bytes=self.max_bytes,
+            high_water_bytes=self.high_water,
+            waiting_writers=len(self.waiters),
+            waits=self.waits,
+            wait_seconds=round(self.wait_time, 3),
+        )
+
+
+metrics.BUFFERED_BYTES.set_function(
+    lambda: sum(budget.used for budget in list(BUDGETS.values()))
+)
+metrics.BUFFERED_BYTES_HIGH_WATER.set_function(
+    lambda: max((budget.high_water for budget in list(BUDGETS.values())), default=0)
+)
+
+
+def get_budget(config):
+    """ The byte budget shared by every writer on the running loop """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in BUDGETS if key.is_closed()]:
+        del BUDGETS[key]
+
+    if loop not in BUDGETS:
+        BUDGETS[loop] = ByteBudget(
+            config.getint(
+                "PIPELINE",
+                "max_buffered_bytes",
+                fallback=ByteBudget.DEFAULT_MAX_BUFFERED_BYTES,
+            )
+        )
+    return BUDGETS[loop]
+
+
+def stats():
+    """ Gauges of the budget on the running loop """
+    budget = BUDGETS.get(asyncio.get_running_loop(), None)
+    return budget.stats() if budget else {}
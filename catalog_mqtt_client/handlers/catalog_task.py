@@ -1,6 +1,7 @@
 """Catalog Task Module, fetches and patch Catalog Task objects """
 import logging
-import aiohttp
+from catalog_mqtt_client.handlers import http_session
+from catalog_mqtt_client.handlers import json_codec
 logger = logging.getLogger(__name__)
 
 
@@ -17,30 +18,36 @@ class CatalogTask:
     async def get(self):
         """ Get the Catalog Task object from cloud.redhat.com"""
         logger.debug("Getting Task %s", self.url)
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            async with session.get(self.url) as response:
-                logger.debug("GET Status %d", response.status)
-                logger.debug("GET Content-type: %s", response.headers['Content-Type'])
+        session = http_session.get_session(self.config)
+        async with session.get(self.url, headers=self.headers) as response:
+            logger.debug("GET Status %d", response.status)
+            logger.debug("GET Content-type: %s", response.headers['Content-Type'])
 
-                data = await response.text()
-                if response.status != 200:
-                    logger.error("GET %s Status Code %d", self.url, response.status)
-                    logger.error(data)
-                    raise Exception("GET %s Status Code %d" % (self.url, response.status))
+            data = await response.text()
+            if response.status != 200:
+                logger.error("GET %s Status Code %d", self.url, response.status)
+                logger.error(data)
+                raise Exception("GET %s Status Code %d" % (self.url, response.status))
 
-                return data
+            return data
 
     async def update(self, data):
-        """ Patch the Catalog Task object in cloud.redhat.com"""
+        """ Patch the Catalog Task object in cloud.redhat.com, data is the
+            update or its JSON bytes
+        """
         logger.debug("Updating Task %s", self.url)
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            async with session.patch(self.url, json=data) as response:
-                logger.debug("PATCH Status %d", response.status)
-                result = await response.text()
-
-                if response.status not in self.VALID_POST_CODES:
-                    logger.error("PATCH %s Status Code %d", self.url, response.status)
-                    logger.error(result)
-                    raise Exception("PATCH %s Status Code %d" % (self.url, response.status))
-
-                return result
+        session = http_session.get_session(self.config)
+        async with session.patch(
+            self.url,
+            data=json_codec.encode(data),
+            headers=dict(self.headers, **{"Content-Type": "application/json"}),
+        ) as response:
+            logger.debug("PATCH Status %d", response.status)
+            result = await response.text()
+
+            if response.status not in self.VALID_POST_CODES:
+                logger.error("PATCH %s Status Code %d", self.url, response.status)
+                logger.error(result)
+                raise Exception("PATCH %s Status Code %d" % (self.url, response.status))
+
+            return result
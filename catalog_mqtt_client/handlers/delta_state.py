@@ -0,0 +1,129 @@
+""" Delta State, an on disk store of the last successful sync of every
+    Tower list collected in delta mode. For each list it keeps the
+    watermark, the Tower's time when the list was last read, and the ids
+    the list had then. The next sync only fetches objects modified after
+    the watermark and reports the ids which are gone as tombstones.
+    A task only commits its watermarks once it has finished successfully
+"""
+import os
+import json
+import asyncio
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+STATES = {}
+
+# Query parameters which don't change the objects in a list
+IGNORED_PARAMS = ("page", "page_size", "order_by", "modified__gt")
+
+
+class DeltaState:
+    """ Watermark and ids per Tower list, persisted as a JSON file """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = self.load()
+        self.version = 0
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Read the state file, a missing or unreadable file starts afresh """
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename) as file_handle:
+                return json.load(file_handle)
+        except (OSError, ValueError):
+            logger.warning(
+                "Ignoring unreadable delta state %s", self.filename, exc_info=True
+            )
+            return {}
+
+    @staticmethod
+    def key(tower_url, path, params):
+        """ The list a request reads, independent of paging """
+        query = "&".join(
+            f"{name}={value}"
+            for name, value in sorted(params.items())
+            if name not in IGNORED_PARAMS
+        )
+        return f"{tower_url.rstrip('/')}/{path.strip('/')}?{query}"
+
+    def get(self, key):
+        """ The last successful sync of a list, None if never synced """
+        return self.entries.get(key, None)
+
+    async def save(self, updates):
+        """ Apply the updates and write the file in a thread, replacing it
+            atomically so a crash never leaves a partial state behind
+        """
+        self.entries.update(updates)
+        self.version = self.version + 1
+        data = json.dumps(self.entries)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.write, data, self.version
+        )
+
+    def write(self, data, version):
+        """ Write the state to a temporary file and move it in place,
+            unless a newer version has been written meanwhile
+        """
+        with self.lock:
+            if version <= self.written:
+                return
+            dirname = os.path.dirname(os.path.abspath(self.filename))
+            os.makedirs(dirname, exist_ok=True)
+            file_handle, tmpname = tempfile.mkstemp(dir=dirname, prefix=".delta")
+            try:
+                with os.fdopen(file_handle, "w") as tmpfile:
+                    tmpfile.write(data)
+                os.replace(tmpname, self.filename)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+            self.written = version
+
+
+class DeltaSync:
+    """ Per task view of the delta state shared by the workers of a task.
+        Syncs are recorded as the lists are read and saved by commit
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.pending = {}
+        self.deleted = 0
+
+    def previous(self, key):
+        """ The last committed sync of a list """
+        return self.state.get(key)
+
+    def record(self, key, watermark, ids, deleted):
+        """ Remember the sync of a list till the task commits """
+        self.pending[key] = {"watermark": watermark, "ids": sorted(ids)}
+        self.deleted = self.deleted + deleted
+
+    async def commit(self):
+        """ The task succeeded, save the watermarks of its lists """
+        if self.pending:
+            await self.state.save(self.pending)
+            logger.debug("Committed delta state of %d lists", len(self.pending))
+        self.pending = {}
+
+    def stats(self):
+        """ Delta statistics of the task """
+        return dict(delta_lists=len(self.pending), delta_deleted=self.deleted)
+
+
+def get_state(config):
+    """ The process wide state store, None unless enabled in the config """
+    if not config.getboolean("DELTA", "enabled", fallback=False):
+        return None
+    filename = config.get("DELTA", "state_file")
+    if filename not in STATES:
+        STATES[filename] = DeltaState(filename)
+    return STATES[filename]
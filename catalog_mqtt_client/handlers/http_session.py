@@ -0,0 +1,103 @@
+""" HTTP Session Registry, a process wide pool of aiohttp sessions shared
+    by the CatalogTask, TarWriter and TowerApiWorker so TCP and TLS
+    connections are kept alive and reused for the life of the client
+"""
+import asyncio
+import logging
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class SessionRegistry:
+    """ Hands out one pooled ClientSession per event loop. Authentication
+        headers differ per service so they are passed on each request and
+        never stored in the shared session
+    """
+
+    DEFAULT_LIMIT = 100
+    DEFAULT_LIMIT_PER_HOST = 10
+    DEFAULT_KEEPALIVE_TIMEOUT = 30
+    DEFAULT_DNS_CACHE_TTL = 300
+
+    def __init__(self):
+        self.sessions = {}
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    def get_session(self, config):
+        """ Get the shared session for the running loop, creating it if needed """
+        loop = asyncio.get_running_loop()
+        self.prune()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = self.create_session(config)
+            self.sessions[loop] = session
+        return session
+
+    def create_session(self, config):
+        """ Create a session with a keep alive connector and DNS cache """
+        connector = aiohttp.TCPConnector(
+            limit=config.getint("HTTP", "limit", fallback=self.DEFAULT_LIMIT),
+            limit_per_host=config.getint(
+                "HTTP", "limit_per_host", fallback=self.DEFAULT_LIMIT_PER_HOST
+            ),
+            keepalive_timeout=config.getfloat(
+                "HTTP", "keepalive_timeout", fallback=self.DEFAULT_KEEPALIVE_TIMEOUT
+            ),
+            use_dns_cache=True,
+            ttl_dns_cache=config.getint(
+                "HTTP", "dns_cache_ttl", fallback=self.DEFAULT_DNS_CACHE_TTL
+            ),
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        logger.debug("Creating shared HTTP session")
+        return aiohttp.ClientSession(
+            connector=connector, trace_configs=[trace_config]
+        )
+
+    def prune(self):
+        """ Forget sessions whose event loop has been closed """
+        for loop in [loop for loop in self.sessions if loop.is_closed()]:
+            self.sessions.pop(loop).detach()
+
+    async def close(self):
+        """ Close the session belonging to the running loop """
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def stats(self):
+        """ Number of connections opened versus reused """
+        return dict(
+            connections_created=self.connections_created,
+            connections_reused=self.connections_reused,
+        )
+
+    async def on_connection_create_end(self, _session, _context, _params):
+        """ Trace callback when a new connection has been established """
+        self.connections_created = self.connections_created + 1
+
+    async def on_connection_reuseconn(self, _session, _context, _params):
+        """ Trace callback when a pooled connection is reused """
+        self.connections_reused = self.connections_reused + 1
+
+
+REGISTRY = SessionRegistry()
+
+
+def get_session(config):
+    """ Get the process wide shared session """
+    return REGISTRY.get_session(config)
+
+
+async def close_sessions():
+    """ Close the process wide shared session """
+    await REGISTRY.close()
+
+
+def stats():
+    """ Connection reuse statistics for the process wide session """
+    return REGISTRY.stats()
@@ -0,0 +1,13 @@
+""" JMESPath Cache, compiled expressions shared across pages, jobs and
+    workers so apply_filter expressions are only parsed once
+"""
+import functools
+import jmespath
+
+MAX_EXPRESSIONS = 512
+
+
+@functools.lru_cache(maxsize=MAX_EXPRESSIONS)
+def compile_expression(expression):
+    """ Parse a JMESPath expression and keep the compiled form """
+    return jmespath.compile(expression)
@@ -0,0 +1,179 @@
+""" Job Journal, an optional SQLite record of the catalog tasks in
+    progress so a restarted client can pick them up again. For every task
+    it keeps the MQTT payload, the jobs queued for it with their state and
+    the pages the TarWriter has staged. Jobs which finished aren't run
+    again and staged pages aren't fetched again when a task resumes.
+    A task is removed from the journal once it has been reported back to
+    the cloud, successfully or not
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+JOURNALS = {}
+
+PENDING = "pending"
+STARTED = "started"
+DONE = "done"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (url TEXT PRIMARY KEY, payload TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_url TEXT NOT NULL,
+    job TEXT NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_task ON jobs (task_url);
+CREATE TABLE IF NOT EXISTS pages (
+    task_url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (task_url, filename)
+);
+"""
+
+
+class JobJournal:
+    """ The journal database, shared by every task. Writes come from the
+        event loop and the tar writer threads so they are serialized by a
+        lock. WAL mode keeps each small write transaction cheap
+    """
+
+    def __init__(self, filename, staging_dir):
+        self.filename = filename
+        self.staging_dir = staging_dir
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config):
+        """ Build the journal from the [JOURNAL] section """
+        return cls(config.get("JOURNAL", "path"), config.get("JOURNAL", "staging_dir"))
+
+    def execute(self, sql, params=()):
+        """ Run a statement in its own transaction """
+        with self.lock, self.connection:
+            return self.connection.execute(sql, params).fetchall()
+
+    def unfinished(self):
+        """ The payloads of the tasks which were interrupted """
+        return [row[0] for row in self.execute("SELECT payload FROM tasks")]
+
+    def start_task(self, url, payload):
+        """ The journal of a task, resumed if the task was interrupted """
+        resumed = bool(self.execute("SELECT 1 FROM tasks WHERE url = ?", (url,)))
+        if not resumed:
+            self.execute("INSERT INTO tasks (url, payload) VALUES (?, ?)", (url, payload))
+        return TaskJournal(self, url, resumed)
+
+
+class TaskJournal:
+    """ The journal of a single task """
+
+    def __init__(self, journal, url, resumed):
+        self.journal = journal
+        self.url = url
+        self.resumed = resumed
+        self.finished = False
+        self.staged = set()
+        self.staging_dir = os.path.join(
+            journal.staging_dir, hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        )
+
+    def jobs(self):
+        """ (job, state) of every job recorded for the task """
+        rows = self.journal.execute(
+            "SELECT id, job, state FROM jobs WHERE task_url = ? ORDER BY id", (self.url,)
+        )
+        return [(dict(json.loads(job), journal_id=job_id), state) for job_id, job, state in rows]
+
+    def resume(self):
+        """ The jobs which didn't finish, and remember the staged pages.
+            A POST or launch which was interrupted may or may not have
+            reached the Tower, so it can't be resumed
+        """
+        jobs = []
+        for job, state in self.jobs():
+            if state == DONE:
+                continue
+            if state == STARTED and job["method"] in ("post", "launch"):
+                raise Exception(
+                    f"Interrupted {job['method']} {job['href_slug']} can't be retried safely"
+                )
+            jobs.append(job)
+        self.staged = {
+            row[0]
+            for row in self.journal.execute(
+                "SELECT filename FROM pages WHERE task_url = ?", (self.url,)
+            )
+        }
+        logger.info(
+            "Resuming task %s with %d jobs and %d staged pages",
+            self.url,
+            len(jobs),
+            len(self.staged),
+        )
+        return jobs
+
+    def reset(self):
+        """ Forget the progress of the task, it starts from the beginning """
+        self.journal.execute("DELETE FROM jobs WHERE task_url = ?", (self.url,))
+        self.journal.execute("DELETE FROM pages WHERE task_url = ?", (self.url,))
+        self.staged = set()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def add_job(self, job):
+        """ Record a queued job, returns its id """
+        with self.journal.lock, self.journal.connection:
+            cursor = self.journal.connection.execute(
+                "INSERT INTO jobs (task_url, job, state) VALUES (?, ?, ?)",
+                (self.url, json.dumps(job), PENDING),
+            )
+            return cursor.lastrowid
+
+    def job_started(self, job):
+        """ A worker picked up the job """
+        self.set_state(job, STARTED)
+
+    def job_done(self, job):
+        """ A worker finished the job """
+        self.set_state(job, DONE)
+
+    def set_state(self, job, state):
+        """ Update the state of a recorded job """
+        job_id = job.get("journal_id", None)
+        if job_id is not None:
+            self.journal.execute("UPDATE jobs SET state = ? WHERE id = ?", (state, job_id))
+
+    def page_written(self, filename):
+        """ The tar writer staged a page, called from its writer thread """
+        self.journal.execute(
+            "INSERT OR IGNORE INTO pages (task_url, filename) VALUES (?, ?)",
+            (self.url, filename),
+        )
+
+    def finish(self):
+        """ The task has been reported back to the cloud """
+        self.reset()
+        self.journal.execute("DELETE FROM tasks WHERE url = ?", (self.url,))
+        self.finished = True
+
+
+def get_journal(config):
+    """ The process wide journal, None unless enabled in the config """
+    if not config.getboolean("JOURNAL", "enabled", fallback=False):
+        return None
+    path = config.get("JOURNAL", "path")
+    if path not in JOURNALS:
+        JOURNALS[path] = JobJournal.from_config(config)
+    return JOURNALS[path]
@@ -0,0 +1,196 @@
+""" Job Monitor, follows the Tower jobs started by launch till they
+    complete. All the launched jobs of a catalog task are tracked by a
+    single scheduler so no worker sits in a sleep while a job runs. Each
+    job is polled right away and then with an exponentially growing
+    interval capped at its refresh_interval_seconds. When several jobs of
+    the same type are due their status is looked up with one list query
+    filtered by id__in. A monitor job stays unfinished in the work queue
+    till its Tower job completes so the queue is only joined after that
+"""
+import time
+import asyncio
+import logging
+import collections
+from urllib.parse import urlparse
+from urllib.parse import parse_qsl
+from catalog_mqtt_client.handlers import http_session
+from catalog_mqtt_client.handlers import json_codec
+
+logger = logging.getLogger(__name__)
+
+
+class MonitoredJob:
+    """ A launched Tower job and when to poll it next """
+
+    def __init__(self, worker, url, job, initial_interval):
+        self.worker = worker
+        self.url = url
+        self.job = job
+        url_info = urlparse(url)
+        self.path = url_info.path
+        self.params = dict(parse_qsl(url_info.query))
+        self.list_path, _, self.job_id = self.path.rstrip("/").rpartition("/")
+        self.max_interval = job.get(
+            "refresh_interval_seconds", worker.DEFAULT_REFRESH_INTERVAL
+        )
+        self.interval = min(initial_interval, self.max_interval)
+        self.next_poll = time.monotonic()
+
+    def backoff(self, factor):
+        """ The job is still running, wait longer before the next poll """
+        self.next_poll = time.monotonic() + self.interval
+        self.interval = min(self.interval * factor, self.max_interval)
+
+
+class JobMonitor:
+    """ Polls every tracked job from one scheduler task. The first error
+        stops the monitoring and is raised by check
+    """
+
+    DEFAULT_INITIAL_INTERVAL = 1.0
+    DEFAULT_BACKOFF_FACTOR = 2.0
+
+    def __init__(self, config, queue):
+        self.config = config
+        self.queue = queue
+        self.initial_interval = config.getfloat(
+            "JOB_MONITOR", "initial_interval", fallback=self.DEFAULT_INITIAL_INTERVAL
+        )
+        self.backoff_factor = config.getfloat(
+            "JOB_MONITOR", "backoff_factor", fallback=self.DEFAULT_BACKOFF_FACTOR
+        )
+        self.jobs = []
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.error = None
+        self.jobs_monitored = 0
+        self.polls = 0
+        self.batched_polls = 0
+
+    def track(self, worker, url, job):
+        """ Start monitoring a job, the caller leaves it unfinished in
+            the queue and the monitor marks it done once the job completes
+        """
+        self.jobs.append(MonitoredJob(worker, url, job, self.initial_interval))
+        self.jobs_monitored = self.jobs_monitored + 1
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        """ Poll the jobs as they fall due till none are left """
+        try:
+            while self.jobs:
+                now = time.monotonic()
+                due = [job for job in self.jobs if job.next_poll <= now]
+                if due:
+                    await self.poll(due)
+                    continue
+
+                self.wakeup.clear()
+                delay = min(job.next_poll for job in self.jobs) - now
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as exp:  # pylint: disable=W0703
+            self.fail(exp)
+
+    async def poll(self, due):
+        """ Poll the due jobs, a list query per job type when more than one is due """
+        session = http_session.get_session(self.config)
+        groups = collections.defaultdict(list)
+        for job in due:
+            groups[job.list_path].append(job)
+
+        for jobs in groups.values():
+            if len(jobs) == 1:
+                body = await self.get_job(session, jobs[0])
+                await self.update(jobs[0], body)
+                continue
+
+            statuses = await self.get_statuses(session, jobs)
+            for job in jobs:
+                if job.job_id not in statuses:
+                    raise Exception("Job %s not found in %s" % (job.job_id, job.list_path))
+                if statuses[job.job_id] in job.worker.JOB_COMPLETION_STATUSES:
+                    # The list view leaves out fields like artifacts
+                    await self.update(job, await self.get_job(session, job))
+                else:
+                    job.backoff(self.backoff_factor)
+
+    async def get_job(self, session, job):
+        """ Get the detail of a single job """
+        self.polls = self.polls + 1
+        response = await job.worker.get_page(
+            session, job.path, job.params, method="monitor"
+        )
+        if response["status"] != 200:
+            raise Exception(
+                "GET failed %s status %s body %s"
+                % (job.url, response["status"], job.worker.body_text(response))
+            )
+        return json_codec.loads(response["body"])
+
+    async def get_statuses(self, session, jobs):
+        """ Status of several jobs of the same type with one list query """
+        self.polls = self.polls + 1
+        self.batched_polls = self.batched_polls + 1
+        params = {
+            "id__in": ",".join(job.job_id for job in jobs),
+            "page_size": len(jobs),
+        }
+        response = await jobs[0].worker.get_page(
+            session, jobs[0].list_path + "/", params, method="monitor"
+        )
+        if response["status"] != 200:
+            raise Exception(
+                "GET failed %s status %s body %s"
+                % (jobs[0].list_path, response["status"], jobs[0].worker.body_text(response))
+            )
+        body = json_codec.loads(response["body"])
+        return {str(result["id"]): result["status"] for result in body["results"]}
+
+    async def update(self, job, body):
+        """ Send the job once it has completed and mark it done in the
+            journal, otherwise poll it later
+        """
+        if body["status"] not in job.worker.JOB_COMPLETION_STATUSES:
+            job.backoff(self.backoff_factor)
+            return
+
+        self.jobs.remove(job)
+        try:
+            await job.worker.send_response(body, job.url, job.job)
+            if job.worker.journal:
+                job.worker.journal.job_done(job.job)
+        finally:
+            self.queue.task_done()
+
+    def fail(self, exp):
+        """ Stop monitoring, the jobs are marked done so the queue can be joined """
+        logger.error("Job monitoring failed %s", exp)
+        self.error = self.error or exp
+        for _ in self.jobs:
+            self.queue.task_done()
+        self.jobs = []
+
+    def check(self):
+        """ Raise the error which stopped the monitoring """
+        if self.error:
+            raise self.error
+
+    async def cancel(self):
+        """ Stop the scheduler """
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def stats(self):
+        """ Polling statistics """
+        return dict(
+            jobs_monitored=self.jobs_monitored,
+            polls=self.polls,
+            batched_polls=self.batched_polls,
+        )
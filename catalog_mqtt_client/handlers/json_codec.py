@@ -0,0 +1,141 @@
+""" JSON Codec, encodes and decodes the JSON of the Tower responses, the
+    catalog tasks and the pages handed to the writers. orjson or ujson is
+    used when installed, otherwise the standard json module. Encoding
+    always returns UTF-8 bytes whichever backend is used.
+    The worker hands the writers every page as JSON bytes, which join
+    splices into a larger document without decoding them again.
+    encoded_size works out the length of the encoded object without
+    building the text
+"""
+import json
+import logging
+import collections
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+logger = logging.getLogger(__name__)
+
+Backend = collections.namedtuple("Backend", ["name", "dumps", "loads"])
+
+# The separators json.dumps uses by default
+ITEM_SEPARATOR_SIZE = len(", ")
+KEY_SEPARATOR_SIZE = len(": ")
+
+AUTO = "auto"
+BACKENDS = {
+    "json": Backend(
+        "json", lambda value: json.dumps(value).encode("utf-8"), json.loads
+    ),
+}
+if orjson is not None:
+    BACKENDS["orjson"] = Backend(
+        "orjson",
+        lambda value: orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS),
+        orjson.loads,
+    )
+if ujson is not None:
+    BACKENDS["ujson"] = Backend(
+        "ujson",
+        lambda value: ujson.dumps(
+            value, ensure_ascii=False, escape_forward_slashes=False
+        ).encode("utf-8"),
+        ujson.loads,
+    )
+
+# Fastest first
+PREFERRED = ("orjson", "ujson", "json")
+
+BACKEND = next(BACKENDS[name] for name in PREFERRED if name in BACKENDS)
+
+
+def select_backend(name=AUTO):
+    """ Use the named backend, auto picks the fastest one installed """
+    global BACKEND  # pylint: disable=W0603
+    if name == AUTO:
+        name = next(name for name in PREFERRED if name in BACKENDS)
+    if name not in BACKENDS:
+        raise Exception(f"JSON backend {name} is not installed")
+    BACKEND = BACKENDS[name]
+    logger.info("Using the %s JSON backend", name)
+    return BACKEND
+
+
+def dumps(value):
+    """ Encode a value as UTF-8 JSON bytes """
+    return BACKEND.dumps(value)
+
+
+def loads(data):
+    """ Decode JSON from bytes or a str """
+    return BACKEND.loads(data)
+
+
+def is_encoded(data):
+    """ True if the page is JSON text """
+    return isinstance(data, (str, bytes, bytearray))
+
+
+def encode(data):
+    """ The page as UTF-8 JSON bytes """
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return dumps(data)
+
+
+def decode(data):
+    """ The page as a parsed object """
+    if is_encoded(data):
+        return loads(data)
+    return data
+
+
+def join(fields):
+    """ A JSON object as UTF-8 bytes, from a dict of keys to values which
+        are already encoded
+    """
+    return b"{" + b",".join(dumps(key) + b":" + value for key, value in fields.items()) + b"}"
+
+
+def page_size(data, size=None):
+    """ The bytes a page is accounted for, size if the caller knows it """
+    if size is not None:
+        return size
+    if is_encoded(data):
+        return len(data)
+    return encoded_size(data)
+
+
+def encoded_size(value, limit=None):
+    """ The length of json.dumps(value), adding up the size of every
+        container and scalar. Stops as soon as the size is over limit
+    """
+    size = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            size = size + 2 + KEY_SEPARATOR_SIZE * len(item)
+            size = size + ITEM_SEPARATOR_SIZE * max(len(item) - 1, 0)
+            for key, child in item.items():
+                # Keys which aren't strings are written as strings
+                key = key if isinstance(key, str) else json.dumps(key)
+                size = size + len(json.dumps(key))
+                stack.append(child)
+        elif isinstance(item, (list, tuple)):
+            size = size + 2 + ITEM_SEPARATOR_SIZE * max(len(item) - 1, 0)
+            stack.extend(item)
+        else:
+            size = size + len(json.dumps(item))
+        if limit is not None and size > limit:
+            break
+    return size
@@ -1,6 +1,10 @@
-""" JSON Writer, writes JSON back to the cloud """
-import json
+""" JSON Writer, writes JSON back to the cloud in batched updates """
+import asyncio
 import logging
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client import tracing
+from catalog_mqtt_client.handlers import backpressure
+from catalog_mqtt_client.handlers import json_codec
 
 logger = logging.getLogger(__name__)
 
@@ -8,32 +12,138 @@ logger = logging.getLogger(__name__)
 class JSONWriter:
     """ JSON Writer Class, supports write/flush/flush_errors/cleanup methods """
 
+    DEFAULT_BATCH_BYTES = 256 * 1024
+    DEFAULT_FLUSH_INTERVAL = 1.0
+
     def __init__(self, config, c_task):
         self.config = config
         self.c_task = c_task
+        self.batch_bytes = config.getint(
+            "JSON_WRITER", "batch_bytes", fallback=self.DEFAULT_BATCH_BYTES
+        )
+        self.flush_interval = config.getfloat(
+            "JSON_WRITER", "flush_interval", fallback=self.DEFAULT_FLUSH_INTERVAL
+        )
+        self.lock = asyncio.Lock()
+        self.budget = None
+        self.pending = {}
+        self.pending_bytes = 0
+        self.timer = None
+        self.timer_task = None
+        self.pages = 0
+        self.patches = 0
 
-    async def write(self, data, filename):
-        """ Write a Page to the Catalog Task in the cloud"""
+    async def write(self, data, filename, size=None):
+        """ Add a Page to the batch for the Catalog Task in the cloud. The
+            batch is sent once it grows over batch_bytes or flush_interval
+            seconds after its first page, keyed by the page filename. The
+            page bytes are spliced into the PATCH without decoding them
+        """
         logger.debug("JSON Page %s", filename)
-        await self.c_task.update(
-            {"output": json.loads(data), "state": "running", "status": "ok"}
-        )
+        self.check_timer_task()
+        if self.budget is None:
+            self.budget = backpressure.get_budget(self.config)
+        data = json_codec.encode(data)
+        size = json_codec.page_size(data, size)
+        await self.budget.acquire(size)
+        metrics.WRITER_BYTES_WRITTEN.inc(size, writer="json")
+        self.pending[filename] = data
+        self.pending_bytes = self.pending_bytes + size
+        self.pages = self.pages + 1
+
+        if self.pending_bytes >= self.batch_bytes:
+            await self.send_pending()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, self.on_timer
+            )
+
+    def on_timer(self):
+        """ The flush interval expired, send whatever is pending """
+        self.timer = None
+        self.timer_task = asyncio.create_task(self.send_pending())
 
-    async def flush(self):
-        """ Flush the final data to  Catalog Task in the cloud"""
-        data = {"state": "completed", "status": "ok"}
-        await self.c_task.update(data)
+    def check_timer_task(self):
+        """ Raise the exception of a failed interval flush """
+        if self.timer_task and self.timer_task.done():
+            task, self.timer_task = self.timer_task, None
+            task.result()
+
+    def take_pending(self):
+        """ Remove the pages from the batch, returns them with the
+            bytes to give back to the budget once they have been sent
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        output, size = self.pending, self.pending_bytes
+        self.pending = {}
+        self.pending_bytes = 0
+        return output, size
+
+    def release(self, size):
+        """ Give the bytes of sent or dropped pages back to the budget """
+        if self.budget:
+            self.budget.release(size)
+
+    async def send_pending(self):
+        """ Send the batched pages as a single running update. Only one
+            PATCH is in flight, pages added while waiting for the previous
+            one go out with this one
+        """
+        async with self.lock:
+            if not self.pending:
+                return
+            pages, size = self.take_pending()
+            try:
+                await self.update("running", "ok", pages)
+                metrics.WRITER_BYTES_UPLOADED.inc(size, writer="json")
+            finally:
+                self.release(size)
+
+    async def update(self, state, status, pages=None, **extra):
+        """ Patch the Catalog Task, the caller holds the lock. A single page
+            is sent as the output, like an unbatched update, several pages
+            are sent under pages keyed by their filename. The encoded pages
+            are joined into the body as is, extra are other top level fields
+        """
+        fields = {name: json_codec.dumps(value) for name, value in extra.items() if value}
+        fields["state"] = json_codec.dumps(state)
+        fields["status"] = json_codec.dumps(status)
+        if pages and len(pages) == 1:
+            fields["output"] = next(iter(pages.values()))
+        elif pages:
+            fields["pages"] = json_codec.join(pages)
+        self.patches = self.patches + 1
+        with tracing.span("json.update", state=state):
+            await self.c_task.update(json_codec.join(fields))
+
+    async def flush(self, stats=None):
+        """ Flush the final data to  Catalog Task in the cloud, the task
+            statistics and timing go next to the output, not in it
+        """
+        if self.timer_task:
+            await self.timer_task
+        async with self.lock:
+            pages, size = self.take_pending()
+            try:
+                await self.update(
+                    "completed", "ok", pages, timing=tracing.timing(), stats=stats
+                )
+                metrics.WRITER_BYTES_UPLOADED.inc(size, writer="json")
+            finally:
+                self.release(size)
+        logger.debug("JSON Writer sent %d pages in %d updates", self.pages, self.patches)
 
     async def flush_errors(self, errors):
         """ Flush the errors to  Catalog Task in the cloud"""
         logger.error(errors)
-        data = {"output": {"errors": errors}, "state": "completed", "status": "error"}
-        await self.c_task.update(data)
-
-    # pylint: disable=W0107
-    # This dummy function is needed to satisfy the interface definition for writer
-    # for JSON we dont have any cleanup but for the TarWriter we have to remove the
-    # Temporary Directory and delete the temporary tgz file
-    def cleanup(self):
-        """ Cleanup function """
-        pass
+        async with self.lock:
+            self.release(self.take_pending()[1])
+            await self.update("completed", "error", output={"errors": errors})
+
+    async def cleanup(self):
+        """ Stop the interval flush, the JSON Writer has no files to remove """
+        self.release(self.take_pending()[1])
+        if self.timer_task and not self.timer_task.done():
+            self.timer_task.cancel()
@@ -1,63 +1,126 @@
 """ This module handles the incoming MQTT Message"""
+import time
 import logging
-import json
-import asyncio
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client import tracing
 from catalog_mqtt_client.handlers import catalog_task
 from catalog_mqtt_client.handlers import tar_writer
 from catalog_mqtt_client.handlers import json_writer
-from catalog_mqtt_client.handlers import tower_api_worker
+from catalog_mqtt_client.handlers import worker_pool
+from catalog_mqtt_client.handlers import job_journal
+from catalog_mqtt_client.handlers import json_codec
 
 logger = logging.getLogger(__name__)
 
 
 class MessageHandler:
-    """ MQTT MessageHandler
-        It first gets the Catalog Task from cloud.redhat.com
-        Then for each request in the Input it adds them to a queue
-        Creates multiple workers to deal with the work in the queue
-    """
+    """ MQTT MessageHandler, runs the jobs of a Catalog Task and sends back the results """
 
-    def __init__(self, config, payload):
+    def __init__(self, config, payload, received=None):
         logger.debug("Request Payload is %s", payload)
-        self.request = json.loads(payload)
+        self.received = received or time.monotonic()
+        self.payload = payload
+        self.request = json_codec.loads(payload)
         self.config = config
         self.c_task = catalog_task.CatalogTask(self.config, self.request["url"])
+        self.stats = {}
 
     async def start(self):
-        """ Start processing the incoming MQTT Message """
-        data = await self.c_task.get()
-        work = json.loads(data)["input"]
+        """ Start processing the incoming MQTT Message, the time from
+            receiving the message till it is finished is recorded and
+            traced when tracing is enabled
+        """
+        status = "error"
+        trace = tracing.Trace.from_config(
+            self.config, "catalog_task", url=self.request["url"]
+        )
+        try:
+            with tracing.activate(trace), tracing.span("message"):
+                await self.process()
+            status = "ok"
+        finally:
+            metrics.MESSAGE_DURATION.observe(
+                time.monotonic() - self.received, status=status
+            )
+            if trace:
+                await trace.export()
+
+    async def process(self):
+        """ Get the Catalog Task from cloud.redhat.com, queue its jobs and
+            run them with a pool of workers through the writer. With the
+            job journal enabled an interrupted task resumes from the jobs
+            which hadn't finished
+        """
+        with tracing.span("catalog_task.get"):
+            data = await self.c_task.get()
+        work = json_codec.loads(data)["input"]
         logger.debug(work)
-        current_writer = self.get_writer(work)
+        journal = self.start_journal()
+        current_writer = self.get_writer(work, journal)
 
         try:
-            work_queue = asyncio.Queue()
-            for job in work["jobs"]:
+            if journal:
+                jobs = self.journaled_jobs(work, journal, current_writer)
+                work_queue = worker_pool.JournaledQueue(journal)
+            else:
+                jobs = work["jobs"]
+                work_queue = worker_pool.TimedQueue()
+            for job in jobs:
                 logger.debug(job)
                 await work_queue.put(job)
 
-            worker_1 = tower_api_worker.TowerApiWorker(
-                self.config, current_writer, work_queue
-            )
-            worker_2 = tower_api_worker.TowerApiWorker(
-                self.config, current_writer, work_queue
-            )
-
-            await asyncio.gather(
-                asyncio.create_task(worker_1.start()),
-                asyncio.create_task(worker_2.start()),
+            pool = worker_pool.WorkerPool(
+                self.config, current_writer, work_queue, journal
             )
-            await current_writer.flush()
+            if journal and journal.resumed:
+                pool.related.seen.update(job["href_slug"] for job, _ in journal.jobs())
+            try:
+                with tracing.span("worker_pool.run", jobs=len(work["jobs"])):
+                    await pool.run()
+            finally:
+                self.stats = pool.stats()
+            with tracing.span("writer.flush"):
+                await current_writer.flush(self.stats)
+            if pool.delta:
+                await pool.delta.commit()
+            if journal:
+                journal.finish()
         except Exception as exp:
             await current_writer.flush_errors([str(exp)])
+            if journal:
+                journal.finish()
             raise
         finally:
-            current_writer.cleanup()
+            await current_writer.cleanup()
+
+    def start_journal(self):
+        """ The task's journal, None unless the job journal is enabled """
+        journal = job_journal.get_journal(self.config)
+        if journal is None:
+            return None
+        return journal.start_task(self.request["url"], self.payload)
 
-    def get_writer(self, work):
+    @staticmethod
+    def journaled_jobs(work, journal, writer):
+        """ The jobs left over if the task was interrupted, only a writer
+            whose pages survived the restart can carry on from them.
+            Otherwise the task starts again with all its jobs
+        """
+        if journal.resumed and getattr(writer, "resumable", False) and journal.jobs():
+            return journal.resume()
+        journal.reset()
+        return work["jobs"]
+
+    def get_writer(self, work, journal=None):
         """ Create an appropriate writer object based on the response format """
         if work["response_format"] == "tar":
-            return tar_writer.TarWriter(self.config, self.c_task, work["upload_url"])
+            return tar_writer.TarWriter(
+                self.config,
+                self.c_task,
+                work["upload_url"],
+                full_resync=work.get("full_resync", False),
+                journal=journal,
+            )
 
         # By default we support the JSON Writer
         return json_writer.JSONWriter(self.config, self.c_task)
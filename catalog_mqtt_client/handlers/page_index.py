@@ -0,0 +1,175 @@
+""" Page Index, a local content hash index of the pages uploaded per
+    Tower path. A TarWriter leaves out the bodies of pages which are the
+    same as in the last successful upload and lists them in a manifest
+    instead. The index keeps at most max_entries pages, dropping the least
+    recently uploaded, and is persisted as an append only log which is
+    compacted once it holds more than COMPACT_RATIO lines per entry
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+from catalog_mqtt_client.handlers import json_codec
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {}
+MANIFEST_NAME = "dedup_manifest.json"
+
+
+def digest(data):
+    """ Content hash of a page, the encoded JSON bytes """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class PageIndex:
+    """ LRU map of page key to the digest of its last uploaded body """
+
+    DEFAULT_MAX_ENTRIES = 100000
+    COMPACT_RATIO = 2
+
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.log_lines = 0
+        self.compactions = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Build the index from the [PAGE_DEDUP] section """
+        return cls(
+            config.get("PAGE_DEDUP", "index_file"),
+            config.getint("PAGE_DEDUP", "max_entries", fallback=cls.DEFAULT_MAX_ENTRIES),
+        )
+
+    @staticmethod
+    def key(tower_url, filename):
+        """ A page of a Tower """
+        return f"{tower_url.rstrip('/')}/{filename.lstrip('/')}"
+
+    def load(self):
+        """ Replay the log, an unreadable line ends the replay """
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as file_handle:
+                for line in file_handle:
+                    record = json.loads(line)
+                    self.add(record["key"], record["digest"])
+                    self.log_lines = self.log_lines + 1
+        except (OSError, ValueError, KeyError):
+            logger.warning("Page index %s is damaged, using what was read", self.filename)
+
+    def add(self, key, page_digest):
+        """ Remember a page as the most recently uploaded """
+        self.entries[key] = page_digest
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        """ The digest of the last upload of a page, safe from any thread """
+        with self.lock:
+            return self.entries.get(key, None)
+
+    def commit(self, uploaded):
+        """ Record the pages of a successful upload, called from a thread """
+        with self.lock:
+            for key, page_digest in uploaded.items():
+                self.add(key, page_digest)
+            if self.log_lines + len(uploaded) > self.COMPACT_RATIO * max(
+                len(self.entries), 1
+            ):
+                self.compact()
+            else:
+                self.append(uploaded)
+
+    def append(self, uploaded):
+        """ Add the pages to the end of the log """
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename, "a") as file_handle:
+            for key, page_digest in uploaded.items():
+                file_handle.write(json.dumps({"key": key, "digest": page_digest}) + "\n")
+        self.log_lines = self.log_lines + len(uploaded)
+
+    def compact(self):
+        """ Rewrite the log with one line per live entry """
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(dirname, exist_ok=True)
+        file_handle, tmpname = tempfile.mkstemp(dir=dirname, prefix=".pages")
+        try:
+            with os.fdopen(file_handle, "w") as tmpfile:
+                for key, page_digest in self.entries.items():
+                    tmpfile.write(json.dumps({"key": key, "digest": page_digest}) + "\n")
+            os.replace(tmpname, self.filename)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        self.log_lines = len(self.entries)
+        self.compactions = self.compactions + 1
+        logger.debug("Compacted page index to %d entries", self.log_lines)
+
+
+class PageDedup:
+    """ Per upload view of the index. Pages are checked from the writer
+        thread, the digests are committed once the upload succeeded. With
+        full_resync every page is sent, as asked for by the cloud
+    """
+
+    def __init__(self, index, tower_url, full_resync=False):
+        self.index = index
+        self.tower_url = tower_url
+        self.full_resync = full_resync
+        self.written = {}
+        self.unchanged = {}
+
+    def is_unchanged(self, data, filename):
+        """ Record the page, True if its body can be left out """
+        if filename == MANIFEST_NAME:
+            return False
+        key = self.index.key(self.tower_url, filename)
+        page_digest = digest(data)
+        self.written[key] = page_digest
+        if not self.full_resync and self.index.get(key) == page_digest:
+            self.unchanged[filename] = page_digest
+            return True
+        return False
+
+    def manifest(self):
+        """ The pages left out of the upload """
+        return json_codec.dumps(
+            {"full_resync": self.full_resync, "unchanged": self.unchanged}
+        )
+
+    async def commit(self):
+        """ The upload succeeded, remember what the cloud now has """
+        if self.written:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.index.commit, self.written
+            )
+        logger.debug(
+            "Upload left out %d of %d unchanged pages", len(self.unchanged), len(self.written)
+        )
+
+    def stats(self):
+        """ Dedup statistics of the upload """
+        return dict(pages=len(self.written), unchanged=len(self.unchanged))
+
+
+def get_index(config):
+    """ The process wide index, None unless enabled in the config """
+    if not config.getboolean("PAGE_DEDUP", "enabled", fallback=False):
+        return None
+    filename = config.get("PAGE_DEDUP", "index_file")
+    if filename not in INDEXES:
+        INDEXES[filename] = PageIndex.from_config(config)
+    return INDEXES[filename]
@@ -0,0 +1,175 @@
+""" Response Cache, an in process LRU cache with a TTL per href prefix
+    for read only Tower GETs, shared across catalog tasks. Entries are
+    evicted to stay within a memory budget and stale entries carrying
+    an ETag or Last-Modified are revalidated instead of refetched
+"""
+import time
+import logging
+import collections
+from catalog_mqtt_client import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE = None
+
+
+class CacheEntry:
+    """ A cached response body, as bytes, with its validators """
+
+    def __init__(self, body, etag, last_modified, expires):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+        self.size = len(body)
+
+    def fresh(self):
+        """ Can the entry be used without asking the Tower """
+        return time.monotonic() < self.expires
+
+    def validators(self):
+        """ Conditional request headers to revalidate a stale entry """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """ LRU + TTL cache keyed by path and query parameters. Only paths
+        matching one of the configured href prefixes are cached
+    """
+
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, prefixes=None):
+        self.max_bytes = max_bytes
+        self.prefixes = sorted(
+            ((prefix.strip("/"), ttl) for prefix, ttl in (prefixes or {}).items()),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """ Build the cache from the [CACHE] and [CACHE_TTL] sections """
+        prefixes = {}
+        if config.has_section("CACHE_TTL"):
+            for prefix, ttl in config.items("CACHE_TTL"):
+                prefixes[prefix] = float(ttl)
+        return cls(
+            config.getint("CACHE", "max_bytes", fallback=cls.DEFAULT_MAX_BYTES),
+            prefixes,
+        )
+
+    @staticmethod
+    def key(path, params):
+        """ Cache key from the path and the query parameters """
+        return (path.strip("/"), tuple(sorted((str(k), str(v)) for k, v in params.items())))
+
+    def ttl_for(self, path):
+        """ TTL of the longest matching href prefix, None if not cacheable """
+        path = path.strip("/")
+        for prefix, ttl in self.prefixes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return ttl
+        return None
+
+    def lookup(self, key):
+        """ Get an entry, fresh or stale, and mark it as recently used """
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+
+        if not entry.fresh() and not entry.validators():
+            self.remove(key)
+            self.misses = self.misses + 1
+            return None
+
+        self.entries.move_to_end(key)
+        if entry.fresh():
+            self.hits = self.hits + 1
+        return entry
+
+    def store(self, key, body, headers, ttl):
+        """ Add a response to the cache, evicting the least recently used """
+        entry = CacheEntry(
+            body,
+            headers.get("ETag", None),
+            headers.get("Last-Modified", None),
+            time.monotonic() + ttl,
+        )
+        if key in self.entries:
+            self.remove(key)
+        self.add(key, entry)
+
+    def add(self, key, entry):
+        """ Put an entry in the cache, evicting the least recently used """
+        if entry.size > self.max_bytes:
+            return
+
+        self.entries[key] = entry
+        self.size = self.size + entry.size
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions = self.evictions + 1
+
+    def refresh(self, key, entry, ttl):
+        """ The Tower confirmed the stale entry lookup returned is still
+            valid, it's put back if it was evicted in the meantime
+        """
+        entry.expires = time.monotonic() + ttl
+        self.revalidated = self.revalidated + 1
+        if self.entries.get(key, None) is entry:
+            self.entries.move_to_end(key)
+        else:
+            if key in self.entries:
+                self.remove(key)
+            self.add(key, entry)
+        return entry
+
+    def remove(self, key):
+        """ Drop an entry """
+        entry = self.entries.pop(key)
+        self.size = self.size - entry.size
+
+    def stats(self):
+        """ Cache statistics """
+        return dict(
+            entries=len(self.entries),
+            bytes=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            revalidated=self.revalidated,
+            evictions=self.evictions,
+        )
+
+
+def cache_stats():
+    """ Statistics of the process wide cache for the metrics endpoint """
+    if CACHE is None:
+        return []
+    return [({"stat": name}, value) for name, value in CACHE.stats().items()]
+
+
+metrics.RESPONSE_CACHE.set_function(cache_stats)
+
+
+def get_cache(config):
+    """ The process wide cache, None unless enabled in the config """
+    global CACHE  # pylint: disable=W0603
+    if not config.getboolean("CACHE", "enabled", fallback=False):
+        return None
+    if CACHE is None:
+        CACHE = ResponseCache.from_config(config)
+    return CACHE
@@ -0,0 +1,232 @@
+""" Streaming Page Parser, incrementally parses a Tower list page from
+    the byte stream. The items of the results array are filtered one at a
+    time as they arrive, so the whole unfiltered page is never held in
+    memory as a string or as parsed objects
+"""
+import re
+import json
+import codecs
+import functools
+from jmespath import visitor
+from catalog_mqtt_client.handlers import jmespath_cache
+
+WHITESPACE = re.compile(r"\s*")
+# What may follow the part of a number which has arrived, "" for the end
+# of the buffer
+NUMBER_CONTINUATIONS = ("", ".", "e", "E", "+", "-")
+RESULTS_FIELD = {"type": "field", "children": [], "value": "results"}
+
+
+class StreamingPageParser:
+    """ Parser for a top level JSON object fed in chunks. Every key except
+        results is decoded as is, each item of results is passed through
+        item_filter, which returns the list of values to keep for the item
+    """
+
+    def __init__(self, item_filter):
+        self.item_filter = item_filter
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.state = self.parse_start
+        self.key = None
+        self.body = {}
+        self.results = []
+        self.item_count = 0
+
+    def feed(self, chunk, final=False):
+        """ Add the next chunk of bytes and parse as far as possible """
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(chunk, final)
+        self.pos = 0
+        while self.state is not None and self.state(final):
+            pass
+
+    def close(self):
+        """ Finish parsing, returns the body with the filtered results """
+        self.feed(b"", True)
+        if self.state is not None:
+            raise ValueError("Incomplete JSON document")
+        return self.body
+
+    def skip_whitespace(self):
+        """ Move past whitespace, True if there is more to look at """
+        self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+        return self.pos < len(self.buffer)
+
+    def expect(self, char):
+        """ Consume a single structural character """
+        if self.buffer[self.pos] != char:
+            raise ValueError(f"Expecting {char!r} at {self.buffer[self.pos:self.pos + 20]!r}")
+        self.pos = self.pos + 1
+
+    def decode_value(self, final):
+        """ Decode one complete JSON value, None if we need more data """
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        # A number at the very end of the buffer, or followed by the start
+        # of a fraction or exponent, may continue in the next chunk
+        if (
+            not final
+            and isinstance(value, (int, float))
+            and not isinstance(value, bool)
+            and self.buffer[end:end + 1] in NUMBER_CONTINUATIONS
+        ):
+            return None
+        self.pos = end
+        return (value,)
+
+    def parse_start(self, _final):
+        """ The opening brace of the page """
+        if not self.skip_whitespace():
+            return False
+        self.expect("{")
+        self.state = self.parse_first_key
+        return True
+
+    def parse_first_key(self, _final):
+        """ A key or the closing brace of an empty object """
+        if not self.skip_whitespace():
+            return False
+        if self.buffer[self.pos] == "}":
+            self.pos = self.pos + 1
+            self.state = None
+        else:
+            self.state = self.parse_key
+        return True
+
+    def parse_key(self, final):
+        """ A key followed by a colon """
+        if not self.skip_whitespace():
+            return False
+        start = self.pos
+        decoded = self.decode_value(final)
+        if decoded is None:
+            return False
+        if not self.skip_whitespace():
+            self.pos = start
+            return False
+        self.expect(":")
+        self.key = decoded[0]
+        self.state = self.parse_results_start if self.key == "results" else self.parse_value
+        return True
+
+    def parse_value(self, final):
+        """ The value of any key other than results """
+        if not self.skip_whitespace():
+            return False
+        decoded = self.decode_value(final)
+        if decoded is None:
+            return False
+        self.body[self.key] = decoded[0]
+        self.state = self.parse_next_key
+        return True
+
+    def parse_next_key(self, _final):
+        """ A comma before the next key or the closing brace """
+        if not self.skip_whitespace():
+            return False
+        if self.buffer[self.pos] == "}":
+            self.pos = self.pos + 1
+            self.state = None
+        else:
+            self.expect(",")
+            self.state = self.parse_key
+        return True
+
+    def parse_results_start(self, final):
+        """ The opening bracket of results, anything else isn't a list """
+        if not self.skip_whitespace():
+            return False
+        if self.buffer[self.pos] != "[":
+            decoded = self.decode_value(final)
+            if decoded is None:
+                return False
+            # Projecting anything but a list gives null in JMESPath
+            self.body["results"] = None
+            self.state = self.parse_next_key
+            return True
+        self.pos = self.pos + 1
+        self.state = self.parse_first_item
+        return True
+
+    def parse_first_item(self, _final):
+        """ An item or the closing bracket of an empty list """
+        if not self.skip_whitespace():
+            return False
+        if self.buffer[self.pos] == "]":
+            self.pos = self.pos + 1
+            self.end_results()
+        else:
+            self.state = self.parse_item
+        return True
+
+    def parse_item(self, final):
+        """ A single result, filtered as soon as it has been decoded """
+        if not self.skip_whitespace():
+            return False
+        decoded = self.decode_value(final)
+        if decoded is None:
+            return False
+        self.item_count = self.item_count + 1
+        self.results.extend(self.item_filter(decoded[0]))
+        self.state = self.parse_next_item
+        return True
+
+    def parse_next_item(self, _final):
+        """ A comma before the next item or the closing bracket """
+        if not self.skip_whitespace():
+            return False
+        if self.buffer[self.pos] == "]":
+            self.pos = self.pos + 1
+            self.end_results()
+        else:
+            self.expect(",")
+            self.state = self.parse_item
+        return True
+
+    def end_results(self):
+        """ Store the filtered results and carry on with the next key """
+        self.body["results"] = self.results
+        self.state = self.parse_next_key
+
+
+def results_item_filter(apply_filter):
+    """ A per item filter for apply_filter expressions projecting the
+        results, e.g. results[].{id:id, name:name}. Follows the JMESPath
+        projection rules, null values are dropped and results[] flattens
+        nested lists. None if the filter needs the whole page and can't
+        be applied while streaming
+    """
+    if not isinstance(apply_filter, str):
+        return None
+    return compiled_item_filter(apply_filter)
+
+
+@functools.lru_cache(maxsize=jmespath_cache.MAX_EXPRESSIONS)
+def compiled_item_filter(apply_filter):
+    """ Build the per item filter once per expression """
+    parsed = jmespath_cache.compile_expression(apply_filter).parsed
+    if parsed["type"] != "projection":
+        return None
+
+    left, right = parsed["children"]
+    if left == {"type": "flatten", "children": [RESULTS_FIELD]}:
+        flatten = True
+    elif left == RESULTS_FIELD:
+        flatten = False
+    else:
+        return None
+
+    interpreter = visitor.TreeInterpreter()
+
+    def item_filter(item):
+        items = item if flatten and isinstance(item, list) else [item]
+        values = [interpreter.visit(right, element) for element in items]
+        return [value for value in values if value is not None]
+
+    return item_filter
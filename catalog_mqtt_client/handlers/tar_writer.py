@@ -1,84 +1,424 @@
-""" Tar Writer, writes pages to a temporary directory and when
-    its time to flush the response to the cloud, it creates a
-    tar file and uploads it to the ingress service. Once it has
-    uploaded the file, it updates the Catalog Task Object
-"""
+""" Tar Writer, uploads the pages to the ingress service as a compressed tar file """
+import io
+import time
+import queue
+import asyncio
+import functools
+import threading
+import collections
 import tempfile
+import contextlib
 from distutils.util import strtobool
 import tarfile
 import os
 import ssl
-import json
 import shutil
 import logging
 import aiohttp
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client import tracing
+from catalog_mqtt_client.handlers import http_session
+from catalog_mqtt_client.handlers import backpressure
+from catalog_mqtt_client.handlers import page_index
+from catalog_mqtt_client.handlers import json_codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
+Codec = collections.namedtuple(
+    "Codec", ["tar_mode", "level_arg", "suffix", "content_type", "filename"]
+)
+
+CONTENT_TYPE_PREFIX = "application/vnd.redhat.topological-inventory.filename+"
+
+# zstd isn't supported by tarfile, the tar stream is piped through zstandard
+CODECS = {
+    "gzip": Codec("gz", "compresslevel", ".tgz", CONTENT_TYPE_PREFIX + "tgz", "inventory.gz"),
+    "bz2": Codec(
+        "bz2", "compresslevel", ".tar.bz2", CONTENT_TYPE_PREFIX + "tar.bz2", "inventory.tar.bz2"
+    ),
+    "xz": Codec("xz", "preset", ".tar.xz", CONTENT_TYPE_PREFIX + "tar.xz", "inventory.tar.xz"),
+    "zstd": Codec(None, "level", ".tar.zst", CONTENT_TYPE_PREFIX + "tar.zst", "inventory.tar.zst"),
+}
+
+
+class UploadProgress:
+    """ Keeps track of the bytes sent for an upload and logs the progress """
+
+    PROGRESS_STEP = 10
+
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.started = time.monotonic()
+        self.next_report = self.PROGRESS_STEP
+
+    def update(self, count):
+        """ Account for a chunk sent, log every PROGRESS_STEP percent """
+        self.sent = self.sent + count
+        metrics.WRITER_UPLOAD_PROGRESS.inc(count, writer="tar")
+        percent = 100 * self.sent // self.total if self.total else 100
+        if percent >= self.next_report:
+            logger.debug(
+                "Uploaded %d of %d bytes (%d%%) %.0f bytes/s",
+                self.sent,
+                self.total,
+                percent,
+                self.throughput(),
+            )
+            self.next_report = percent - percent % self.PROGRESS_STEP + self.PROGRESS_STEP
+
+    def elapsed(self):
+        """ Seconds since the upload started """
+        return time.monotonic() - self.started
+
+    def throughput(self):
+        """ Bytes sent per second """
+        elapsed = self.elapsed()
+        return self.sent / elapsed if elapsed else 0.0
+
+    def stats(self):
+        """ Statistics for the upload """
+        return dict(
+            bytes_sent=self.sent,
+            total_bytes=self.total,
+            seconds=round(self.elapsed(), 3),
+            throughput_bytes_per_second=round(self.throughput()),
+        )
+
 
 class TarWriter:
     """ Tar Writer supports write/flush/flush_errors methods """
 
-    UPLOAD_CONTENT_TYPE = "application/vnd.redhat.topological-inventory.filename+tgz"
+    UPLOAD_CONTENT_TYPE = CODECS["gzip"].content_type
+    DEFAULT_COMPRESSION = "gzip"
+    DEFAULT_MAX_PENDING_WRITES = 16
+    STOP = None
+    STAGED_MODE = "staged"
+    STREAM_MODE = "stream"
+    DEFAULT_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+    DEFAULT_UPLOAD_CHUNK_SIZE = 64 * 1024
+    DEFAULT_UPLOAD_RETRIES = 3
+    DEFAULT_UPLOAD_BACKOFF = 1.0
+    VALID_UPLOAD_CODES = [200, 201, 202]
 
-    def __init__(self, config, c_task, upload_url, dirname=None, tgzfile=None):
+    def __init__(
+        self,
+        config,
+        c_task,
+        upload_url,
+        dirname=None,
+        tgzfile=None,
+        full_resync=False,
+        journal=None,
+    ):
         self.config = config
         self.upload_url = upload_url
         self.c_task = c_task
+        # staged writes the pages to dirname and compresses them on flush,
+        # stream appends them to a compressed tar stream spooled in memory
+        self.mode = config.get("TAR_WRITER", "mode", fallback=self.STAGED_MODE)
+        if self.mode not in (self.STAGED_MODE, self.STREAM_MODE):
+            raise Exception(f"Invalid tar writer mode {self.mode}")
+        self.spool = None
+        self.tar_handle = None
+        self.compressor = None
+        compression = config.get(
+            "TAR_WRITER", "compression", fallback=self.DEFAULT_COMPRESSION
+        )
+        if compression not in CODECS:
+            raise Exception(f"Invalid tar writer compression {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise Exception("zstd compression needs the zstandard package")
+        self.codec = CODECS[compression]
+        self.compression_level = config.getint(
+            "TAR_WRITER", "compression_level", fallback=None
+        )
+        self.compression_seconds = 0.0
+        self.max_pending_writes = config.getint(
+            "TAR_WRITER", "max_pending_writes", fallback=self.DEFAULT_MAX_PENDING_WRITES
+        )
+        self.pending_writes = None
+        self.budget = None
+        self.write_queue = queue.Queue()
+        self.write_thread = None
+        self.write_error = None
+        self.upload_chunk_size = config.getint(
+            "TAR_WRITER", "upload_chunk_size", fallback=self.DEFAULT_UPLOAD_CHUNK_SIZE
+        )
+        self.upload_retries = config.getint(
+            "TAR_WRITER", "upload_retries", fallback=self.DEFAULT_UPLOAD_RETRIES
+        )
+        self.upload_backoff = config.getfloat(
+            "TAR_WRITER", "upload_backoff", fallback=self.DEFAULT_UPLOAD_BACKOFF
+        )
+        self.upload_stats = {}
+        index = page_index.get_index(config)
+        self.dedup = (
+            page_index.PageDedup(index, config["ANSIBLE_TOWER"]["url"], full_resync)
+            if index
+            else None
+        )
+        # Only staged pages can be kept for a resumed task, in the staging
+        # directory of its journal
+        self.journal = journal if self.mode == self.STAGED_MODE else None
         if dirname:
            self.dirname = dirname
+        elif self.journal:
+           self.dirname = self.journal.staging_dir
         else:
            self.dirname = tempfile.TemporaryDirectory(prefix="catalog").name
 
         if tgzfile:
            self.tgzfile = tgzfile
         else:
-           self.tgzfile = tempfile.NamedTemporaryFile(prefix="catalog", suffix=".tgz").name
+           self.tgzfile = tempfile.NamedTemporaryFile(
+               prefix="catalog", suffix=self.codec.suffix
+           ).name
 
         self.initialize_ssl()
+        if self.mode == self.STREAM_MODE:
+            self.open_stream()
+
+    def open_stream(self):
+        """ Open the compressed tar stream on a spooled temporary file """
+        self.spool = tempfile.SpooledTemporaryFile(
+            max_size=self.config.getint(
+                "TAR_WRITER", "spool_max_bytes", fallback=self.DEFAULT_SPOOL_MAX_BYTES
+            ),
+            prefix="catalog",
+            suffix=self.codec.suffix,
+        )
+        self.tar_handle = self.open_tar(self.spool)
+
+    def open_tar(self, file_handle):
+        """ Open a tar file for writing on file_handle with the configured codec """
+        params = {}
+        if self.compression_level is not None:
+            params[self.codec.level_arg] = self.compression_level
+        if self.codec.tar_mode is None:
+            self.compressor = zstandard.ZstdCompressor(**params).stream_writer(
+                file_handle, closefd=False
+            )
+            return tarfile.open(fileobj=self.compressor, mode="w|")
+        return tarfile.open(
+            fileobj=file_handle, mode=f"w:{self.codec.tar_mode}", **params
+        )
+
+    def close_tar(self, tar_handle):
+        """ Finish the tar file and the compressed stream it's written to """
+        tar_handle.close()
+        if self.compressor:
+            self.compressor.close()
+            self.compressor = None
 
-    async def write(self, data, filename):
-        """ Write a file to the temporary directory """
+    async def write(self, data, filename, size=None):
+        """ Queue a page for the writer thread, waits while max_pending_writes
+            pages are queued or the byte budget is used up so the workers
+            can't outrun the disk. data is JSON text or the parsed page,
+            which the writer thread encodes when the caller knows its size
+        """
         logger.debug("JSON Page %s", filename)
+        self.start_write_thread()
+        self.raise_write_error()
+        if size is None:
+            data = json_codec.encode(data)
+        size = json_codec.page_size(data, size)
+        await self.budget.acquire(size)
+        metrics.WRITER_BYTES_WRITTEN.inc(size, writer="tar")
+        try:
+            await self.pending_writes.acquire()
+        except asyncio.CancelledError:
+            self.budget.release(size)
+            raise
+        if self.mode == self.STREAM_MODE:
+            func = self.add_to_stream
+        else:
+            func = self.write_file
+        self.write_queue.put(
+            (
+                self.write_page,
+                (func, data, filename),
+                functools.partial(self.page_written, size),
+            )
+        )
+
+    def write_page(self, func, data, filename):
+        """ Encode the page and write it, unless page dedup finds it
+            unchanged since the last upload. Called from the writer thread
+        """
+        data = json_codec.encode(data)
+        if self.dedup and self.dedup.is_unchanged(data, filename):
+            return
+        func(data, filename)
+
+    def page_written(self, size):
+        """ The writer thread is done with a page, runs on the event loop """
+        self.pending_writes.release()
+        self.budget.release(size)
+
+    def start_write_thread(self):
+        """ Start the writer thread on the first page """
+        if self.write_thread is None:
+            self.pending_writes = asyncio.Semaphore(self.max_pending_writes)
+            self.budget = backpressure.get_budget(self.config)
+            self.write_thread = threading.Thread(
+                target=self.drain_writes,
+                args=(asyncio.get_running_loop(),),
+                name="tar-writer",
+                daemon=True,
+            )
+            self.write_thread.start()
+
+    def drain_writes(self, loop):
+        """ Writer thread, writes the queued pages in order and tells the
+            event loop when each one is done. After an error the remaining
+            pages are skipped, the error is raised on the event loop
+        """
+        while True:
+            item = self.write_queue.get()
+            if item is self.STOP:
+                return
+            func, args, done = item
+            try:
+                if func and self.write_error is None:
+                    func(*args)
+            except Exception as exp:  # pylint: disable=W0703
+                self.write_error = exp
+            try:
+                loop.call_soon_threadsafe(done)
+            except RuntimeError:
+                # The event loop is gone, nobody is waiting
+                pass
+
+    async def wait_for_writes(self):
+        """ Barrier, returns once every queued page has been written """
+        if self.write_thread:
+            written = asyncio.get_running_loop().create_future()
+            self.write_queue.put((None, (), functools.partial(written.set_result, None)))
+            await written
+        self.raise_write_error()
+
+    def raise_write_error(self):
+        """ Raise the error the writer thread ran into """
+        if self.write_error:
+            raise self.write_error
+
+    def write_file(self, data, filename):
+        """ Write a page to the temporary directory """
         fullpath = os.path.join(self.dirname, filename)
         basedir = os.path.dirname(fullpath)
         if not os.path.exists(basedir):
             os.makedirs(basedir)
 
-        with open(fullpath, "w") as file_handle:
+        with open(fullpath, "wb") as file_handle:
             file_handle.write(data)
+        if self.journal:
+            self.journal.page_written(filename)
 
-    async def flush(self):
-        """ Compress all the files into a tarfile and send it to the ingress service"""
-        self.create_tar()
-        logger.debug("Tar file is %s", self.tgzfile)
-        result = await self.upload_file()
-        data = {"output": json.loads(result), "state": "completed", "status": "ok"}
+    async def flush(self, stats=None):
+        """ Compress all the files into a tarfile and send it to the ingress
+            service, the task statistics and timing go next to the output
+            of the ingress service in the final update. The upload and page
+            dedup statistics are added to the task statistics
+        """
+        await self.wait_for_writes()
+        if self.dedup:
+            await self.write(self.dedup.manifest(), page_index.MANIFEST_NAME)
+            await self.wait_for_writes()
+        with tracing.span("tar.compress", mode=self.mode):
+            await self.compress()
+        with tracing.span("tar.upload"):
+            result = await self.upload_file()
+        if self.dedup:
+            await self.dedup.commit()
+        data = {
+            "output": json_codec.loads(result),
+            "state": "completed",
+            "status": "ok",
+        }
+        timing = tracing.timing()
+        if timing:
+            data["timing"] = timing
+        data["stats"] = dict(stats or {}, upload=self.upload_stats)
+        if self.dedup:
+            data["stats"]["dedup"] = self.dedup.stats()
         await self.c_task.update(data)
 
+    async def compress(self):
+        """ Create the tar file in a thread, zlib, bz2, lzma and zstandard
+            release the GIL so the event loop isn't stalled
+        """
+        started = time.monotonic()
+        await asyncio.get_running_loop().run_in_executor(None, self.create_tar)
+        self.compression_seconds = time.monotonic() - started
+        logger.debug(
+            "Tar file is %s compressed in %.3fs", self.tgzfile, self.compression_seconds
+        )
+
     async def flush_errors(self, errors):
         """ If we encountered any errors, flush all the errors to the cloud task"""
         logger.error(errors)
         data = {"output": {"errors": errors}, "state": "completed", "status": "error"}
         await self.c_task.update(data)
 
+    def add_to_stream(self, data, filename):
+        """ Append a page to the tar stream, using the same member names
+            a staged page would get so the archive layout doesn't change
+        """
+        info = tarfile.TarInfo(os.path.join(self.dirname, filename).lstrip("/"))
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar_handle.addfile(info, io.BytesIO(data))
+
     def create_tar(self):
-        """ Create a tar file in a temporary file """
-        with tarfile.open(self.tgzfile, "w:gz") as tar_handle:
+        """ Create a tar file in a temporary file, called from a thread """
+        if self.mode == self.STREAM_MODE:
+            self.close_tar(self.tar_handle)
+            return
+
+        with open(self.tgzfile, "wb") as file_handle:
+            tar_handle = self.open_tar(file_handle)
             for root, _, files in os.walk(self.dirname):
                 for file in files:
                     tar_handle.add(os.path.join(root, file))
+            self.close_tar(tar_handle)
 
     async def upload_file(self):
-        """ Upload the tarfile to cloud as multipart data"""
-        logger.debug("uploading %s", self.tgzfile)
+        """ Upload the tarfile to cloud as multipart data, connection errors
+            and 429/5xx responses are retried with an exponential backoff.
+            The ingress service can't resume a partial upload so every
+            attempt streams the file from the start
+        """
+        attempt = 1
+        while True:
+            try:
+                return await self.upload_attempt(attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if attempt > self.upload_retries:
+                    raise
+                delay = self.upload_backoff * 2 ** (attempt - 1)
+                logger.warning(
+                    "Upload attempt %d failed %s, retrying in %.2fs", attempt, err, delay
+                )
+                await asyncio.sleep(delay)
+                attempt = attempt + 1
+
+    async def upload_attempt(self, attempt):
+        """ Stream the tarfile to the ingress service in bounded chunks """
+        logger.debug("uploading %s attempt %d", self.tgzfile, attempt)
         with aiohttp.MultipartWriter("form-data") as mpwriter:
-            with open(self.tgzfile, "rb") as file_handle:
-                part = mpwriter.append(file_handle)
+            with self.open_archive() as file_handle:
+                progress = UploadProgress(archive_size(file_handle))
+                part = mpwriter.append(self.read_chunks(file_handle, progress))
                 part.set_content_disposition(
-                    "form-data", name="file", filename="inventory.gz"
+                    "form-data", name="file", filename=self.codec.filename
                 )
-                part.headers[aiohttp.hdrs.CONTENT_TYPE] = self.UPLOAD_CONTENT_TYPE
+                part.headers[aiohttp.hdrs.CONTENT_TYPE] = self.codec.content_type
 
                 headers = {}
                 # TODO : Use mTLS certs not userid/password
@@ -86,16 +426,55 @@ class TarWriter:
                     self.config["AUTH"]["username"], self.config["AUTH"]["password"]
                 )
                 headers["Authorization"] = auth.encode()
-                async with aiohttp.ClientSession(headers=headers) as session:
-                    async with session.post(
-                        self.upload_url, ssl=self.ssl_context, data=mpwriter
-                    ) as response:
-                        logger.debug("Status: %s", response.status)
-                        logger.debug(
-                            "Content-type: %s", response.headers["Content-Type"]
+                session = http_session.get_session(self.config)
+                async with session.post(
+                    self.upload_url,
+                    ssl=self.ssl_context,
+                    data=mpwriter,
+                    headers=headers,
+                ) as response:
+                    logger.debug("Status: %s", response.status)
+                    logger.debug(
+                        "Content-type: %s", response.headers.get("Content-Type")
+                    )
+                    logger.debug("Attempt %d stats %s", attempt, progress.stats())
+
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status,
+                            message=response.reason,
                         )
+                    text = await response.text()
+                    if response.status not in self.VALID_UPLOAD_CODES:
+                        raise Exception(f"Upload failed {response.status} {text}")
+                    self.upload_stats = dict(progress.stats(), attempts=attempt)
+                    metrics.WRITER_BYTES_UPLOADED.inc(progress.sent, writer="tar")
+                    metrics.WRITER_UPLOAD_DURATION.observe(progress.elapsed(), writer="tar")
+                    logger.info("Upload stats %s", self.upload_stats)
+                    return text
+
+    async def read_chunks(self, file_handle, progress):
+        """ Read the tarfile a chunk at a time, off the event loop so a
+            tarfile which spilled to disk doesn't block other tasks
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(
+                None, file_handle.read, self.upload_chunk_size
+            )
+            if not chunk:
+                break
+            progress.update(len(chunk))
+            yield chunk
 
-                        return await response.text()
+    def open_archive(self):
+        """ Open the compressed tar file for reading """
+        if self.mode == self.STREAM_MODE:
+            self.spool.seek(0)
+            return contextlib.nullcontext(self.spool)
+        return open(self.tgzfile, "rb")
 
     def initialize_ssl(self):
         """ Configure SSL for the current session """
@@ -112,10 +491,42 @@ class TarWriter:
         if not verify_ssl:
             self.ssl_context.verify_mode = ssl.CERT_NONE
 
-    def cleanup(self):
-        """ Clean the Temporary directory where we were collecting the files """
+    @property
+    def resumable(self):
+        """ True if the staged pages survive till the task has finished """
+        return self.journal is not None
+
+    async def cleanup(self):
+        """ Clean the Temporary directory where we were collecting the files,
+            off the event loop since it waits for the writer thread to stop
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.remove_files)
+
+    def remove_files(self):
+        """ Stop the writer thread and remove the files, the pages of an
+            unfinished journaled task are kept to resume it
+        """
+        if self.write_thread:
+            self.write_queue.put(self.STOP)
+            self.write_thread.join()
+            self.write_thread = None
+
+        if self.spool:
+           self.spool.close()
+
         if os.path.exists(self.tgzfile):
            os.remove(self.tgzfile)
 
+        if self.journal and not self.journal.finished:
+           return
+
         if os.path.exists(self.dirname):
            shutil.rmtree(self.dirname)
+
+
+def archive_size(file_handle):
+    """ Size of an open file, leaves it positioned at the start """
+    file_handle.seek(0, os.SEEK_END)
+    size = file_handle.tell()
+    file_handle.seek(0)
+    return size
@@ -1,18 +1,233 @@
 """ Tower API Worker, makes REST API calls to the Tower """
 import os
-import json
+import math
+import time
+import random
+import collections
 import logging
 import ssl
 import asyncio
+import datetime
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 from urllib.parse import parse_qsl
 from urllib.parse import urljoin
 from distutils.util import strtobool
 import aiohttp
-import jmespath
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client import tracing
+from catalog_mqtt_client.handlers import http_session
+from catalog_mqtt_client.handlers import job_monitor
+from catalog_mqtt_client.handlers import jmespath_cache
+from catalog_mqtt_client.handlers import json_codec
+from catalog_mqtt_client.handlers import stream_parser
 
 logger = logging.getLogger(__name__)
 
+SCHEDULERS = {}
+
+# A parsed page, filtered is set if apply_filter has already been applied
+# while streaming, size is the number of results Tower sent on the page
+# and raw the body Tower sent as bytes, None if it was streamed
+Page = collections.namedtuple("Page", ["body", "filtered", "size", "raw"])
+
+
+class RelatedObjects:
+    """ Per task record of the related objects which have been queued,
+        shared by all the workers of a task so every related URL is
+        fetched at most once
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.deduplicated = 0
+
+    def add(self, href_slug):
+        """ Remember the href_slug, False if it has already been queued """
+        if href_slug in self.seen:
+            self.deduplicated = self.deduplicated + 1
+            return False
+        self.seen.add(href_slug)
+        return True
+
+
+class RequestScheduler:
+    """ Central scheduler for the requests sent to a Tower. Requests are
+        rate limited with a token bucket, a 429 or a Retry-After pauses
+        every request to the Tower, GETs are retried with a jittered
+        exponential backoff on connection errors and 5xx responses while
+        POSTs are only retried on 429 and 503 where Tower didn't act on
+        them. After breaker_threshold consecutive failures the circuit
+        opens and requests fail fast till breaker_reset seconds have
+        passed, then a single trial request decides if it closes again
+    """
+
+    RETRY_STATUSES = [429, 500, 502, 503, 504]
+    POST_RETRY_STATUSES = [429, 503]
+    DEFAULT_RATE = 0.0
+    DEFAULT_BURST = 10
+    DEFAULT_RETRIES = 3
+    DEFAULT_BACKOFF = 0.5
+    DEFAULT_MAX_BACKOFF = 30.0
+    DEFAULT_BREAKER_THRESHOLD = 5
+    DEFAULT_BREAKER_RESET = 30.0
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, config):
+        self.url = config["ANSIBLE_TOWER"]["url"]
+        self.rate = config.getfloat("TOWER_REQUESTS", "rate", fallback=self.DEFAULT_RATE)
+        self.burst = config.getint("TOWER_REQUESTS", "burst", fallback=self.DEFAULT_BURST)
+        self.retries = config.getint(
+            "TOWER_REQUESTS", "retries", fallback=self.DEFAULT_RETRIES
+        )
+        self.backoff = config.getfloat(
+            "TOWER_REQUESTS", "backoff", fallback=self.DEFAULT_BACKOFF
+        )
+        self.max_backoff = config.getfloat(
+            "TOWER_REQUESTS", "max_backoff", fallback=self.DEFAULT_MAX_BACKOFF
+        )
+        self.breaker_threshold = config.getint(
+            "TOWER_REQUESTS", "breaker_threshold", fallback=self.DEFAULT_BREAKER_THRESHOLD
+        )
+        self.breaker_reset = config.getfloat(
+            "TOWER_REQUESTS", "breaker_reset", fallback=self.DEFAULT_BREAKER_RESET
+        )
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.retried = 0
+        self.throttled_time = 0.0
+        self.circuit_opened = 0
+
+    async def request(self, send, idempotent):
+        """ Send a request with the rate limit, retries and circuit breaker.
+            send is a coroutine function returning a response dict, the
+            last response is returned if it still failed after the retries
+        """
+        attempt = 0
+        while True:
+            trial = self.check_circuit()
+            try:
+                await self.throttle()
+                self.requests = self.requests + 1
+                try:
+                    response = await send()
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    self.record_failure()
+                    if not idempotent or attempt >= self.retries:
+                        raise
+                    delay = self.backoff_delay(attempt)
+                else:
+                    status = response["status"]
+                    if status not in self.RETRY_STATUSES:
+                        self.record_success()
+                        return response
+                    if status != 429:
+                        self.record_failure()
+                    retryable = idempotent or status in self.POST_RETRY_STATUSES
+                    if not retryable or attempt >= self.retries:
+                        return response
+                    retry_after = self.retry_after(response.get("headers") or {})
+                    delay = self.backoff_delay(attempt) if retry_after is None else retry_after
+                    if status == 429 or retry_after is not None:
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            finally:
+                if trial:
+                    self.trial_in_flight = False
+
+            logger.warning(
+                "Retrying Tower request in %.2fs, attempt %d", delay, attempt + 1
+            )
+            attempt = attempt + 1
+            self.retried = self.retried + 1
+            metrics.TOWER_RETRIES.inc(tower=self.url)
+            await asyncio.sleep(delay)
+
+    def check_circuit(self):
+        """ Fail fast while the circuit is open, True for the trial request """
+        if self.state == self.OPEN:
+            if time.monotonic() < self.opened_at + self.breaker_reset:
+                raise Exception(
+                    "Tower %s circuit open after %d failures" % (self.url, self.failures)
+                )
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.trial_in_flight:
+                raise Exception("Tower %s circuit half open, trial in flight" % self.url)
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        """ Tower answered, close the circuit """
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        """ Tower failed, open the circuit over the threshold """
+        self.failures = self.failures + 1
+        if self.state == self.HALF_OPEN or self.failures >= self.breaker_threshold:
+            if self.state != self.OPEN:
+                self.circuit_opened = self.circuit_opened + 1
+                logger.error("Tower %s circuit open", self.url)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    async def throttle(self):
+        """ Wait for a Retry-After pause and a token from the bucket """
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                delay = self.paused_until - now
+            elif not self.rate:
+                return
+            else:
+                self.tokens = min(
+                    float(self.burst), self.tokens + (now - self.refilled) * self.rate
+                )
+                self.refilled = now
+                if self.tokens >= 1.0:
+                    self.tokens = self.tokens - 1.0
+                    return
+                delay = (1.0 - self.tokens) / self.rate
+            self.throttled_time = self.throttled_time + delay
+            await asyncio.sleep(delay)
+
+    def backoff_delay(self, attempt):
+        """ Full jitter exponential backoff """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retry_after(self, headers):
+        """ Seconds to wait from a Retry-After header, None if missing """
+        value = headers.get("Retry-After", None)
+        if value is None:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0.0), self.max_backoff)
+
+    def stats(self):
+        """ Scheduler state reported with the worker pool stats """
+        return dict(
+            tower_requests=self.requests,
+            tower_retries=self.retried,
+            tower_throttled_seconds=round(self.throttled_time, 3),
+            tower_circuit=self.state,
+            tower_circuit_opened=self.circuit_opened,
+        )
+
 
 class TowerApiWorker:
     """ Tower API Worker, picks work items from a queue and dispatches API
@@ -22,34 +237,126 @@ class TowerApiWorker:
     VALID_POST_CODES = [200, 201, 202]
     JOB_COMPLETION_STATUSES = ["successful", "failed", "error", "canceled"]
     DEFAULT_REFRESH_INTERVAL = 10
+    DEFAULT_PREFETCH_WINDOW = 4
+    DELTA_ID_FILTER = "results[].id"
+    DELTA_PAGE_SIZE = 200
+    DEFAULT_MAX_TOWER_CONCURRENCY = 8
+    DEFAULT_STREAM_THRESHOLD = 1024 * 1024
+    STREAM_CHUNK_SIZE = 64 * 1024
     ARTIFACTS_KEY_PREFIX = "expose_to_cloud_redhat_com_"
     MAX_ARTIFACTS_SIZE = 1024
-
-    def __init__(self, config, writer, queue):
+    SHUTDOWN = None
+    RETIRED = "retired"
+
+    def __init__(
+        self,
+        config,
+        writer,
+        queue,
+        semaphore=None,
+        related=None,
+        cache=None,
+        monitor=None,
+        scheduler=None,
+        delta=None,
+        journal=None,
+    ):
         self.writer = writer
         self.queue = queue
         self.config = config
+        self.journal = journal
+        self.related = related or RelatedObjects()
+        self.cache = cache
+        self.delta = delta
+        self.scheduler = scheduler or RequestScheduler(config)
+        self.own_monitor = monitor is None
+        self.monitor = monitor or job_monitor.JobMonitor(config, queue)
+        self.semaphore = semaphore or asyncio.Semaphore(
+            self.DEFAULT_MAX_TOWER_CONCURRENCY
+        )
+        self.jobs_done = 0
+        self.busy_time = 0.0
+        self.headers = self.auth_headers()
+        self.stream_threshold = config.getint(
+            "ANSIBLE_TOWER", "stream_threshold_bytes", fallback=self.DEFAULT_STREAM_THRESHOLD
+        )
         self.initialize_ssl()
 
-    async def start(self):
+    async def start(self, may_retire=None, idle_timeout=None):
         """ Make the API request based on the specified method
             It picks up one request at a time from the Queue. There
-            could be multiple workers reading from the same queue
+            could be multiple workers reading from the same queue.
+            The worker keeps going till the queue has been joined, i.e.
+            every job including the follow up jobs added by other workers
+            and the jobs being monitored is done. Each worker then queues
+            one shutdown sentinel and stops once it picks up a sentinel
         """
-        async with aiohttp.ClientSession(headers=self.auth_headers()) as session:
-            while not self.queue.empty():
-                job = await self.queue.get()
-                logger.debug(job["method"] + ":" + job["href_slug"])
-                if job["method"] == "get":
-                    await self.get(session, job["href_slug"], job)
-                elif job["method"] == "post":
-                    await self.post(session, job["href_slug"], job)
-                elif job["method"] == "launch":
-                    await self.launch(session, job["href_slug"], job)
-                elif job["method"] == "monitor":
-                    await self.monitor(session, job["href_slug"], job)
-                else:
-                    raise Exception(f"Invalid method {job['method']}")
+        runner = asyncio.create_task(self.run(may_retire, idle_timeout))
+        joined = asyncio.create_task(self.queue.join())
+        try:
+            await asyncio.wait([runner, joined], return_when=asyncio.FIRST_COMPLETED)
+            if runner.done() and runner.result() == self.RETIRED:
+                return self.RETIRED
+            self.queue.put_nowait(self.SHUTDOWN)
+            result = await runner
+            self.monitor.check()
+            return result
+        finally:
+            joined.cancel()
+            runner.cancel()
+            if self.own_monitor:
+                await self.monitor.cancel()
+
+    async def run(self, may_retire=None, idle_timeout=None):
+        """ Process jobs till a shutdown sentinel is received. If the queue
+            stays empty for idle_timeout seconds the worker asks may_retire
+            if it can stop early
+        """
+        session = http_session.get_session(self.config)
+        while True:
+            try:
+                job = await asyncio.wait_for(self.queue.get(), idle_timeout)
+            except asyncio.TimeoutError:
+                if may_retire and may_retire():
+                    return self.RETIRED
+                continue
+
+            if job is self.SHUTDOWN:
+                self.queue.task_done()
+                return self.SHUTDOWN
+
+            handed_off = False
+            started = time.monotonic()
+            try:
+                if self.journal:
+                    self.journal.job_started(job)
+                handed_off = await self.process(session, job)
+                if self.journal and not handed_off:
+                    self.journal.job_done(job)
+            finally:
+                self.busy_time = self.busy_time + (time.monotonic() - started)
+                if not handed_off:
+                    self.queue.task_done()
+            self.jobs_done = self.jobs_done + 1
+
+    async def process(self, session, job):
+        """ Dispatch a single job to the method handling it. Returns True
+            if the job was handed to the monitor, which marks it done
+        """
+        logger.debug(job["method"] + ":" + job["href_slug"])
+        with tracing.span("job." + job["method"], href_slug=job["href_slug"]):
+            if job["method"] == "get":
+                await self.get(session, job["href_slug"], job)
+            elif job["method"] == "post":
+                await self.post(session, job["href_slug"], job)
+            elif job["method"] == "launch":
+                await self.launch(session, job["href_slug"], job)
+            elif job["method"] == "monitor":
+                self.monitor.track(self, job["href_slug"], job)
+                return True
+            else:
+                raise Exception(f"Invalid method {job['method']}")
+        return False
 
     async def get(self, session, href_slug, job):
         """ Send an HTTP Get request to the Ansible Tower API
@@ -59,74 +366,248 @@ class TowerApiWorker:
          """
         url_info = urlparse(href_slug)
         params = dict(parse_qsl(url_info.query))
+        page_prefix = job.get("page_prefix", "page")
+        first_page = int(params.get("page", 1))
+
+        if self.delta and job.get("delta", False) and job.get("fetch_all_pages", False):
+            await self.start_delta(session, url_info.path, params)
+
+        page = await self.fetch_page(session, url_info.path, params, href_slug, job)
+        has_next = isinstance(page.body, dict) and bool(page.body.get("next", None))
+        last_page = self.last_page_number(page, first_page)
+        page_name = os.path.join(url_info.path, page_prefix + "1")
+        await self.send_response(page.body, page_name, job, page.filtered, page.raw)
+
+        if not job.get("fetch_all_pages", False):
+            return
+
+        page_number = first_page
+        if has_next and last_page:
+            pages = range(first_page + 1, last_page + 1)
+            has_next = await self.prefetch_pages(
+                session, url_info.path, params, pages, job
+            )
+            page_number = last_page
+
+        # Follow the next links for anything added after the first page
+        # was counted or when Tower didn't give us a count
+        while has_next:
+            page_number = page_number + 1
+            params["page"] = page_number
+            page = await self.fetch_page(session, url_info.path, params, href_slug, job)
+            has_next = bool(page.body.get("next", None))
+            page_name = os.path.join(
+                url_info.path, page_prefix + str(page_number - first_page + 1)
+            )
+            await self.send_response(
+                page.body, page_name, job, page.filtered, page.raw
+            )
+
+    async def start_delta(self, session, path, params):
+        """ Collect only the objects modified since the last successful
+            sync of the list. The ids of the whole list are read first,
+            the Tower's time of that read is the next watermark, and the
+            ids which have disappeared are written as a tombstone manifest.
+            params is changed to only ask for the modified objects
+        """
+        key = self.delta.state.key(self.config["ANSIBLE_TOWER"]["url"], path, params)
+        previous = self.delta.previous(key)
+        ids, watermark = await self.list_ids(session, path, params)
+
+        deleted = []
+        if previous:
+            params["modified__gt"] = previous["watermark"]
+            deleted = sorted(set(previous["ids"]) - ids)
+            tombstones = json_codec.dumps(
+                {
+                    "href_slug": path,
+                    "since": previous["watermark"],
+                    "watermark": watermark,
+                    "deleted": deleted,
+                }
+            )
+            await self.writer.write(
+                tombstones, os.path.join(path, "tombstones"), size=len(tombstones)
+            )
+        self.delta.record(key, watermark, ids, len(deleted))
+        logger.debug(
+            "Delta sync of %s since %s, %d deleted",
+            path,
+            previous["watermark"] if previous else "never",
+            len(deleted),
+        )
+
+    async def list_ids(self, session, path, params):
+        """ The ids of every object in a list and the Tower's time when
+            the first page was read, as an ISO timestamp. Large pages are
+            reduced to their ids while streaming
+        """
+        item_filter = stream_parser.results_item_filter(self.DELTA_ID_FILTER)
+        list_params = {
+            name: value
+            for name, value in params.items()
+            if name not in ("page", "modified__gt")
+        }
+        list_params.update(page_size=self.DELTA_PAGE_SIZE, order_by="id")
+        ids = set()
+        watermark = None
         page_number = 1
         while True:
-            response = await self.get_page(session, url_info.path, params)
+            response = await self.get_page(
+                session, path, dict(list_params, page=page_number), item_filter=item_filter
+            )
             if response["status"] != 200:
                 raise Exception(
                     "Get failed %s status %s body %s"
-                    % (href_slug, response["status"], response.get("body", "empty"))
+                    % (path, response["status"], self.body_text(response))
                 )
-
-            json_body = json.loads(response["body"])
-            page_prefix = job.get("page_prefix", "page")
-
-            page_name = os.path.join(url_info.path, page_prefix + str(page_number))
-            await self.send_response(json_body, page_name, job)
-
-            if job.get("fetch_all_pages", False):
-                page_number = page_number + 1
-                if json_body.get("next", None):
-                    params["page"] = params.get("page", 1) + 1
-                else:
-                    break
+            if watermark is None:
+                watermark = tower_time(response["headers"])
+            if "json" in response:
+                body = response["json"]
+            else:
+                body = filter_body(
+                    self.DELTA_ID_FILTER, json_codec.loads(response["body"])
+                )
+            ids.update(body["results"])
+            if not body.get("next", None):
+                return ids, watermark
+            page_number = page_number + 1
+
+    async def prefetch_pages(self, session, path, params, pages, job):
+        """ Fetch the remaining pages concurrently, keeping at most
+            page_prefetch_window requests in flight. The pages are sent
+            to the writer in their original order and naming. Pages a
+            resumed task has already staged aren't fetched again, except
+            the last one which tells if there are more pages. Returns
+            True if the last page still points to a next page
+        """
+        window = self.config.getint(
+            "WORKER_POOL", "page_prefetch_window", fallback=self.DEFAULT_PREFETCH_WINDOW
+        )
+        page_prefix = job.get("page_prefix", "page")
+        first_page = pages.start - 1
+        pending = collections.deque()
+        remaining = iter(pages)
+
+        def page_name(page_number):
+            return os.path.join(path, page_prefix + str(page_number - first_page + 1))
+
+        def schedule():
+            page = next(remaining, None)
+            if page is None:
+                return
+            if (
+                self.journal
+                and page != pages[-1]
+                and page_name(page) in self.journal.staged
+            ):
+                pending.append((page, None))
             else:
-                break
+                page_params = dict(params, page=page)
+                task = asyncio.create_task(
+                    self.fetch_page(session, path, page_params, path, job)
+                )
+                pending.append((page, task))
+
+        has_next = False
+        try:
+            for _ in range(max(1, window)):
+                schedule()
+            while pending:
+                page_number, task = pending.popleft()
+                if task is None:
+                    logger.debug("Skipping staged %s", page_name(page_number))
+                    schedule()
+                    continue
+                page = await task
+                schedule()
+                has_next = bool(page.body.get("next", None))
+                await self.send_response(
+                    page.body, page_name(page_number), job, page.filtered, page.raw
+                )
+        finally:
+            for _, task in pending:
+                if task:
+                    task.cancel()
+        return has_next
+
+    async def fetch_page(self, session, path, params, href_slug, job):
+        """ Get a single page and parse it, raise if the Get failed.
+            Large pages whose apply_filter only projects the results
+            are parsed and filtered while streaming
+        """
+        item_filter = stream_parser.results_item_filter(job.get("apply_filter", None))
+        response = await self.get_page(
+            session, path, params, use_cache=True, item_filter=item_filter, method="get"
+        )
+        if response["status"] != 200:
+            raise Exception(
+                "Get failed %s status %s body %s"
+                % (href_slug, response["status"], self.body_text(response))
+            )
+        if "json" in response:
+            return Page(response["json"], True, response["item_count"], None)
+
+        json_body = json_codec.loads(response["body"])
+        results = json_body.get("results", None) if isinstance(json_body, dict) else None
+        return Page(
+            json_body,
+            False,
+            len(results) if isinstance(results, list) else 0,
+            response["body"],
+        )
+
+    @staticmethod
+    def last_page_number(page, first_page):
+        """ Work out the last page from the count and the size of the
+            first page, None if the response doesn't tell us
+        """
+        if not isinstance(page.body, dict):
+            return None
+        count = page.body.get("count", None)
+        if not isinstance(count, int) or not page.size:
+            return None
+        return first_page - 1 + math.ceil(
+            max(0, count - (first_page - 1) * page.size) / page.size
+        )
 
     async def post(self, session, href_slug, job):
         """ Post the data to the Ansible Tower """
         url = urljoin(self.config["ANSIBLE_TOWER"]["url"], href_slug)
-        async with session.post(
-            url, json=job["params"], ssl=self.ssl_context
-        ) as post_response:
-            response = dict(
-                status=post_response.status, body=await post_response.text()
-            )
+        response = await self.post_page(session, url, job["params"])
 
-            if response["status"] not in self.VALID_POST_CODES:
-                raise Exception(
-                    "Post failed %s status %s body %s"
-                    % (url, response["status"], response.get("body", "empty"))
-                )
+        if response["status"] not in self.VALID_POST_CODES:
+            raise Exception(
+                "Post failed %s status %s body %s"
+                % (url, response["status"], self.body_text(response))
+            )
 
-            await self.send_response(json.loads(response["body"]), url, job)
+        await self.send_response(
+            json_codec.loads(response["body"]), url, job, raw=response["body"]
+        )
 
     async def launch(self, session, href_slug, job):
         """ Post the data to the Ansible Tower and then monitor for completion """
         url = urljoin(self.config["ANSIBLE_TOWER"]["url"], href_slug)
-        async with session.post(
-            url, json=job["params"], ssl=self.ssl_context
-        ) as post_response:
-            response = dict(
-                status=post_response.status, body=await post_response.text()
-            )
+        response = await self.post_page(session, url, job["params"], method="launch")
 
-            if response["status"] not in self.VALID_POST_CODES:
-                raise Exception(
-                    "Post failed %s status %s body %s"
-                    % (url, response["status"], response.get("body", "empty"))
-                )
-            json_body = json.loads(response["body"])
-            await self.send_response(json_body, url, job)
-            new_job = {
-                "href_slug": json_body["url"],
-                "method": "monitor",
-                "apply_filter": job["apply_filter"],
-                "refresh_interval_seconds": job.get(
-                    "refresh_interval_seconds", self.DEFAULT_REFRESH_INTERVAL
-                ),
-            }
-            await self.queue.put(new_job)
+        if response["status"] not in self.VALID_POST_CODES:
+            raise Exception(
+                "Post failed %s status %s body %s"
+                % (url, response["status"], self.body_text(response))
+            )
+        json_body = json_codec.loads(response["body"])
+        await self.send_response(json_body, url, job, raw=response["body"])
+        new_job = {
+            "href_slug": json_body["url"],
+            "method": "monitor",
+            "apply_filter": job["apply_filter"],
+            "refresh_interval_seconds": job.get(
+                "refresh_interval_seconds", self.DEFAULT_REFRESH_INTERVAL
+            ),
+        }
+        await self.queue.put(new_job)
 
     async def add_related(self, json_body, job):
         """ Add related objects to the work queue so we can fetch them """
@@ -143,7 +624,8 @@ class TowerApiWorker:
             and adding it to the work queue. A good example of this is
             the survey_spec which is optional for job_template and worklow_job_templates
             If the survey_enabled is true (the predicate) we will add the URL to the
-            queue so we can retrieve it
+            queue so we can retrieve it. Objects shared by many results,
+            like a common survey spec or inventory, are only queued once
         """
         for rel in related:
             key = rel["predicate"]
@@ -151,26 +633,169 @@ class TowerApiWorker:
             logger.debug(obj)
             if obj.get(key, None):
                 new_job = {"href_slug": obj[val][1:], "method": "get"}
+                if not self.related.add(new_job["href_slug"]):
+                    logger.debug("Skipping already queued %s", new_job["href_slug"])
+                    continue
                 logger.debug(new_job)
                 await self.queue.put(new_job)
 
-    async def get_page(self, session, href_slug, params):
-        """ Get a single page from the Tower API """
+    async def get_page(
+        self, session, href_slug, params, use_cache=False, item_filter=None, method="get"
+    ):
+        """ Get a single page from the Tower API. Read only GETs whose
+            href matches a cached prefix are served from the response cache.
+            method is the job method the request is counted against
+        """
+        ttl = self.cache.ttl_for(href_slug) if use_cache and self.cache else None
+        if not ttl:
+            return await self.request_page(
+                session, href_slug, params, item_filter=item_filter, method=method
+            )
+
+        key = self.cache.key(href_slug, params)
+        entry = self.cache.lookup(key)
+        if entry and entry.fresh():
+            return dict(status=200, body=entry.body)
+
+        validators = entry.validators() if entry else {}
+        response = await self.request_page(
+            session, href_slug, params, validators, method=method
+        )
+        if response["status"] == 304 and entry:
+            return dict(status=200, body=self.cache.refresh(key, entry, ttl).body)
+        if response["status"] == 200:
+            self.cache.store(key, response["body"], response["headers"], ttl)
+        return response
+
+    async def request_page(
+        self, session, href_slug, params, headers=None, item_filter=None, method="get"
+    ):
+        """ Send the Get request to the Tower API through the scheduler """
+        return await self.scheduler.request(
+            lambda: self.send_get(session, href_slug, params, headers, item_filter, method),
+            idempotent=True,
+        )
+
+    async def send_get(self, session, href_slug, params, headers, item_filter, method):
+        """ Send a single Get request. Responses larger than the stream
+            threshold are parsed from the byte stream with the item_filter
+            applied to each result
+        """
         url = urljoin(self.config["ANSIBLE_TOWER"]["url"], href_slug)
-        async with session.get(url, params=params, ssl=self.ssl_context) as response:
-            response_text = dict(status=response.status, body=await response.text())
-        return response_text
+        async with self.semaphore:
+            started = time.monotonic()
+            status = "error"
+            try:
+                async with session.get(
+                    url,
+                    params=params,
+                    headers=dict(self.headers, **(headers or {})),
+                    ssl=self.ssl_context,
+                ) as response:
+                    status = response.status
+                    if item_filter and response.status == 200:
+                        return await self.read_page(response, item_filter)
+
+                    return dict(
+                        status=response.status,
+                        body=await response.read(),
+                        headers=response.headers,
+                    )
+            finally:
+                record_request(method, started, status, href_slug)
+
+    async def read_page(self, response, item_filter):
+        """ Read a page which can be filtered while streaming. Chunked and
+            compressed responses have no Content-Length, so they are
+            buffered till more than stream_threshold bytes arrive and the
+            rest is fed to the streaming parser
+        """
+        parser = None
+        if (
+            response.content_length is not None
+            and response.content_length > self.stream_threshold
+        ):
+            parser = stream_parser.StreamingPageParser(item_filter)
+        elif response.content_length is not None:
+            return dict(
+                status=response.status,
+                body=await response.read(),
+                headers=response.headers,
+            )
+
+        buffered = []
+        size = 0
+        async for chunk in response.content.iter_chunked(self.STREAM_CHUNK_SIZE):
+            if parser is not None:
+                parser.feed(chunk)
+                continue
+            buffered.append(chunk)
+            size = size + len(chunk)
+            if size > self.stream_threshold:
+                parser = stream_parser.StreamingPageParser(item_filter)
+                for data in buffered:
+                    parser.feed(data)
+                buffered = []
+
+        if parser is not None:
+            return dict(
+                status=response.status,
+                json=parser.close(),
+                item_count=parser.item_count,
+                headers=response.headers,
+            )
+        return dict(
+            status=response.status,
+            body=b"".join(buffered),
+            headers=response.headers,
+        )
+
+    async def post_page(self, session, url, data, method="post"):
+        """ Post data to the Tower API through the scheduler """
+        return await self.scheduler.request(
+            lambda: self.send_post(session, url, data, method), idempotent=False
+        )
+
+    async def send_post(self, session, url, data, method):
+        """ Send a single Post request and read the response """
+        async with self.semaphore:
+            started = time.monotonic()
+            status = "error"
+            try:
+                async with session.post(
+                    url, json=data, headers=self.headers, ssl=self.ssl_context
+                ) as response:
+                    status = response.status
+                    return dict(
+                        status=response.status,
+                        body=await response.read(),
+                        headers=response.headers,
+                    )
+            finally:
+                record_request(method, started, status, url)
+
+    @staticmethod
+    def body_text(response):
+        """ The body of a response as text for an error message """
+        body = response.get("body", None)
+        if body is None:
+            return "empty"
+        return body.decode("utf-8", "replace")
 
     def filter_artifacts(self, json_body):
         """ To prevent exposure of all attributes in the artifacts from the
-            job, we only expose ones with a specific prefix
+            job, we only expose ones with a specific prefix. The size is
+            counted without encoding the artifacts and stops at the limit
         """
         artifacts = {}
         for key in json_body["artifacts"]:
             if key.startswith(self.ARTIFACTS_KEY_PREFIX):
                 artifacts[key] = json_body["artifacts"][key]
 
-        if len(json.dumps(artifacts)) > self.MAX_ARTIFACTS_SIZE:
+        if (
+            json_codec.encoded_size(artifacts, self.MAX_ARTIFACTS_SIZE)
+            > self.MAX_ARTIFACTS_SIZE
+        ):
             raise Exception(f"Artifacts is over {self.MAX_ARTIFACTS_SIZE} bytes")
 
         json_body["artifacts"] = artifacts
@@ -182,43 +807,27 @@ class TowerApiWorker:
         headers["Authorization"] = "Bearer " + self.config["ANSIBLE_TOWER"]["token"]
         return headers
 
-    async def monitor(self, session, url, job):
-        """ Monitor a Ansible Tower Job """
-        url_info = urlparse(url)
-        params = dict(parse_qsl(url_info.query))
-        while True:
-            response = await self.get_page(session, url_info.path, params)
-            if response["status"] != 200:
-                raise Exception(
-                    "GET failed %s status %s body %s"
-                    % (url, response["status"], response.get("body", "empty"))
-                )
-
-            json_body = json.loads(response["body"])
-            if json_body["status"] not in self.JOB_COMPLETION_STATUSES:
-                await asyncio.sleep(
-                    job.get("refresh_interval_seconds", self.DEFAULT_REFRESH_INTERVAL)
-                )
-                continue
-
-            await self.send_response(json_body, url, job)
-            break
-
-    async def send_response(self, json_body, name, job):
+    async def send_response(self, json_body, name, job, filtered=False, raw=None):
         """ Send the response to the writer, which would send it
             via the appropriate route (upload to ingress service)
-            or directly update the task result
+            or directly update the task result. The writer gets the
+            page as JSON bytes, raw is the body Tower sent which is
+            handed over as is unless a filter changes the body
         """
-        if "apply_filter" in job:
-            json_body = filter_body(job["apply_filter"], json_body)
+        if "apply_filter" in job and not filtered:
+            with tracing.span("jmespath.filter"):
+                json_body = filter_body(job["apply_filter"], json_body)
+            raw = None
 
         if isinstance(json_body, dict) and isinstance(
             json_body.get("artifacts", None), dict
         ):
             json_body = self.filter_artifacts(json_body)
+            raw = None
 
         await self.add_related(json_body, job)
-        await self.writer.write(json.dumps(json_body), name)
+        page = raw if raw is not None else json_codec.dumps(json_body)
+        await self.writer.write(page, name, size=len(page))
 
     def initialize_ssl(self):
         """ Configure SSL for the current session """
@@ -235,13 +844,63 @@ class TowerApiWorker:
 
 # Local Function to apply JMES Path Filter
 def filter_body(apply_filters, json_body):
-    """ Apply JMESPath filters to the json body"""
+    """ Apply JMESPath filters to the json body, the compiled expressions
+        are cached so they aren't parsed again for every page
+    """
     if isinstance(apply_filters, dict):
         new_data = {}
         for key, jmes_filter in apply_filters.items():
-            new_data[key] = jmespath.search(jmes_filter, json_body)
+            new_data[key] = jmespath_cache.compile_expression(jmes_filter).search(
+                json_body
+            )
         json_body = new_data
     elif isinstance(apply_filters, str):
-        json_body["results"] = jmespath.search(apply_filters, json_body)
+        json_body["results"] = jmespath_cache.compile_expression(
+            apply_filters
+        ).search(json_body)
 
     return json_body
+
+
+def tower_time(headers):
+    """ The Tower's clock from the Date header of a response, the local
+        clock if there isn't one
+    """
+    date = headers.get("Date", None)
+    try:
+        moment = parsedate_to_datetime(date) if date else None
+    except (TypeError, ValueError):
+        moment = None
+    if moment is None:
+        moment = datetime.datetime.now(datetime.timezone.utc)
+    return moment.isoformat()
+
+
+def record_request(method, started, status, href_slug):
+    """ Tower request metrics and trace span, status is error if no
+        response came back
+    """
+    elapsed = time.monotonic() - started
+    metrics.TOWER_REQUEST_DURATION.observe(elapsed, method=method)
+    metrics.TOWER_RESPONSES.inc(method=method, status=status)
+    tracing.record("tower." + method, elapsed, href_slug=href_slug, status=status)
+
+
+metrics.TOWER_CIRCUIT_OPEN.set_function(
+    lambda: [
+        ({"tower": tower}, scheduler.state == RequestScheduler.OPEN)
+        for (_, tower), scheduler in list(SCHEDULERS.items())
+    ]
+)
+
+
+def request_scheduler(config):
+    """ The scheduler shared by every worker talking to the same Tower """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in SCHEDULERS if key[0].is_closed()]:
+        del SCHEDULERS[key]
+
+    key = (loop, config["ANSIBLE_TOWER"]["url"])
+    if key not in SCHEDULERS:
+        SCHEDULERS[key] = RequestScheduler(config)
+    return SCHEDULERS[key]
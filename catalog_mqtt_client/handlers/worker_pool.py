@@ -0,0 +1,223 @@
+""" Worker Pool, runs a variable number of TowerApiWorkers against a work queue """
+import time
+import weakref
+import asyncio
+import logging
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client.handlers import tower_api_worker
+from catalog_mqtt_client.handlers import response_cache
+from catalog_mqtt_client.handlers import delta_state
+from catalog_mqtt_client.handlers import job_monitor
+
+logger = logging.getLogger(__name__)
+
+TOWER_SEMAPHORES = {}
+POOLS = weakref.WeakSet()
+
+
+class TimedQueue(asyncio.Queue):
+    """ Work Queue which keeps track of how long jobs wait to be picked up """
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _put(self, item):
+        super()._put((time.monotonic(), item))
+
+    def _get(self):
+        put_time, item = super()._get()
+        waited = time.monotonic() - put_time
+        self.wait_time = self.wait_time + waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return item
+
+
+class JournaledQueue(TimedQueue):
+    """ Work Queue which records every job in the task's journal, including
+        the follow up jobs the workers add, so an interrupted task knows
+        which jobs are left
+    """
+
+    def __init__(self, journal, maxsize=0):
+        self.journal = journal
+        super().__init__(maxsize)
+
+    def _put(self, item):
+        if isinstance(item, dict) and "journal_id" not in item:
+            item["journal_id"] = self.journal.add_job(item)
+        super()._put(item)
+
+
+class WorkerPool:
+    """ Scales TowerApiWorkers between a minimum and maximum count. All
+        workers talking to the same Tower share a concurrency ceiling
+    """
+
+    DEFAULT_MIN_WORKERS = 1
+    DEFAULT_MAX_WORKERS = 8
+    DEFAULT_MAX_TOWER_CONCURRENCY = (
+        tower_api_worker.TowerApiWorker.DEFAULT_MAX_TOWER_CONCURRENCY
+    )
+    DEFAULT_IDLE_TIMEOUT = 1.0
+    SCALE_INTERVAL = 0.1
+
+    def __init__(self, config, writer, queue, journal=None):
+        self.config = config
+        self.writer = writer
+        self.queue = queue
+        self.journal = journal
+        self.min_workers = config.getint(
+            "WORKER_POOL", "min_workers", fallback=self.DEFAULT_MIN_WORKERS
+        )
+        self.max_workers = max(
+            self.min_workers,
+            config.getint("WORKER_POOL", "max_workers", fallback=self.DEFAULT_MAX_WORKERS),
+        )
+        self.idle_timeout = config.getfloat(
+            "WORKER_POOL", "idle_timeout", fallback=self.DEFAULT_IDLE_TIMEOUT
+        )
+        self.semaphore = tower_semaphore(config)
+        self.scheduler = tower_api_worker.request_scheduler(config)
+        self.related = tower_api_worker.RelatedObjects()
+        self.cache = response_cache.get_cache(config)
+        state = delta_state.get_state(config)
+        self.delta = delta_state.DeltaSync(state) if state else None
+        self.monitor = job_monitor.JobMonitor(config, queue)
+        self.tasks = {}
+        POOLS.add(self)
+        self.retiring = 0
+        self.workers_started = 0
+        self.peak_workers = 0
+        self.jobs_done = 0
+        self.busy_time = 0.0
+        self.worker_time = 0.0
+        self.elapsed = 0.0
+
+    async def run(self):
+        """ Run the workers till the queue has been drained. The pool
+            starts sized from the job list, grows while the queue backs up
+            and shrinks as workers go idle
+        """
+        started = time.monotonic()
+        try:
+            self.spawn(self.initial_size())
+            while self.tasks:
+                done, _ = await asyncio.wait(
+                    list(self.tasks),
+                    timeout=self.SCALE_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    self.retire(task)
+                self.scale()
+        except BaseException:
+            await self.cancel()
+            raise
+        finally:
+            self.elapsed = time.monotonic() - started
+            logger.info("Worker pool stats %s", self.stats())
+
+    def initial_size(self):
+        """ Start with one worker per queued job within the limits """
+        return min(self.max_workers, max(self.min_workers, self.queue.qsize()))
+
+    def scale(self):
+        """ Add workers while there are more queued jobs than workers """
+        backlog = self.queue.qsize() - len(self.tasks)
+        if self.tasks and backlog > 0 and len(self.tasks) < self.max_workers:
+            self.spawn(min(backlog, self.max_workers - len(self.tasks)))
+
+    def spawn(self, count):
+        """ Start count new workers, they share the JobMonitor which
+            follows the launched jobs and the task journal, if any
+        """
+        for _ in range(count):
+            worker = tower_api_worker.TowerApiWorker(
+                self.config,
+                self.writer,
+                self.queue,
+                self.semaphore,
+                self.related,
+                self.cache,
+                self.monitor,
+                self.scheduler,
+                self.delta,
+                self.journal,
+            )
+            task = asyncio.create_task(
+                worker.start(self.may_retire, self.idle_timeout)
+            )
+            self.tasks[task] = (worker, time.monotonic())
+            self.workers_started = self.workers_started + 1
+        self.peak_workers = max(self.peak_workers, len(self.tasks))
+        logger.debug("Worker pool size %d", len(self.tasks))
+
+    def may_retire(self):
+        """ Let an idle worker stop as long as we stay above the minimum """
+        if len(self.tasks) - self.retiring > self.min_workers:
+            self.retiring = self.retiring + 1
+            return True
+        return False
+
+    def retire(self, task):
+        """ Account for a worker which has stopped, raise its exception if any """
+        worker, started = self.tasks.pop(task)
+        self.worker_time = self.worker_time + (time.monotonic() - started)
+        self.jobs_done = self.jobs_done + worker.jobs_done
+        self.busy_time = self.busy_time + worker.busy_time
+        if task.result() == worker.RETIRED:
+            self.retiring = self.retiring - 1
+
+    async def cancel(self):
+        """ Stop all the running workers """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = {}
+        await self.monitor.cancel()
+
+    def stats(self):
+        """ Per run statistics used to size the pool """
+        wait_time = getattr(self.queue, "wait_time", 0.0)
+        return dict(
+            jobs_done=self.jobs_done,
+            workers_started=self.workers_started,
+            peak_workers=self.peak_workers,
+            elapsed_seconds=round(self.elapsed, 3),
+            queue_wait_seconds=round(wait_time, 3),
+            avg_queue_wait_seconds=round(wait_time / self.jobs_done, 3)
+            if self.jobs_done
+            else 0.0,
+            max_queue_wait_seconds=round(getattr(self.queue, "max_wait_time", 0.0), 3),
+            worker_utilisation=round(self.busy_time / self.worker_time, 3)
+            if self.worker_time
+            else 0.0,
+            related_deduplicated=self.related.deduplicated,
+            **(self.delta.stats() if self.delta else {}),
+            **self.monitor.stats(),
+            **self.scheduler.stats(),
+        )
+
+
+metrics.QUEUE_DEPTH.set_function(lambda: sum(pool.queue.qsize() for pool in list(POOLS)))
+metrics.ACTIVE_WORKERS.set_function(lambda: sum(len(pool.tasks) for pool in list(POOLS)))
+
+
+def tower_semaphore(config):
+    """ A concurrency ceiling shared by every pool talking to the same Tower """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in TOWER_SEMAPHORES if key[0].is_closed()]:
+        del TOWER_SEMAPHORES[key]
+
+    key = (loop, config["ANSIBLE_TOWER"]["url"])
+    if key not in TOWER_SEMAPHORES:
+        TOWER_SEMAPHORES[key] = asyncio.Semaphore(
+            config.getint(
+                "WORKER_POOL",
+                "max_tower_concurrency",
+                fallback=WorkerPool.DEFAULT_MAX_TOWER_CONCURRENCY,
+            )
+        )
+    return TOWER_SEMAPHORES[key]
@@ -0,0 +1,297 @@
+""" Metrics, counters, gauges and histograms kept in process and exposed
+    in the Prometheus text format on an opt in local HTTP endpoint.
+    Metrics can be updated from any thread, gauges can also be computed
+    from a function when the endpoint is scraped
+"""
+import math
+import logging
+import threading
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9090
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """ A named metric with a value per combination of label values """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """ The label values in the declared order """
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key, extra=None):
+        """ Labels in the exposition format """
+        pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = (
+            '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def samples(self):
+        """ (suffix, labels, value) for every sample of the metric """
+        with self.lock:
+            return [("", self.format_labels(key), value) for key, value in self.values.items()]
+
+    def expose(self):
+        """ The metric in the Prometheus text format """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """ A value which only goes up """
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        """ Add amount to the counter """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """ Current value """
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """ A value which goes up and down, or is computed by a function
+        returning a number, or a list of (labels, number) when labelled
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        """ Set the gauge """
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        """ Add amount to the gauge """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """ Subtract amount from the gauge """
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """ Compute the gauge when it is scraped """
+        self.function = function
+
+    def value(self, **labels):
+        """ Current value """
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        if not self.labels:
+            return [("", "", value)]
+        return [("", self.format_labels(self.key(labels)), number) for labels, number in value]
+
+
+class Histogram(Metric):
+    """ Counts observations in cumulative buckets """
+
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        """ Record an observation """
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] = counts[index] + 1
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        """ Number of observations """
+        counts, _ = self.values.get(self.key(labels), ([0], 0.0))
+        return counts[-1]
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append(
+                    ("_bucket", self.format_labels(key, {"le": format_value(bound)}), count)
+                )
+            samples.append(("_sum", self.format_labels(key), total))
+            samples.append(("_count", self.format_labels(key), counts[-1]))
+        return samples
+
+
+class Registry:
+    """ The metrics exposed by the endpoint """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """ Add a metric """
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """ Every metric in the Prometheus text format """
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
+
+
+def format_value(value):
+    """ Numbers as Prometheus expects them """
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+REGISTRY = Registry()
+
+MESSAGES_RECEIVED = REGISTRY.register(
+    Counter("catalog_mqtt_messages_received_total", "MQTT messages received")
+)
+MESSAGE_DURATION = REGISTRY.register(
+    Histogram(
+        "catalog_mqtt_message_duration_seconds",
+        "Time from receiving an MQTT message till its catalog task is finished",
+        ["status"],
+        buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+    )
+)
+TOWER_REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "catalog_tower_request_duration_seconds",
+        "Latency of the requests sent to the Tower",
+        ["method"],
+    )
+)
+TOWER_RESPONSES = REGISTRY.register(
+    Counter(
+        "catalog_tower_responses_total",
+        "Responses from the Tower by method and status code",
+        ["method", "status"],
+    )
+)
+WRITER_BYTES_WRITTEN = REGISTRY.register(
+    Counter(
+        "catalog_writer_bytes_written_total", "Page bytes handed to the writers", ["writer"]
+    )
+)
+WRITER_BYTES_UPLOADED = REGISTRY.register(
+    Counter(
+        "catalog_writer_bytes_uploaded_total",
+        "Bytes sent to cloud.redhat.com by the writers",
+        ["writer"],
+    )
+)
+WRITER_UPLOAD_DURATION = REGISTRY.register(
+    Histogram(
+        "catalog_writer_upload_duration_seconds",
+        "Time taken by the successful upload of a tar file",
+        ["writer"],
+    )
+)
+WRITER_UPLOAD_PROGRESS = REGISTRY.register(
+    Counter(
+        "catalog_writer_upload_progress_bytes_total",
+        "Bytes of tar files sent so far by every upload attempt, including failed ones",
+        ["writer"],
+    )
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge("catalog_work_queue_depth", "Jobs waiting in the work queues of all tasks")
+)
+ACTIVE_WORKERS = REGISTRY.register(
+    Gauge("catalog_active_workers", "Tower API workers running for all tasks")
+)
+TASKS_IN_FLIGHT = REGISTRY.register(
+    Gauge("catalog_tasks_in_flight", "Catalog tasks being processed")
+)
+TASKS_BACKLOG = REGISTRY.register(
+    Gauge("catalog_tasks_backlog", "MQTT messages waiting to be processed")
+)
+BUFFERED_BYTES = REGISTRY.register(
+    Gauge("catalog_pipeline_buffered_bytes", "Page bytes buffered between workers and writers")
+)
+BUFFERED_BYTES_HIGH_WATER = REGISTRY.register(
+    Gauge(
+        "catalog_pipeline_buffered_bytes_high_water",
+        "Most page bytes buffered between workers and writers",
+    )
+)
+TOWER_CIRCUIT_OPEN = REGISTRY.register(
+    Gauge("catalog_tower_circuit_open", "1 while requests to the Tower fail fast", ["tower"])
+)
+TOWER_RETRIES = REGISTRY.register(
+    Counter("catalog_tower_retries_total", "Requests to the Tower which were retried", ["tower"])
+)
+RESPONSE_CACHE = REGISTRY.register(
+    Gauge(
+        "catalog_response_cache",
+        "Entries, bytes, hits, misses, revalidations and evictions of the Tower response cache",
+        ["stat"],
+    )
+)
+
+
+async def handle_metrics(_request):
+    """ Serve the metrics """
+    return web.Response(
+        body=REGISTRY.expose().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE}
+    )
+
+
+async def start_server(config):
+    """ Start the metrics endpoint if enabled in the config, returns the runner """
+    if not config.getboolean("METRICS", "enabled", fallback=False):
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(
+        runner,
+        config.get("METRICS", "host", fallback=DEFAULT_HOST),
+        config.getint("METRICS", "port", fallback=DEFAULT_PORT),
+    )
+    await site.start()
+    logger.info("Serving metrics on %s", runner.addresses)
+    return runner
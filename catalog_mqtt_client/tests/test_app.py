@@ -0,0 +1,26 @@
+""" App Tests """
+import asyncio
+import os
+import signal
+import pytest
+from unittest.mock import patch
+from catalog_mqtt_client import app
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.http_session.close_sessions")
+@patch("catalog_mqtt_client.app.mqtt.Client")
+async def test_signal_stops_dispatcher(client_mock, close_mock, tmpdir, monkeypatch):
+    """ Test that SIGINT cancels the consumers and closes the HTTP sessions """
+    conf = os.path.join(str(tmpdir), "app.conf")
+    with open(conf, "w") as config_file:
+        config_file.write("[MQTT_BROKER]\nurl = tcp://localhost:1883\nuuid = 123\n")
+    monkeypatch.setenv("CATALOG_MQTT_CONF", conf)
+
+    task = asyncio.create_task(app.run())
+    await asyncio.sleep(0.05)
+    os.kill(os.getpid(), signal.SIGINT)
+    await asyncio.wait_for(task, 1)
+
+    client_mock.return_value.loop_stop.assert_called_once()
+    close_mock.assert_awaited_once()
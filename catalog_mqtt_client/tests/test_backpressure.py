@@ -0,0 +1,131 @@
+""" Test the Byte Budget between the workers and the writers """
+import asyncio
+import configparser
+import threading
+import pytest
+from test_data import TestData
+from catalog_mqtt_client.handlers import backpressure
+from catalog_mqtt_client.handlers import tar_writer
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_release():
+    """ Test that a writer waits till enough bytes are released """
+    budget = backpressure.ByteBudget(100)
+    await budget.acquire(60)
+    waiting = asyncio.create_task(budget.acquire(60))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+
+    budget.release(60)
+    await waiting
+    stats = budget.stats()
+    assert stats["buffered_bytes"] == 60
+    assert stats["high_water_bytes"] == 60
+    assert stats["waits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_oversize_page_let_through_when_empty():
+    """ Test that a page bigger than the budget doesn't block forever """
+    budget = backpressure.ByteBudget(100)
+    await budget.acquire(500)
+    assert budget.stats()["high_water_bytes"] == 500
+    budget.release(500)
+    assert budget.stats()["buffered_bytes"] == 0
+
+
+@pytest.mark.asyncio
+async def test_waiters_served_in_order():
+    """ Test that a small page doesn't overtake a waiting big one """
+    budget = backpressure.ByteBudget(100)
+    order = []
+
+    async def writer(name, size):
+        await budget.acquire(size)
+        order.append(name)
+
+    await budget.acquire(90)
+    big = asyncio.create_task(writer("big", 80))
+    await asyncio.sleep(0)
+    small = asyncio.create_task(writer("small", 5))
+    await asyncio.sleep(0.01)
+    assert order == []
+
+    budget.release(90)
+    await asyncio.gather(big, small)
+    assert order == ["big", "small"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_removed():
+    """ Test that a cancelled writer doesn't hold up the others """
+    budget = backpressure.ByteBudget(100)
+    await budget.acquire(50)
+    big = asyncio.create_task(budget.acquire(80))
+    await asyncio.sleep(0)
+    small = asyncio.create_task(budget.acquire(40))
+    await asyncio.sleep(0.01)
+    big.cancel()
+    await asyncio.gather(big, return_exceptions=True)
+    await small
+    assert budget.stats()["buffered_bytes"] == 90
+    assert budget.stats()["waiting_writers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_release_from_thread():
+    """ Test that bytes released by a writer thread wake up the workers """
+    budget = backpressure.ByteBudget(100)
+    await budget.acquire(100)
+    waiting = asyncio.create_task(budget.acquire(10))
+    await asyncio.sleep(0.01)
+    thread = threading.Thread(target=budget.release, args=(100,))
+    thread.start()
+    thread.join()
+    await asyncio.wait_for(waiting, 1)
+    assert budget.stats()["buffered_bytes"] == 10
+
+
+@pytest.mark.asyncio
+async def test_budget_shared_per_loop():
+    """ Test that every writer on the loop shares the configured budget """
+    config = configparser.ConfigParser()
+    config.read_dict(TestData.config)
+    config["PIPELINE"] = {"max_buffered_bytes": "1234"}
+    budget = backpressure.get_budget(config)
+    assert budget is backpressure.get_budget(TestData.config)
+    assert budget.max_bytes == 1234
+    assert backpressure.stats()["max_buffered_bytes"] == 1234
+    del backpressure.BUDGETS[asyncio.get_running_loop()]
+
+
+@pytest.mark.asyncio
+async def test_tar_writer_blocks_on_budget():
+    """ Test that a worker waits while pages queued for the disk use up the budget """
+    config = configparser.ConfigParser()
+    config.read_dict(TestData.config)
+    config["PIPELINE"] = {"max_buffered_bytes": "10"}
+    writer = tar_writer.TarWriter(config, None, TestData.UPLOAD_URL)
+    disk_ready = threading.Event()
+    write_file = writer.write_file
+
+    def slow_disk(data, filename):
+        disk_ready.wait()
+        write_file(data, filename)
+
+    writer.write_file = slow_disk
+    await writer.write("12345678", "page1")
+    second = asyncio.create_task(writer.write("12345678", "page2"))
+    await asyncio.sleep(0.05)
+    assert not second.done()
+    assert writer.budget.stats()["buffered_bytes"] == 8
+
+    disk_ready.set()
+    await second
+    await writer.wait_for_writes()
+    await asyncio.sleep(0)
+    assert writer.budget.stats()["buffered_bytes"] == 0
+    assert writer.budget.stats()["high_water_bytes"] == 8
+    await writer.cleanup()
+    del backpressure.BUDGETS[asyncio.get_running_loop()]
@@ -187,3 +187,11 @@ class TestData:
         apply_filter=JOB_FILTER,
     )
     UPLOAD_URL="http://www.example.com/upload/catalog"
+
+
+def config_with(section, **options):
+    """ A copy of TestData.config with the options set in section """
+    config = configparser.ConfigParser()
+    config.read_dict(TestData.config)
+    config[section] = {key: str(value) for key, value in options.items()}
+    return config
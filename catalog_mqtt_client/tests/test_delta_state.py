@@ -0,0 +1,121 @@
+""" Test the delta collection of Tower lists """
+import asyncio
+import json
+import os
+import re
+import pytest
+from aioresponses import aioresponses
+from catalog_mqtt_client.handlers import delta_state
+from catalog_mqtt_client.handlers import tower_api_worker
+from test_data import TestData
+
+LIST_URL = re.compile(r"^https://www\.example\.com/api/v2/job_templates\?.*$")
+DATE = "Wed, 01 Jul 2020 12:00:00 GMT"
+JOB = {
+    "href_slug": "api/v2/job_templates?page_size=2",
+    "method": "get",
+    "fetch_all_pages": True,
+    "delta": True,
+}
+
+
+class SimpleWriter:
+    """ Stub writer keeping every page """
+
+    def __init__(self):
+        self.pages = {}
+
+    async def write(self, data, fname, size=None):
+        """ Keep the page """
+        self.pages[fname] = json.loads(data)
+
+
+def list_page(ids):
+    """ A single page list of job templates """
+    return json.dumps(
+        {
+            "count": len(ids),
+            "next": None,
+            "previous": None,
+            "results": [{"id": i, "name": f"template {i}"} for i in ids],
+        }
+    )
+
+
+async def sync(state, listed, fetched):
+    """ Run a delta job, the id listing returns listed and the fetch of
+        the objects returns fetched. Returns the pages written, the urls
+        requested and the task's delta sync
+    """
+    delta = delta_state.DeltaSync(state)
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(JOB)
+    worker = tower_api_worker.TowerApiWorker(
+        TestData.config, writer, work_queue, delta=delta
+    )
+    with aioresponses() as mocked:
+        for ids in (listed, fetched):
+            mocked.get(LIST_URL, status=200, body=list_page(ids), headers={"Date": DATE})
+        await worker.start()
+        urls = [str(key[1]) for key in mocked.requests]
+    return writer.pages, urls, delta
+
+
+def test_key_ignores_paging():
+    """ Test that paging parameters don't change the list """
+    key = delta_state.DeltaState.key(
+        "https://www.example.com/",
+        "/api/v2/hosts/",
+        {"page": 3, "page_size": 10, "inventory": 1, "modified__gt": "x"},
+    )
+    assert key == "https://www.example.com/api/v2/hosts?inventory=1"
+
+
+@pytest.mark.asyncio
+async def test_save_and_load(tmpdir):
+    """ Test that committed syncs survive a restart """
+    filename = os.path.join(str(tmpdir), "state", "delta.json")
+    state = delta_state.DeltaState(filename)
+    delta = delta_state.DeltaSync(state)
+    delta.record("list", "2020-07-01T12:00:00+00:00", {3, 1}, 0)
+    assert delta_state.DeltaState(filename).get("list") is None
+
+    await delta.commit()
+    assert delta_state.DeltaState(filename).get("list") == {
+        "watermark": "2020-07-01T12:00:00+00:00",
+        "ids": [1, 3],
+    }
+
+
+def test_unreadable_state(tmpdir):
+    """ Test that a corrupt state file starts afresh """
+    filename = os.path.join(str(tmpdir), "delta.json")
+    with open(filename, "w") as file_handle:
+        file_handle.write("{not json")
+    assert delta_state.DeltaState(filename).entries == {}
+
+
+@pytest.mark.asyncio
+async def test_delta_sync(tmpdir):
+    """ Test a full first sync followed by a delta with tombstones """
+    state = delta_state.DeltaState(os.path.join(str(tmpdir), "delta.json"))
+
+    pages, urls, delta = await sync(state, [1, 2], [1, 2])
+    assert "api/v2/job_templates/tombstones" not in pages
+    assert pages["api/v2/job_templates/page1"]["count"] == 2
+    assert not any("modified__gt" in url for url in urls)
+    await delta.commit()
+
+    pages, urls, delta = await sync(state, [2, 3], [3])
+    assert pages["api/v2/job_templates/page1"]["results"] == [
+        {"id": 3, "name": "template 3"}
+    ]
+    assert pages["api/v2/job_templates/tombstones"] == {
+        "href_slug": "api/v2/job_templates",
+        "since": "2020-07-01T12:00:00+00:00",
+        "watermark": "2020-07-01T12:00:00+00:00",
+        "deleted": [1],
+    }
+    assert any("modified__gt=2020-07-01T12" in url for url in urls)
+    assert delta.stats() == {"delta_lists": 1, "delta_deleted": 1}
@@ -0,0 +1,103 @@
+""" Dispatcher Tests """
+import asyncio
+import json
+import threading
+import pytest
+from unittest.mock import patch
+from test_data import TestData, config_with
+from catalog_mqtt_client import dispatcher
+
+
+PAYLOAD = json.dumps({"url": "http://www.example.com/task/123"})
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.message_handler.MessageHandler.start")
+async def test_concurrent_tasks_are_capped(start_mock):
+    """ Test that at most max_concurrent_tasks handlers run at once """
+    running = 0
+    peak = 0
+
+    async def slow_start():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+
+    start_mock.side_effect = slow_start
+    disp = dispatcher.Dispatcher(config_with("CLIENT", max_concurrent_tasks=2, max_backlog=10))
+    await disp.start()
+    for _ in range(5):
+        disp.submit(PAYLOAD)
+    await asyncio.sleep(0)
+    await disp.queue.join()
+    await disp.stop()
+
+    assert start_mock.call_count == 5
+    assert peak == 2
+    assert disp.processed == 5
+    assert disp.in_flight == 0
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.message_handler.MessageHandler.start")
+async def test_backlog_full_drops_messages(start_mock):
+    """ Test that messages over the backlog are dropped """
+    release = asyncio.Event()
+
+    async def blocked_start():
+        await release.wait()
+
+    start_mock.side_effect = blocked_start
+    disp = dispatcher.Dispatcher(config_with("CLIENT", max_concurrent_tasks=1, max_backlog=2))
+    await disp.start()
+    disp.submit(PAYLOAD)
+    await asyncio.sleep(0.01)
+    for _ in range(3):
+        disp.submit(PAYLOAD)
+    await asyncio.sleep(0.01)
+    assert disp.dropped == 1
+
+    release.set()
+    await disp.queue.join()
+    await disp.stop()
+    assert start_mock.call_count == 3
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.message_handler.MessageHandler.start")
+async def test_submit_from_another_thread(start_mock):
+    """ Test that payloads can be handed over from the MQTT thread """
+    disp = dispatcher.Dispatcher(config_with("CLIENT", max_concurrent_tasks=2, max_backlog=10))
+    await disp.start()
+    thread = threading.Thread(target=disp.submit, args=(PAYLOAD,))
+    thread.start()
+    thread.join()
+    await asyncio.sleep(0.01)
+    await disp.queue.join()
+    await disp.stop()
+    start_mock.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.message_handler.MessageHandler.start")
+async def test_handler_exception_is_contained(start_mock):
+    """ Test that a failing task does not stop the consumer """
+    start_mock.side_effect = Exception("Kaboom")
+    disp = dispatcher.Dispatcher(config_with("CLIENT", max_concurrent_tasks=1, max_backlog=10))
+    await disp.start()
+    disp.submit(PAYLOAD)
+    disp.submit(PAYLOAD)
+    await asyncio.sleep(0)
+    await disp.queue.join()
+    await disp.stop()
+    assert start_mock.call_count == 2
+
+
+def test_submit_before_start():
+    """ Test submitting before the dispatcher has a loop """
+    disp = dispatcher.Dispatcher(config_with("CLIENT", max_concurrent_tasks=1, max_backlog=10))
+    with pytest.raises(Exception) as excinfo:
+        disp.submit(PAYLOAD)
+    assert "not been started" in str(excinfo.value)
@@ -0,0 +1,69 @@
+""" Test the shared HTTP Session Registry """
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from test_data import TestData
+from catalog_mqtt_client.handlers import http_session
+
+
+async def hello(_request):
+    """ Simple handler for the local server """
+    return web.Response(text="Hello")
+
+
+@pytest.mark.asyncio
+async def test_same_session_in_loop():
+    """ Test that the same session is handed out within a loop """
+    registry = http_session.SessionRegistry()
+    session_1 = registry.get_session(TestData.config)
+    session_2 = registry.get_session(TestData.config)
+    assert session_1 is session_2
+    await registry.close()
+    assert session_1.closed
+
+
+@pytest.mark.asyncio
+async def test_closed_session_is_replaced():
+    """ Test that a closed session is replaced with a new one """
+    registry = http_session.SessionRegistry()
+    session_1 = registry.get_session(TestData.config)
+    await session_1.close()
+    session_2 = registry.get_session(TestData.config)
+    assert session_1 is not session_2
+    await registry.close()
+
+
+def test_new_session_per_loop():
+    """ Test that sessions of closed loops are pruned """
+    registry = http_session.SessionRegistry()
+
+    async def get_and_close():
+        session = registry.get_session(TestData.config)
+        await registry.close()
+        return session
+
+    session_1 = asyncio.run(get_and_close())
+    session_2 = asyncio.run(get_and_close())
+    assert session_1 is not session_2
+    assert registry.sessions == {}
+
+
+@pytest.mark.asyncio
+async def test_connections_are_reused():
+    """ Test that keep alive connections are reused and counted """
+    app = web.Application()
+    app.router.add_get("/", hello)
+    server = TestServer(app)
+    await server.start_server()
+    registry = http_session.SessionRegistry()
+    try:
+        session = registry.get_session(TestData.config)
+        for _ in range(3):
+            async with session.get(server.make_url("/")) as response:
+                assert await response.text() == "Hello"
+    finally:
+        await registry.close()
+        await server.close()
+
+    assert registry.stats() == dict(connections_created=1, connections_reused=2)
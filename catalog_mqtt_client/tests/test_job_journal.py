@@ -0,0 +1,192 @@
+""" Test the journal which lets interrupted tasks resume """
+import asyncio
+import json
+import os
+from unittest.mock import patch
+import pytest
+from aioresponses import aioresponses
+from catalog_mqtt_client.handlers import job_journal
+from catalog_mqtt_client.handlers import message_handler
+from catalog_mqtt_client.handlers import tower_api_worker
+from catalog_mqtt_client.handlers import worker_pool
+from test_data import TestData, config_with
+
+TASK_URL = "http://www.example.com/task/123"
+PAYLOAD = json.dumps({"url": TASK_URL})
+
+
+class SimpleWriter:
+    """ Stub writer keeping every page """
+
+    def __init__(self):
+        self.pages = {}
+
+    async def write(self, data, fname, size=None):
+        """ Keep the page """
+        self.pages[fname] = json.loads(data)
+
+
+def journal_config(tmpdir):
+    """ Config for a staged tar writer with the job journal enabled """
+    config = config_with("TAR_WRITER", mode="staged")
+    config["JOURNAL"] = {
+        "enabled": "true",
+        "path": os.path.join(str(tmpdir), "journal.db"),
+        "staging_dir": os.path.join(str(tmpdir), "staging"),
+    }
+    return config
+
+
+def page(number, num_pages):
+    """ A page of job templates """
+    return json.dumps(
+        {
+            "count": num_pages * 2,
+            "next": f"/api/v2/job_templates/?page={number + 1}"
+            if number < num_pages
+            else None,
+            "previous": None,
+            "results": [{"id": number * 2}, {"id": number * 2 + 1}],
+        }
+    )
+
+
+def test_resume_leftover_jobs(tmpdir):
+    """ Test that an interrupted task resumes with the unfinished jobs """
+    journal = job_journal.JobJournal(
+        os.path.join(str(tmpdir), "journal.db"), os.path.join(str(tmpdir), "staging")
+    )
+    task = journal.start_task(TASK_URL, PAYLOAD)
+    assert not task.resumed
+    done = {"href_slug": "api/v2/hosts", "method": "get"}
+    done["journal_id"] = task.add_job(done)
+    started = {"href_slug": "api/v2/groups", "method": "get"}
+    started["journal_id"] = task.add_job(started)
+    task.job_done(done)
+    task.job_started(started)
+    task.page_written("api/v2/groups/page1")
+
+    reopened = job_journal.JobJournal(journal.filename, journal.staging_dir)
+    assert reopened.unfinished() == [PAYLOAD]
+    resumed = reopened.start_task(TASK_URL, PAYLOAD)
+    assert resumed.resumed
+    assert resumed.resume() == [started]
+    assert resumed.staged == {"api/v2/groups/page1"}
+
+    resumed.finish()
+    assert reopened.unfinished() == []
+    assert resumed.jobs() == []
+
+
+def test_interrupted_post_not_retried(tmpdir):
+    """ Test that a POST which might have reached the Tower isn't resumed """
+    journal = job_journal.JobJournal(
+        os.path.join(str(tmpdir), "journal.db"), os.path.join(str(tmpdir), "staging")
+    )
+    task = journal.start_task(TASK_URL, PAYLOAD)
+    job = {"href_slug": "api/v2/job_templates/7/launch/", "method": "launch"}
+    job["journal_id"] = task.add_job(job)
+    task.job_started(job)
+
+    with pytest.raises(Exception) as excinfo:
+        journal.start_task(TASK_URL, PAYLOAD).resume()
+    assert "can't be retried safely" in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_staged_pages_not_fetched(tmpdir):
+    """ Test that a resumed list skips the pages which were staged """
+    journal = job_journal.JobJournal(
+        os.path.join(str(tmpdir), "journal.db"), os.path.join(str(tmpdir), "staging")
+    )
+    task = journal.start_task(TASK_URL, PAYLOAD)
+    task.staged = {"api/v2/job_templates/page2"}
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(
+        dict(href_slug="api/v2/job_templates?page_size=2", method="get", fetch_all_pages=True)
+    )
+    worker = tower_api_worker.TowerApiWorker(
+        TestData.config, writer, work_queue, journal=task
+    )
+    with aioresponses() as mocked:
+        mocked.get(TestData.JOB_TEMPLATES_LIST_URL, status=200, body=page(1, 3))
+        mocked.get(
+            f"{TestData.DEFAULT_JOB_TEMPLATES_LIST_URL}?page=3&page_size=2",
+            status=200,
+            body=page(3, 3),
+        )
+        await worker.start()
+
+    assert sorted(writer.pages) == [
+        "api/v2/job_templates/page1",
+        "api/v2/job_templates/page3",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_monitored_launch_done(tmpdir):
+    """ Test that a launch and the job it monitored aren't resumed once
+        the job has completed
+    """
+    journal = job_journal.JobJournal(
+        os.path.join(str(tmpdir), "journal.db"), os.path.join(str(tmpdir), "staging")
+    )
+    task = journal.start_task(TASK_URL, PAYLOAD)
+    config = config_with("JOB_MONITOR", initial_interval=0.01)
+    work_queue = worker_pool.JournaledQueue(task)
+    await work_queue.put(dict(TestData.JOB_TEMPLATE_LAUNCH_PAYLOAD))
+    pool = worker_pool.WorkerPool(config, SimpleWriter(), work_queue, journal=task)
+    with aioresponses() as mocked:
+        mocked.post(
+            TestData.JOB_TEMPLATE_POST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_1_RUNNING),
+        )
+        mocked.get(
+            TestData.JOB_MONITOR_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_1_SUCCESSFUL),
+        )
+        await pool.run()
+
+    assert [(job["method"], state) for job, state in task.jobs()] == [
+        ("launch", job_journal.DONE),
+        ("monitor", job_journal.DONE),
+    ]
+    assert journal.start_task(TASK_URL, PAYLOAD).resume() == []
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.tar_writer.TarWriter.flush")
+@patch("catalog_mqtt_client.handlers.catalog_task.CatalogTask.get")
+@patch("catalog_mqtt_client.handlers.tower_api_worker.TowerApiWorker.get")
+async def test_handler_resumes_task(get_mock, task_mock, flush_mock, tmpdir):
+    """ Test that the message handler only runs the jobs left over """
+    config = journal_config(tmpdir)
+    jobs = [
+        {"href_slug": "api/v2/hosts", "method": "get"},
+        {"href_slug": "api/v2/groups", "method": "get"},
+    ]
+    task_mock.return_value = json.dumps(
+        {
+            "input": {
+                "response_format": "tar",
+                "upload_url": TestData.UPLOAD_URL,
+                "jobs": jobs,
+            }
+        }
+    )
+    journal = job_journal.get_journal(config)
+    interrupted = journal.start_task(TASK_URL, PAYLOAD)
+    for job in jobs:
+        job["journal_id"] = interrupted.add_job(dict(job))
+    interrupted.job_done(jobs[0])
+
+    handler = message_handler.MessageHandler(config, PAYLOAD)
+    await handler.start()
+
+    assert [call.args[1] for call in get_mock.call_args_list] == ["api/v2/groups"]
+    flush_mock.assert_called_once()
+    assert journal.unfinished() == []
+    assert not os.path.exists(interrupted.staging_dir)
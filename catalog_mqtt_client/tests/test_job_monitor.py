@@ -0,0 +1,166 @@
+""" Test the Job Monitor """
+import asyncio
+import json
+import re
+import pytest
+from aioresponses import aioresponses
+from test_data import TestData, config_with
+from catalog_mqtt_client.handlers import job_monitor
+from catalog_mqtt_client.handlers import tower_api_worker
+from catalog_mqtt_client.handlers import worker_pool
+
+JOBS_LIST_URL = re.compile(r"^https://www\.example\.com/api/v2/jobs/\?.*id__in=")
+
+
+class SimpleWriter:
+    """ Stub writer which keeps the pages in order """
+
+    def __init__(self):
+        self.pages = []
+
+    async def write(self, data, fname, size=None):
+        """ Keep the page """
+        self.pages.append((fname, json.loads(data)))
+
+
+def monitor_payload(job_id, refresh_interval):
+    """ A monitor job for the Tower job job_id """
+    return dict(
+        href_slug=f"/api/v2/jobs/{job_id}",
+        method="monitor",
+        params={},
+        refresh_interval_seconds=refresh_interval,
+        apply_filter=TestData.JOB_FILTER,
+    )
+
+
+def job_body(job_id, status):
+    """ A Tower job """
+    return dict(id=job_id, url=f"/api/v2/jobs/{job_id}", status=status)
+
+
+def test_interval_backs_off_to_refresh_interval():
+    """ Test that the poll interval doubles up to the refresh interval """
+    job = job_monitor.MonitoredJob(
+        tower_api_worker.TowerApiWorker, "/api/v2/jobs/500", monitor_payload(500, 5), 1
+    )
+    intervals = []
+    for _ in range(5):
+        intervals.append(job.interval)
+        job.backoff(2)
+    assert intervals == [1, 2, 4, 5, 5]
+    assert (job.list_path, job.job_id) == ("/api/v2/jobs", "500")
+
+
+@pytest.mark.asyncio
+async def test_due_jobs_batched_with_id_in():
+    """ Test that jobs due together are polled with one list query and
+        only completed jobs are fetched in full
+    """
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(monitor_payload(500, 0.05))
+    await work_queue.put(monitor_payload(501, 0.05))
+    config = config_with("JOB_MONITOR", initial_interval=0.01, backoff_factor=2)
+    worker = tower_api_worker.TowerApiWorker(config, writer, work_queue)
+    requested = []
+
+    def record(url, **kwargs):
+        requested.append(kwargs.get("params") or {})
+
+    with aioresponses() as mocked:
+        mocked.get(
+            JOBS_LIST_URL,
+            status=200,
+            body=json.dumps(
+                dict(count=2, results=[job_body(500, "successful"), job_body(501, "running")])
+            ),
+            callback=record,
+        )
+        mocked.get(
+            "https://www.example.com/api/v2/jobs/500",
+            status=200,
+            body=json.dumps(job_body(500, "successful")),
+        )
+        mocked.get(
+            "https://www.example.com/api/v2/jobs/501",
+            status=200,
+            body=json.dumps(job_body(501, "failed")),
+        )
+        # Both jobs are tracked before the scheduler polls
+        await worker.start()
+
+    assert [fname for fname, _ in writer.pages] == ["/api/v2/jobs/500", "/api/v2/jobs/501"]
+    assert writer.pages[1][1]["status"] == "failed"
+    assert requested[0]["id__in"] == "500,501"
+    assert worker.monitor.stats() == dict(jobs_monitored=2, polls=3, batched_polls=1)
+
+
+@pytest.mark.asyncio
+async def test_monitor_frees_the_worker():
+    """ Test that a single worker keeps fetching while a job runs """
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(monitor_payload(500, 0.1))
+    await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_PAGE)
+    config = config_with("JOB_MONITOR", initial_interval=0.1, backoff_factor=2)
+    worker = tower_api_worker.TowerApiWorker(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mocked.get(
+            "https://www.example.com/api/v2/jobs/500",
+            status=200,
+            body=json.dumps(job_body(500, "running")),
+        )
+        mocked.get(
+            "https://www.example.com/api/v2/jobs/500",
+            status=200,
+            body=json.dumps(job_body(500, "successful")),
+        )
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_RESPONSE),
+        )
+        await worker.start()
+
+    assert [fname for fname, _ in writer.pages] == [
+        "api/v2/job_templates/my_prefix1",
+        "/api/v2/jobs/500",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pool_waits_for_monitored_jobs():
+    """ Test that the pool only stops once the monitored jobs complete """
+    writer = SimpleWriter()
+    work_queue = worker_pool.TimedQueue()
+    await work_queue.put(monitor_payload(500, 0.05))
+    config = config_with("JOB_MONITOR", initial_interval=0.05, backoff_factor=2)
+    config["WORKER_POOL"] = {"min_workers": "1", "max_workers": "2", "idle_timeout": "0.01"}
+    pool = worker_pool.WorkerPool(config, writer, work_queue)
+    with aioresponses() as mocked:
+        for status in ("pending", "running", "successful"):
+            mocked.get(
+                "https://www.example.com/api/v2/jobs/500",
+                status=200,
+                body=json.dumps(job_body(500, status)),
+            )
+        await pool.run()
+
+    assert writer.pages[0][1]["status"] == "successful"
+    assert pool.stats()["polls"] == 3
+
+
+@pytest.mark.asyncio
+async def test_batched_poll_error():
+    """ Test that a failed list query fails the worker """
+    work_queue = asyncio.Queue()
+    await work_queue.put(monitor_payload(500, 1))
+    await work_queue.put(monitor_payload(501, 1))
+    config = config_with("JOB_MONITOR", initial_interval=1, backoff_factor=2)
+    worker = tower_api_worker.TowerApiWorker(config, SimpleWriter(), work_queue)
+    with aioresponses() as mocked:
+        mocked.get(JOBS_LIST_URL, status=404, body="BAD DATA")
+        with pytest.raises(Exception) as excinfo:
+            await worker.start()
+    assert "BAD DATA" in str(excinfo.value)
@@ -0,0 +1,67 @@
+""" Test the encoding of the pages handed to the writers """
+import json
+import pytest
+from catalog_mqtt_client.handlers import json_codec
+
+
+def test_encoded_size():
+    """ Test that the size matches the encoded text """
+    values = [
+        {},
+        [],
+        {"name": "Fred \"Flint\" Stöne", "ids": [1, 2.5, None, True], 3: {"a": []}},
+        [{"nested": [{"deep": "x" * 10}]}, "tab\t", -7],
+    ]
+    for value in values:
+        assert json_codec.encoded_size(value) == len(json.dumps(value))
+
+
+def test_encoded_size_stops_at_limit():
+    """ Test that counting stops once the size is over the limit """
+    value = {"key": ["x" * 100] * 100}
+    size = json_codec.encoded_size(value, limit=50)
+    assert 50 < size < len(json.dumps(value))
+
+
+def test_encode_and_decode():
+    """ Test that text passes through as bytes and objects are converted """
+    page = {"name": "Fred Flintstone"}
+    text = json.dumps(page)
+    assert json_codec.encode(text.encode("utf-8")) == text.encode("utf-8")
+    assert json_codec.encode(text) == text.encode("utf-8")
+    assert json.loads(json_codec.encode(page)) == page
+    assert json_codec.decode(text) == page
+    assert json_codec.decode(page) is page
+    assert json_codec.page_size(page, 10) == 10
+
+
+@pytest.mark.parametrize("name", sorted(json_codec.BACKENDS))
+def test_backends_round_trip(name):
+    """ Test that every installed backend writes UTF-8 bytes it reads back """
+    page = {"name": "Fred Flintstöne", "url": "/api/v2/hosts/1/", "ids": [1, 2.5, None]}
+    previous = json_codec.BACKEND
+    try:
+        assert json_codec.select_backend(name).name == name
+        encoded = json_codec.dumps(page)
+        assert isinstance(encoded, bytes)
+        assert json.loads(encoded.decode("utf-8")) == page
+        assert json_codec.loads(encoded) == page
+        assert json_codec.loads(encoded.decode("utf-8")) == page
+    finally:
+        json_codec.BACKEND = previous
+
+
+def test_missing_backend():
+    """ Test that asking for a backend which isn't installed fails """
+    with pytest.raises(Exception) as excinfo:
+        json_codec.select_backend("simdjson")
+    assert "not installed" in str(excinfo.value)
+
+
+def test_join_encoded_values():
+    """ Test that encoded values are joined into a JSON object as is """
+    page = b'{"id": 1}'
+    assert json.loads(json_codec.join({"page1": page, "state": b'"ok"'})) == {
+        "page1": {"id": 1},
+        "state": "ok",
+    }
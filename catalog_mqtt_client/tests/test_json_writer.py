@@ -1,7 +1,10 @@
 """ Test Json Writer Update """
+import asyncio
 import json
+from unittest.mock import patch
 import pytest
-from test_data import TestData
+from test_data import TestData, config_with
+from catalog_mqtt_client.handlers import json_codec
 from catalog_mqtt_client.handlers import json_writer
 
 
@@ -14,7 +17,7 @@ class SimpleCatalogTask:
 
     async def update(self, data):
         """ Update method to catch data"""
-        self.data = data
+        self.data = json.loads(data)
 
 
 @pytest.mark.asyncio
@@ -39,11 +42,12 @@ async def test_flush_errors():
     assert (c_task.data["status"]) == "error"
 
 
-def test_cleanup():
+@pytest.mark.asyncio
+async def test_cleanup():
     """ Test Cleanup """
     c_task = SimpleCatalogTask()
     writer = json_writer.JSONWriter(TestData.config, c_task)
-    writer.cleanup()
+    await writer.cleanup()
 
 
 @pytest.mark.asyncio
@@ -53,7 +57,171 @@ async def test_write():
     writer = json_writer.JSONWriter(TestData.config, c_task)
     result = {"name": "Fred Flintstone"}
     await writer.write(json.dumps(result), "file1")
+    assert c_task.data == {}
+    await writer.flush()
 
-    assert (c_task.data["state"]) == "running"
+    assert (c_task.data["state"]) == "completed"
     assert (c_task.data["output"]["name"]) == "Fred Flintstone"
     assert (c_task.data["status"]) == "ok"
+    assert writer.patches == 1
+
+
+@pytest.mark.asyncio
+async def test_write_parsed_page():
+    """ Test that a parsed page is encoded and batched by its size """
+    c_task = SimpleCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=30, flush_interval=60)
+    writer = json_writer.JSONWriter(config, c_task)
+    page = {"name": "Fred Flintstone"}
+    await writer.write(page, "file1")
+    assert writer.pending_bytes == len(json_codec.dumps(page))
+    await writer.write({"wife": "Wilma Flintstone"}, "file2", size=100)
+
+    assert c_task.data["pages"] == {
+        "file1": {"name": "Fred Flintstone"},
+        "file2": {"wife": "Wilma Flintstone"},
+    }
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_page_bytes_spliced_into_patch():
+    """ Test that page bytes go into the PATCH without being decoded """
+    c_task = SimpleCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=1024, flush_interval=60)
+    writer = json_writer.JSONWriter(config, c_task)
+    page = b'{"name": "Fred Flintstone"}'
+    await writer.write(page, "file1", size=len(page))
+    assert writer.pending["file1"] is page
+    with patch.object(json_codec, "loads", side_effect=AssertionError):
+        await writer.flush()
+
+    assert c_task.data["output"] == {"name": "Fred Flintstone"}
+    await writer.cleanup()
+
+
+def sent_pages(update):
+    """ The pages of an update, a single page is sent as the output """
+    if "pages" in update:
+        return list(update["pages"].values())
+    if "output" in update:
+        return [update["output"]]
+    return []
+
+
+@pytest.mark.asyncio
+async def test_write_over_batch_size():
+    """ Test that a batch over the size threshold is sent right away """
+    c_task = SimpleCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=30, flush_interval=60)
+    writer = json_writer.JSONWriter(config, c_task)
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "file1")
+    assert c_task.data == {}
+    await writer.write(json.dumps({"wife": "Wilma Flintstone"}), "file2")
+
+    assert c_task.data["state"] == "running"
+    assert "output" not in c_task.data
+    assert c_task.data["pages"] == {
+        "file1": {"name": "Fred Flintstone"},
+        "file2": {"wife": "Wilma Flintstone"},
+    }
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_write_flush_interval():
+    """ Test that pending pages are sent when the interval expires """
+    c_task = SimpleCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=1024, flush_interval=0.01)
+    writer = json_writer.JSONWriter(config, c_task)
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "file1")
+    await asyncio.sleep(0.05)
+
+    assert c_task.data["state"] == "running"
+    assert c_task.data["output"] == {"name": "Fred Flintstone"}
+    await writer.flush()
+    assert c_task.data == {"state": "completed", "status": "ok"}
+    assert writer.patches == 2
+
+
+class SlowCatalogTask(SimpleCatalogTask):
+    """ Stub Class which keeps every update and counts concurrent ones """
+
+    def __init__(self):
+        super().__init__()
+        self.updates = []
+        self.active = 0
+        self.peak = 0
+
+    async def update(self, data):
+        """ Slow update method """
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.updates.append(json.loads(data))
+        self.active -= 1
+
+
+@pytest.mark.asyncio
+async def test_updates_coalesced_one_in_flight():
+    """ Test that pages written during a PATCH are merged into the next """
+    c_task = SlowCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=1, flush_interval=60)
+    writer = json_writer.JSONWriter(config, c_task)
+    await asyncio.gather(
+        *[writer.write(json.dumps({f"page{i}": i}), f"page{i}") for i in range(10)]
+    )
+    await writer.flush()
+
+    assert c_task.peak == 1
+    assert len(c_task.updates) < 10
+    assert c_task.updates[-1]["state"] == "completed"
+    merged = {}
+    for update in c_task.updates:
+        for page in sent_pages(update):
+            merged.update(page)
+    assert merged == {f"page{i}": i for i in range(10)}
+
+
+@pytest.mark.asyncio
+async def test_list_pages_all_sent():
+    """ Test that list pages with the same keys are all sent """
+    c_task = SlowCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=1024 * 1024, flush_interval=60)
+    writer = json_writer.JSONWriter(config, c_task)
+    for page in range(1, 4):
+        await writer.write(
+            json.dumps(
+                {
+                    "count": 6,
+                    "next": f"/api/v2/hosts/?page={page + 1}" if page < 3 else None,
+                    "previous": None,
+                    "results": [{"id": page * 2}, {"id": page * 2 + 1}],
+                }
+            ),
+            f"api/v2/hosts/page{page}",
+        )
+    await writer.flush()
+
+    ids = [
+        result["id"]
+        for update in c_task.updates
+        for page in sent_pages(update)
+        for result in page["results"]
+    ]
+    assert sorted(ids) == [2, 3, 4, 5, 6, 7]
+
+
+@pytest.mark.asyncio
+async def test_flush_errors_drops_pending():
+    """ Test that pending pages aren't sent after an error """
+    c_task = SlowCatalogTask()
+    config = config_with("JSON_WRITER", batch_bytes=1024, flush_interval=60)
+    writer = json_writer.JSONWriter(config, c_task)
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "file1")
+    await writer.flush_errors(["kaboom"])
+    await writer.cleanup()
+
+    assert c_task.updates == [
+        {"output": {"errors": ["kaboom"]}, "state": "completed", "status": "error"}
+    ]
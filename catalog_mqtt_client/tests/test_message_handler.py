@@ -2,6 +2,7 @@
 import json
 import pytest
 from unittest.mock import patch
+from aioresponses import aioresponses
 from test_data import TestData
 from catalog_mqtt_client.handlers import tower_api_worker
 from catalog_mqtt_client.handlers import catalog_task
@@ -80,3 +81,33 @@ async def test_start_with_json_writer_exception(start_mock, get_mock, flush_mock
     start_mock.assert_called()
     flush_error_mock.assert_called_once_with(['Kaboom'])
     flush_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("catalog_mqtt_client.handlers.catalog_task.CatalogTask.update")
+@patch("catalog_mqtt_client.handlers.catalog_task.CatalogTask.get")
+async def test_stats_in_completed_update(get_mock, update_mock):
+    """ Test that the task stats are sent with the completed update """
+    task_info = {
+        "input": {
+            "response_format": "json",
+            "jobs": [TestData.JOB_TEMPLATE_PAYLOAD_FETCH_RELATED],
+        }
+    }
+    get_mock.return_value = json.dumps(task_info)
+    shared = dict(TestData.JOB_TEMPLATE_1)
+
+    payload = {"url": "http://www.example.com/task/123"}
+    msg = message_handler.MessageHandler(TestData.config, json.dumps(payload))
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(dict(count=3, next=None, results=[shared, shared, shared])),
+        )
+        mocked.get(TestData.SURVEY_URL, status=200, body=json.dumps(TestData.SURVEY_DATA))
+        await msg.start()
+
+    completed = json.loads(update_mock.call_args_list[-1].args[0])
+    assert completed["state"] == "completed"
+    assert completed["stats"]["related_deduplicated"] == 2
@@ -0,0 +1,94 @@
+""" Test the Prometheus metrics """
+import asyncio
+import configparser
+import json
+import aiohttp
+import pytest
+from aioresponses import aioresponses
+from test_data import TestData
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client.handlers import tower_api_worker
+
+
+def test_exposition_format():
+    """ Test the text format of counters, gauges and histograms """
+    counter = metrics.Counter("test_total", "A counter", ["kind"])
+    counter.inc(kind="a")
+    counter.inc(2, kind='b"c')
+    gauge = metrics.Gauge("test_gauge", "A gauge")
+    gauge.set_function(lambda: 7)
+    histogram = metrics.Histogram("test_seconds", "A histogram", buckets=(0.5, 1.0))
+    histogram.observe(0.2)
+    histogram.observe(0.7)
+
+    registry = metrics.Registry()
+    for metric in (counter, gauge, histogram):
+        registry.register(metric)
+    lines = registry.expose().splitlines()
+
+    assert "# TYPE test_total counter" in lines
+    assert 'test_total{kind="a"} 1' in lines
+    assert 'test_total{kind="b\\"c"} 2' in lines
+    assert "test_gauge 7" in lines
+    assert 'test_seconds_bucket{le="0.5"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 2' in lines
+    assert "test_seconds_count 2" in lines
+    assert histogram.count() == 2
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    """ Test that the enabled endpoint serves the registry """
+    config = configparser.ConfigParser()
+    config.read_dict({"METRICS": {"enabled": "true", "port": "0"}})
+    metrics.MESSAGES_RECEIVED.inc()
+    runner = await metrics.start_server(config)
+    try:
+        host, port = runner.addresses[0][:2]
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://{host}:{port}/metrics") as response:
+                assert response.status == 200
+                assert response.headers["Content-Type"].startswith("text/plain")
+                body = await response.text()
+    finally:
+        await runner.cleanup()
+
+    assert "# TYPE catalog_mqtt_messages_received_total counter" in body
+    assert "catalog_pipeline_buffered_bytes " in body
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_disabled():
+    """ Test that nothing is served unless enabled """
+    config = configparser.ConfigParser()
+    assert await metrics.start_server(config) is None
+
+
+@pytest.mark.asyncio
+async def test_tower_request_recorded():
+    """ Test that a worker GET is counted with its status and latency """
+    config = configparser.ConfigParser()
+    config.read_dict(TestData.config)
+    work_queue = asyncio.Queue()
+    await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_PAGE)
+
+    class Writer:
+        """ Stub writer """
+
+        async def write(self, _data, _fname, size=None):
+            """ Drop the page """
+
+    responses = metrics.TOWER_RESPONSES.value(method="get", status=200)
+    observed = metrics.TOWER_REQUEST_DURATION.count(method="get")
+    worker = tower_api_worker.TowerApiWorker(config, Writer(), work_queue)
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_RESPONSE),
+        )
+        await worker.start()
+
+    assert metrics.TOWER_RESPONSES.value(method="get", status=200) == responses + 1
+    assert metrics.TOWER_REQUEST_DURATION.count(method="get") == observed + 1
@@ -0,0 +1,88 @@
+""" Test the content hash dedup of uploaded pages """
+import json
+import os
+import tarfile
+import pytest
+from aioresponses import aioresponses
+from catalog_mqtt_client.handlers import page_index
+from catalog_mqtt_client.handlers import tar_writer
+from test_data import TestData, config_with
+
+
+# pylint: disable=R0903
+class SimpleCatalogTask:
+    """ Stub Class to Check incoming data"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def update(self, data):
+        """ Update method to catch data"""
+        self.data = data
+
+
+def dedup_config(index_file):
+    """ Config for a stream mode tar writer with page dedup """
+    config = config_with("TAR_WRITER", mode="stream")
+    config["PAGE_DEDUP"] = {"enabled": "true", "index_file": index_file}
+    return config
+
+
+async def upload(config, pages, full_resync=False, c_task=None):
+    """ Write and upload the pages, returns the archive members by name """
+    writer = tar_writer.TarWriter(
+        config, c_task or SimpleCatalogTask(), TestData.UPLOAD_URL, full_resync=full_resync
+    )
+    try:
+        for filename, page in pages.items():
+            await writer.write(json.dumps(page), filename)
+        with aioresponses() as mocked:
+            mocked.post(TestData.UPLOAD_URL, status=200, body=json.dumps({"id": 1}))
+            await writer.flush()
+        members = {}
+        with writer.open_archive() as file_handle:
+            with tarfile.open(fileobj=file_handle, mode="r:gz") as tar_handle:
+                for member in tar_handle.getmembers():
+                    name = os.path.relpath("/" + member.name, writer.dirname)
+                    members[name] = json.loads(tar_handle.extractfile(member).read())
+        return members
+    finally:
+        await writer.cleanup()
+
+
+def test_index_bounded_and_compacted(tmpdir):
+    """ Test that the index drops old entries and compacts its log """
+    filename = os.path.join(str(tmpdir), "pages.jsonl")
+    index = page_index.PageIndex(filename, max_entries=2)
+    index.commit({"a": "1", "b": "2"})
+    for version in range(5):
+        index.commit({"c": str(version)})
+    assert index.get("a") is None
+    assert index.compactions > 0
+
+    with open(filename) as file_handle:
+        assert len(file_handle.readlines()) <= 2 * index.COMPACT_RATIO
+    reloaded = page_index.PageIndex(filename, max_entries=2)
+    assert reloaded.entries == {"b": "2", "c": "4"}
+
+
+@pytest.mark.asyncio
+async def test_unchanged_pages_left_out(tmpdir):
+    """ Test that only changed pages are uploaded the second time """
+    config = dedup_config(os.path.join(str(tmpdir), "pages.jsonl"))
+    pages = {"api/v2/hosts/page1": {"id": 1}, "api/v2/hosts/page2": {"id": 2}}
+    members = await upload(config, pages)
+    assert set(members) == {*pages, page_index.MANIFEST_NAME}
+
+    pages["api/v2/hosts/page2"] = {"id": 3}
+    c_task = SimpleCatalogTask()
+    members = await upload(config, pages, c_task=c_task)
+    assert c_task.data["stats"]["dedup"] == {"pages": 2, "unchanged": 1}
+    assert set(members) == {"api/v2/hosts/page2", page_index.MANIFEST_NAME}
+    manifest = members[page_index.MANIFEST_NAME]
+    assert manifest["full_resync"] is False
+    assert list(manifest["unchanged"]) == ["api/v2/hosts/page1"]
+
+    members = await upload(config, pages, full_resync=True)
+    assert set(members) == {*pages, page_index.MANIFEST_NAME}
+    assert members[page_index.MANIFEST_NAME]["unchanged"] == {}
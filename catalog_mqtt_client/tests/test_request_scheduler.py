@@ -0,0 +1,149 @@
+""" Test the Tower Request Scheduler """
+import asyncio
+import json
+import time
+import aiohttp
+import pytest
+from aioresponses import aioresponses
+from test_data import TestData, config_with
+from catalog_mqtt_client.handlers import tower_api_worker
+
+
+def scheduler_config(**settings):
+    """ Config with fast retries and the given scheduler settings """
+    return config_with("TOWER_REQUESTS", **dict({"backoff": 0.01, "max_backoff": 1}, **settings))
+
+
+def responses(*statuses, headers=None):
+    """ A send function answering with the given statuses in turn """
+    remaining = list(statuses)
+    sent = []
+
+    async def send():
+        sent.append(time.monotonic())
+        status = remaining.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        return dict(status=status, body="{}", headers=headers or {})
+
+    return send, sent
+
+
+@pytest.mark.asyncio
+async def test_get_retried_on_5xx_and_connection_errors():
+    """ Test that idempotent requests are retried """
+    scheduler = tower_api_worker.RequestScheduler(scheduler_config())
+    send, sent = responses(503, aiohttp.ClientConnectionError(), 200)
+    response = await scheduler.request(send, idempotent=True)
+    assert response["status"] == 200
+    assert len(sent) == 3
+    assert scheduler.stats()["tower_retries"] == 2
+    assert scheduler.stats()["tower_circuit"] == "closed"
+
+
+@pytest.mark.asyncio
+async def test_last_response_returned_after_retries():
+    """ Test that the failed response is handed back once retries run out """
+    scheduler = tower_api_worker.RequestScheduler(scheduler_config(retries=1))
+    send, sent = responses(500, 502)
+    response = await scheduler.request(send, idempotent=True)
+    assert response["status"] == 502
+    assert len(sent) == 2
+
+
+@pytest.mark.asyncio
+async def test_post_only_retried_when_not_processed():
+    """ Test that POSTs are retried on 503 but not on 500 or connection errors """
+    scheduler = tower_api_worker.RequestScheduler(scheduler_config())
+    send, sent = responses(503, 500)
+    response = await scheduler.request(send, idempotent=False)
+    assert response["status"] == 500
+    assert len(sent) == 2
+
+    send, sent = responses(aiohttp.ClientConnectionError())
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await scheduler.request(send, idempotent=False)
+    assert len(sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_the_tower():
+    """ Test that a Retry-After delays the retry and the other requests """
+    scheduler = tower_api_worker.RequestScheduler(scheduler_config())
+    send, sent = responses(429, 200, headers={"Retry-After": "0.1"})
+    other_send, other_sent = responses(200)
+    first = asyncio.create_task(scheduler.request(send, idempotent=False))
+    await asyncio.sleep(0.01)
+    await scheduler.request(other_send, idempotent=True)
+    await first
+    assert sent[1] - sent[0] >= 0.1
+    assert other_sent[0] - sent[0] >= 0.1
+    assert scheduler.stats()["tower_throttled_seconds"] > 0
+
+
+def test_retry_after_http_date():
+    """ Test that a Retry-After date is converted to seconds """
+    scheduler = tower_api_worker.RequestScheduler(scheduler_config(max_backoff=600))
+    retry_at = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 120))
+    assert 100 < scheduler.retry_after({"Retry-After": retry_at}) <= 120
+    assert scheduler.retry_after({"Retry-After": "soon"}) is None
+    assert scheduler.retry_after({}) is None
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_rate_limit():
+    """ Test that requests past the burst are spaced by the rate """
+    scheduler = tower_api_worker.RequestScheduler(scheduler_config(rate=20, burst=1))
+    send, sent = responses(200, 200, 200)
+    await asyncio.gather(*[scheduler.request(send, idempotent=True) for _ in range(3)])
+    assert sent[2] - sent[0] >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    """ Test that the circuit opens, fails fast and closes after a good trial """
+    scheduler = tower_api_worker.RequestScheduler(
+        scheduler_config(retries=0, breaker_threshold=2, breaker_reset=0.05)
+    )
+    send, sent = responses(500, 500, 200)
+    await scheduler.request(send, idempotent=True)
+    await scheduler.request(send, idempotent=True)
+    assert scheduler.stats()["tower_circuit"] == "open"
+
+    with pytest.raises(Exception) as excinfo:
+        await scheduler.request(send, idempotent=True)
+    assert "circuit open" in str(excinfo.value)
+    assert len(sent) == 2
+
+    await asyncio.sleep(0.06)
+    await scheduler.request(send, idempotent=True)
+    assert scheduler.stats()["tower_circuit"] == "closed"
+    assert scheduler.stats()["tower_circuit_opened"] == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_get_survives_tower_hiccup():
+    """ Test that a worker's GET is retried instead of failing the task """
+    writer_data = []
+
+    class Writer:
+        """ Stub writer """
+
+        async def write(self, data, _fname, size=None):
+            """ Keep the page """
+            writer_data.append(json.loads(data))
+
+    work_queue = asyncio.Queue()
+    await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_PAGE)
+    worker = tower_api_worker.TowerApiWorker(scheduler_config(), Writer(), work_queue)
+    with aioresponses() as mocked:
+        mocked.get(TestData.DEFAULT_JOB_TEMPLATES_LIST_URL, status=503, body="Busy")
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_RESPONSE),
+        )
+        await worker.start()
+
+    assert writer_data[0]["count"] == 3
+    assert worker.scheduler.stats()["tower_retries"] == 1
@@ -0,0 +1,194 @@
+""" Test the Tower Response Cache """
+import asyncio
+import configparser
+import json
+import time
+import pytest
+from aioresponses import aioresponses
+from test_data import TestData
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client.handlers import response_cache
+from catalog_mqtt_client.handlers import tower_api_worker
+
+
+class SimpleWriter:
+    """ Stub writer which keeps the last page """
+
+    def __init__(self):
+        self.data = None
+        self.called = 0
+
+    async def write(self, data, _fname, size=None):
+        """ Keep the page """
+        self.data = json.loads(data)
+        self.called += 1
+
+
+def test_ttl_for_longest_prefix():
+    """ Test that the longest matching prefix decides the TTL """
+    cache = response_cache.ResponseCache(
+        1024, {"/api/v2/job_templates": 60, "api/v2/job_templates/909/survey_spec": 5}
+    )
+    assert cache.ttl_for("api/v2/job_templates") == 60
+    assert cache.ttl_for("/api/v2/job_templates/910/") == 60
+    assert cache.ttl_for("api/v2/job_templates/909/survey_spec") == 5
+    assert cache.ttl_for("api/v2/job_templates_other") is None
+    assert cache.ttl_for("api/v2/jobs/500") is None
+
+
+def test_lru_eviction_within_budget():
+    """ Test that the least recently used entries are evicted """
+    cache = response_cache.ResponseCache(10, {"api": 60})
+    cache.store("a", b"1234", {}, 60)
+    cache.store("b", b"1234", {}, 60)
+    cache.lookup("a")
+    cache.store("c", b"1234", {}, 60)
+
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.size == 8
+    assert cache.evictions == 1
+
+
+def test_entry_over_budget_not_cached():
+    """ Test that an entry bigger than the budget is skipped """
+    cache = response_cache.ResponseCache(3, {"api": 60})
+    cache.store("a", b"1234", {}, 60)
+    assert cache.lookup("a") is None
+    assert cache.size == 0
+
+
+def test_expired_entry_without_validators_dropped():
+    """ Test that stale entries which can't be revalidated are removed """
+    cache = response_cache.ResponseCache(1024, {"api": 60})
+    cache.store("a", b"1234", {}, 60)
+    cache.store("b", b"1234", {"ETag": '"abc"'}, 60)
+    cache.entries["a"].expires = time.monotonic() - 1
+    cache.entries["b"].expires = time.monotonic() - 1
+
+    assert cache.lookup("a") is None
+    assert cache.lookup("b").validators() == {"If-None-Match": '"abc"'}
+
+
+def test_entry_evicted_during_revalidation():
+    """ Test that a stale entry evicted while it was revalidated is put back """
+    cache = response_cache.ResponseCache(10, {"api": 60})
+    cache.store("a", b"1234", {"ETag": '"abc"'}, 60)
+    cache.entries["a"].expires = time.monotonic() - 1
+    entry = cache.lookup("a")
+    cache.store("b", b"1234", {}, 60)
+    cache.store("c", b"1234", {}, 60)
+    assert "a" not in cache.entries
+
+    assert cache.refresh("a", entry, 60) is entry
+    assert entry.fresh()
+    assert cache.lookup("a") is entry
+    assert cache.size <= cache.max_bytes
+    assert cache.revalidated == 1
+
+
+def test_stats_exposed_as_metrics(monkeypatch):
+    """ Test that the cache statistics are served on the metrics endpoint """
+    cache = response_cache.ResponseCache(1024, {"api": 60})
+    cache.store("a", b"1234", {}, 60)
+    cache.lookup("a")
+    monkeypatch.setattr(response_cache, "CACHE", cache)
+    exposed = metrics.RESPONSE_CACHE.expose()
+    assert 'catalog_response_cache{stat="hits"} 1' in exposed
+    assert 'catalog_response_cache{stat="bytes"} 4' in exposed
+
+
+def test_from_config():
+    """ Test building the cache from the config file sections """
+    config = configparser.ConfigParser()
+    config["CACHE"] = {"enabled": "true", "max_bytes": "2048"}
+    config["CACHE_TTL"] = {"api/v2/job_templates": "300"}
+    cache = response_cache.ResponseCache.from_config(config)
+    assert cache.max_bytes == 2048
+    assert cache.ttl_for("api/v2/job_templates") == 300
+    assert response_cache.get_cache(TestData.config) is None
+
+
+async def fetch(cache, count):
+    """ Run count single page get jobs through a worker """
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    for _ in range(count):
+        await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_PAGE)
+    worker = tower_api_worker.TowerApiWorker(
+        TestData.config, writer, work_queue, cache=cache
+    )
+    await worker.start()
+    return writer
+
+
+@pytest.mark.asyncio
+async def test_get_served_from_cache():
+    """ Test that a cached GET doesn't go to the Tower """
+    cache = response_cache.ResponseCache(1024 * 1024, {"api/v2/job_templates": 60})
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_RESPONSE),
+        )
+        writer = await fetch(cache, 3)
+
+    assert writer.called == 3
+    assert writer.data["count"] == 3
+    assert cache.stats()["hits"] == 2
+    [entry] = cache.entries.values()
+    assert entry.body == json.dumps(TestData.JOB_TEMPLATE_RESPONSE).encode("utf-8")
+
+
+@pytest.mark.asyncio
+async def test_get_revalidated_with_etag():
+    """ Test that a stale entry is revalidated with If-None-Match """
+    cache = response_cache.ResponseCache(1024 * 1024, {"api/v2/job_templates": 60})
+    sent_headers = []
+
+    def record(_url, **kwargs):
+        sent_headers.append(kwargs["headers"])
+
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_RESPONSE),
+            headers={"ETag": '"v1"'},
+            callback=record,
+        )
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=304,
+            callback=record,
+        )
+        await fetch(cache, 1)
+        for entry in cache.entries.values():
+            entry.expires = time.monotonic() - 1
+        writer = await fetch(cache, 1)
+
+    assert writer.data["count"] == 3
+    assert sent_headers[1]["If-None-Match"] == '"v1"'
+    assert cache.stats()["revalidated"] == 1
+
+
+@pytest.mark.asyncio
+async def test_monitor_never_cached():
+    """ Test that job status polling bypasses the cache """
+    cache = response_cache.ResponseCache(1024 * 1024, {"api/v2/jobs": 60})
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(TestData.JOB_MONITOR_PAYLOAD)
+    worker = tower_api_worker.TowerApiWorker(
+        TestData.config, writer, work_queue, cache=cache
+    )
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.JOB_MONITOR_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_1_SUCCESSFUL),
+        )
+        await worker.start()
+
+    assert writer.data["status"] == "successful"
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,179 @@
+""" Test the Streaming Page Parser """
+import asyncio
+import configparser
+import json
+import jmespath
+from unittest.mock import patch
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aioresponses import aioresponses
+from test_data import TestData
+from catalog_mqtt_client.handlers import stream_parser
+from catalog_mqtt_client.handlers import tower_api_worker
+
+PAGE = dict(
+    count=4,
+    next="/api/v2/job_templates/?page=2",
+    previous=None,
+    extra=[1, 2.5e3, {"name": "café"}],
+    results=[
+        dict(id=1, name="Fred", survey_enabled=True, tags=["a"]),
+        dict(id=2, name=None, survey_enabled=False, tags=[]),
+        [dict(id=3, name="Wilma"), dict(id=4, name="Pebbles")],
+    ],
+    total=12345,
+)
+
+
+def parse(body, apply_filter, chunk_size):
+    """ Feed the body to the parser in chunks """
+    raw = json.dumps(body).encode("utf-8")
+    parser = stream_parser.StreamingPageParser(
+        stream_parser.results_item_filter(apply_filter)
+    )
+    for i in range(0, len(raw), chunk_size):
+        parser.feed(raw[i:i + chunk_size])
+    return parser
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 100000])
+@pytest.mark.parametrize(
+    "apply_filter",
+    ["results[].{id:id,name:name}", "results[].name", "results[*].tags"],
+)
+def test_matches_jmespath(apply_filter, chunk_size):
+    """ Test that streaming gives the same page as filtering the whole body """
+    expected = dict(PAGE)
+    expected["results"] = jmespath.search(apply_filter, PAGE)
+    parser = parse(PAGE, apply_filter, chunk_size)
+    assert parser.close() == expected
+    assert parser.item_count == 3
+
+
+@pytest.mark.parametrize("number", ["1.5", "-2.25e-3", "4E+2", "10"])
+def test_number_split_across_chunks(number):
+    """ Test that a number split anywhere between two chunks is decoded whole """
+    raw = f'{{"ratio": {number}, "results": [{{"id": 1, "ratio": {number}}}]}}'.encode()
+    for split in range(1, len(raw)):
+        parser = stream_parser.StreamingPageParser(lambda item: [item])
+        parser.feed(raw[:split])
+        parser.feed(raw[split:])
+        assert parser.close() == json.loads(raw)
+
+
+def test_results_not_a_list():
+    """ Test that a projection over a non list gives null """
+    parser = parse(dict(count=0, results={"a": 1}), "results[].id", 3)
+    assert parser.close() == dict(count=0, results=None)
+
+
+def test_truncated_document():
+    """ Test that an incomplete document raises """
+    parser = stream_parser.StreamingPageParser(lambda item: [item])
+    parser.feed(b'{"count": 1, "results": [{"id": 1}')
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def test_filters_needing_whole_page():
+    """ Test that only results projections are streamed """
+    assert stream_parser.results_item_filter(None) is None
+    assert stream_parser.results_item_filter({"id": "id"}) is None
+    assert stream_parser.results_item_filter("results[].id | [0]") is None
+    assert stream_parser.results_item_filter("results[].tags[]") is None
+    assert stream_parser.results_item_filter("count") is None
+
+
+class SimpleWriter:
+    """ Stub writer which keeps the pages """
+
+    def __init__(self):
+        self.pages = []
+
+    async def write(self, data, _fname, size=None):
+        """ Keep the page """
+        self.pages.append(json.loads(data))
+
+
+@pytest.mark.asyncio
+async def test_worker_streams_large_pages():
+    """ Test that the worker streams pages over the threshold """
+    config = configparser.ConfigParser()
+    config.read_dict(TestData.config)
+    config["ANSIBLE_TOWER"]["stream_threshold_bytes"] = "10"
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_ALL_PAGES)
+    worker = tower_api_worker.TowerApiWorker(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATES_PAGE1_RESPONSE),
+            headers={"Content-Length": "1000"},
+        )
+        mocked.get(
+            TestData.JOB_TEMPLATES_LIST_URL_PAGE_2,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATES_PAGE2_RESPONSE),
+            headers={"Content-Length": "1000"},
+        )
+        await worker.start()
+
+    assert len(writer.pages) == 2
+    assert writer.pages[0]["results"] == [
+        {"id": TestData.JOB_TEMPLATE_ID_1, "name": "Fred Flintstone"},
+        {"id": TestData.JOB_TEMPLATE_ID_2, "name": "Pebbles Flintstone"},
+    ]
+    assert writer.pages[1]["results"] == [
+        {"id": TestData.JOB_TEMPLATE_ID_3, "name": "Wilma Flintstone"}
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("threshold,streamed", [("10", True), ("1048576", False)])
+async def test_worker_streams_chunked_pages(threshold, streamed):
+    """ Test that a chunked page without a Content-Length is streamed once
+        more than the threshold has arrived, and buffered below it
+    """
+    body = json.dumps(dict(TestData.JOB_TEMPLATES_PAGE1_RESPONSE, next=None)).encode()
+
+    async def handler(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for start in range(0, len(body), 16):
+            await response.write(body[start : start + 16])
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/api/v2/job_templates", handler)
+    async with TestServer(app) as server:
+        config = configparser.ConfigParser()
+        config.read_dict(TestData.config)
+        config["ANSIBLE_TOWER"]["url"] = str(server.make_url("/"))
+        config["ANSIBLE_TOWER"]["stream_threshold_bytes"] = threshold
+        writer = SimpleWriter()
+        work_queue = asyncio.Queue()
+        await work_queue.put(
+            dict(
+                href_slug="api/v2/job_templates",
+                method="get",
+                apply_filter="results[].{id:id,name:name}",
+            )
+        )
+        worker = tower_api_worker.TowerApiWorker(config, writer, work_queue)
+        with patch.object(
+            stream_parser,
+            "StreamingPageParser",
+            wraps=stream_parser.StreamingPageParser,
+        ) as parser_mock:
+            await worker.start()
+
+    assert parser_mock.called == streamed
+    assert writer.pages[0]["results"] == [
+        {"id": TestData.JOB_TEMPLATE_ID_1, "name": "Fred Flintstone"},
+        {"id": TestData.JOB_TEMPLATE_ID_2, "name": "Pebbles Flintstone"},
+    ]
@@ -1,12 +1,26 @@
 """ Test Writer Tests """
+import io
+import asyncio
 import os
+import threading
+import tarfile
 import tempfile
 import json
+import aiohttp
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from aioresponses import aioresponses
-from test_data import TestData
+from test_data import TestData, config_with
+from catalog_mqtt_client import metrics
+from catalog_mqtt_client.handlers import http_session
 from catalog_mqtt_client.handlers import tar_writer
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # pylint: disable=R0903
 class SimpleCatalogTask:
@@ -33,7 +47,23 @@ async def test_flush():
 
     assert (c_task.data["state"]) == "completed"
     assert (c_task.data["status"]) == "ok"
-    writer.cleanup()
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_stats_next_to_output():
+    """ Test that the task stats aren't mixed into the ingress response """
+    c_task = SimpleCatalogTask()
+    writer = tar_writer.TarWriter(TestData.config, c_task, TestData.UPLOAD_URL)
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "file1")
+    with aioresponses() as mocked:
+        mocked.post(TestData.UPLOAD_URL, status=200, body=json.dumps({"name": "Fred"}))
+        await writer.flush({"jobs_done": 1})
+
+    assert c_task.data["output"] == {"name": "Fred"}
+    assert c_task.data["stats"]["jobs_done"] == 1
+    assert c_task.data["stats"]["upload"] == writer.upload_stats
+    await writer.cleanup()
 
 
 @pytest.mark.asyncio
@@ -45,20 +75,21 @@ async def test_flush_errors():
         TestData.config, c_task, TestData.UPLOAD_URL, dirname, tgzfile
     )
     await writer.flush_errors("kaboom")
-    writer.cleanup()
+    await writer.cleanup()
 
     assert (c_task.data["state"]) == "completed"
     assert (c_task.data["status"]) == "error"
 
 
-def test_cleanup():
+@pytest.mark.asyncio
+async def test_cleanup():
     """ Test Cleanup """
     c_task = SimpleCatalogTask()
     dirname, tgzfile = prep_test()
     writer = tar_writer.TarWriter(
         TestData.config, c_task, TestData.UPLOAD_URL, dirname, tgzfile
     )
-    writer.cleanup()
+    await writer.cleanup()
     assert not os.path.exists(dirname)
     assert not os.path.exists(tgzfile)
 
@@ -73,8 +104,27 @@ async def test_write():
     )
     result = {"name": "Fred Flintstone"}
     await writer.write(json.dumps(result), "file1")
+    await writer.wait_for_writes()
     assert os.path.exists(dirname + "/file1")
-    writer.cleanup()
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_write_parsed_page():
+    """ Test that a parsed page is encoded by the writer thread """
+    c_task = SimpleCatalogTask()
+    dirname, tgzfile = prep_test()
+    writer = tar_writer.TarWriter(
+        TestData.no_verify_config, c_task, TestData.UPLOAD_URL, dirname, tgzfile
+    )
+    result = {"name": "Fred Flintstone"}
+    await writer.write(result, "file1", size=32)
+    await writer.write(result, "file2")
+    await writer.wait_for_writes()
+    for filename in ("file1", "file2"):
+        with open(os.path.join(dirname, filename)) as file_handle:
+            assert json.load(file_handle) == result
+    await writer.cleanup()
 
 
 def prep_test():
@@ -86,3 +136,367 @@ def prep_test():
     with open(dirname + "/demo.txt", "w") as file_handle:
         file_handle.write("Hello World\n")
     return dirname, tgzfile
+
+
+@pytest.mark.asyncio
+async def test_stream_write_and_flush():
+    """ Test that stream mode writes no staging directory and uploads the tar """
+    c_task = SimpleCatalogTask()
+    config = config_with("TAR_WRITER", mode="stream", spool_max_bytes=1024 * 1024)
+    writer = tar_writer.TarWriter(config, c_task, TestData.UPLOAD_URL)
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "api/v2/job_templates/page1")
+    await writer.write(json.dumps({"name": "Barney Rubble"}), "api/v2/job_templates/page2")
+    assert not os.path.exists(writer.dirname)
+
+    uploaded = []
+
+    def record(_url, **kwargs):
+        uploaded.append(kwargs["data"])
+
+    with aioresponses() as mocked:
+        mocked.post(
+            TestData.UPLOAD_URL, status=200, body=json.dumps({"name": "Fred"}), callback=record
+        )
+        await writer.flush()
+
+    assert len(uploaded) == 1
+    assert c_task.data["state"] == "completed"
+    with writer.open_archive() as file_handle:
+        with tarfile.open(fileobj=file_handle, mode="r:gz") as tar_handle:
+            names = tar_handle.getnames()
+            member = tar_handle.extractfile(names[0])
+            assert json.loads(member.read()) == {"name": "Fred Flintstone"}
+    assert names == [
+        os.path.join(writer.dirname, "api/v2/job_templates/page1").lstrip("/"),
+        os.path.join(writer.dirname, "api/v2/job_templates/page2").lstrip("/"),
+    ]
+    await writer.cleanup()
+    assert writer.spool.closed
+
+
+@pytest.mark.asyncio
+async def test_stream_spills_to_disk():
+    """ Test that the spooled stream moves to disk over the threshold """
+    c_task = SimpleCatalogTask()
+    config = config_with("TAR_WRITER", mode="stream", spool_max_bytes=1024)
+    writer = tar_writer.TarWriter(config, c_task, TestData.UPLOAD_URL)
+    for page in range(20):
+        await writer.write(os.urandom(512).hex(), f"page{page}")
+    await writer.wait_for_writes()
+    writer.create_tar()
+    assert writer.spool._rolled  # pylint: disable=W0212
+    with writer.open_archive() as file_handle:
+        with tarfile.open(fileobj=file_handle, mode="r:gz") as tar_handle:
+            assert len(tar_handle.getnames()) == 20
+    await writer.cleanup()
+
+
+def test_invalid_mode():
+    """ Test that an unknown mode is rejected """
+    config = config_with("TAR_WRITER", mode="stream", spool_max_bytes=1024)
+    config["TAR_WRITER"]["mode"] = "bogus"
+    with pytest.raises(Exception) as excinfo:
+        tar_writer.TarWriter(config, SimpleCatalogTask(), TestData.UPLOAD_URL)
+    assert "Invalid tar writer mode bogus" in str(excinfo.value)
+
+
+class StandInIngress:
+    """ Local stand in for the ingress service, answers with the
+        queued statuses and then with 202
+    """
+
+    def __init__(self, statuses=None):
+        self.statuses = list(statuses or [])
+        self.uploads = []
+        self.chunked = []
+        self.server = None
+
+    async def upload(self, request):
+        """ Read the multipart upload """
+        self.chunked.append(request.headers.get("Transfer-Encoding") == "chunked")
+        reader = await request.multipart()
+        part = await reader.next()
+        data = await part.read()
+        self.uploads.append((part.filename, data))
+        status = self.statuses.pop(0) if self.statuses else 202
+        return web.json_response({"request_id": len(self.uploads)}, status=status)
+
+    async def start(self):
+        """ Start the local server """
+        app = web.Application()
+        app.router.add_post("/upload", self.upload)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url("/upload"))
+
+    async def close(self):
+        """ Stop the local server and the shared sessions """
+        await http_session.close_sessions()
+        await self.server.close()
+
+
+def upload_config(chunk_size, retries):
+    """ Config for a stream mode tar writer with upload settings """
+    return config_with(
+        "TAR_WRITER",
+        mode="stream",
+        upload_chunk_size=chunk_size,
+        upload_retries=retries,
+        upload_backoff=0.01,
+    )
+
+
+async def archive_writer(config, upload_url):
+    """ Tar writer with a few incompressible pages """
+    writer = tar_writer.TarWriter(config, SimpleCatalogTask(), upload_url)
+    for page in range(4):
+        await writer.write(os.urandom(2048).hex(), f"page{page}")
+    return writer
+
+
+@pytest.mark.asyncio
+async def test_upload_streams_in_chunks():
+    """ Test that the tar file is streamed and the stats are kept """
+    ingress = StandInIngress()
+    upload_url = await ingress.start()
+    try:
+        writer = await archive_writer(upload_config(1024, 0), upload_url)
+        await writer.flush()
+    finally:
+        await ingress.close()
+
+    with writer.open_archive() as file_handle:
+        archive = file_handle.read()
+    assert ingress.uploads == [("inventory.gz", archive)]
+    assert ingress.chunked == [True]
+    assert writer.c_task.data["output"] == {"request_id": 1}
+    assert writer.upload_stats["attempts"] == 1
+    assert writer.upload_stats["bytes_sent"] == len(archive)
+    assert writer.upload_stats["total_bytes"] == len(archive)
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_upload_retries_transient_failures():
+    """ Test that 5xx responses are retried from the start of the file """
+    ingress = StandInIngress([503, 500])
+    upload_url = await ingress.start()
+    progress = metrics.WRITER_UPLOAD_PROGRESS.value(writer="tar")
+    uploads = metrics.WRITER_UPLOAD_DURATION.count(writer="tar")
+    try:
+        writer = await archive_writer(upload_config(4096, 3), upload_url)
+        await writer.flush()
+    finally:
+        await ingress.close()
+
+    assert len(ingress.uploads) == 3
+    assert ingress.uploads[0] == ingress.uploads[2]
+    assert writer.upload_stats["attempts"] == 3
+    assert writer.upload_stats["bytes_sent"] == len(ingress.uploads[2][1])
+    assert metrics.WRITER_UPLOAD_PROGRESS.value(writer="tar") == progress + 3 * len(
+        ingress.uploads[2][1]
+    )
+    assert metrics.WRITER_UPLOAD_DURATION.count(writer="tar") == uploads + 1
+    assert writer.c_task.data["status"] == "ok"
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_upload_gives_up_after_retries():
+    """ Test that the last transient failure is raised """
+    ingress = StandInIngress([503, 503, 503])
+    upload_url = await ingress.start()
+    uploaded = metrics.WRITER_BYTES_UPLOADED.value(writer="tar")
+    try:
+        writer = await archive_writer(upload_config(4096, 2), upload_url)
+        with pytest.raises(aiohttp.ClientResponseError) as excinfo:
+            await writer.flush()
+    finally:
+        await ingress.close()
+
+    assert excinfo.value.status == 503
+    assert len(ingress.uploads) == 3
+    assert writer.upload_stats == {}
+    assert metrics.WRITER_BYTES_UPLOADED.value(writer="tar") == uploaded
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_upload_client_error_not_retried():
+    """ Test that a 4xx response fails straight away """
+    ingress = StandInIngress([413])
+    upload_url = await ingress.start()
+    try:
+        writer = await archive_writer(upload_config(4096, 3), upload_url)
+        with pytest.raises(Exception) as excinfo:
+            await writer.flush()
+    finally:
+        await ingress.close()
+
+    assert "Upload failed 413" in str(excinfo.value)
+    assert len(ingress.uploads) == 1
+    await writer.cleanup()
+
+
+def compression_config(mode, compression, level=None):
+    """ Config for a tar writer with a compression codec """
+    config = config_with("TAR_WRITER", mode=mode, compression=compression)
+    if level is not None:
+        config["TAR_WRITER"]["compression_level"] = str(level)
+    return config
+
+
+def read_archive(writer):
+    """ Names and contents of the members of the compressed tar file """
+    with writer.open_archive() as file_handle:
+        data = file_handle.read()
+    if writer.codec.tar_mode is None:
+        data = zstandard.ZstdDecompressor().stream_reader(data).read()
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tar_handle:
+        return {
+            os.path.basename(name): json.loads(tar_handle.extractfile(name).read())
+            for name in tar_handle.getnames()
+        }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["staged", "stream"])
+@pytest.mark.parametrize(
+    "compression,level", [("gzip", 1), ("bz2", None), ("xz", 0), ("zstd", 3)]
+)
+async def test_compression_codecs(mode, compression, level):
+    """ Test that every codec produces a readable tar file """
+    if compression == "zstd" and zstandard is None:
+        pytest.skip("zstandard is not installed")
+    c_task = SimpleCatalogTask()
+    writer = tar_writer.TarWriter(
+        compression_config(mode, compression, level), c_task, TestData.UPLOAD_URL
+    )
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "page1")
+    await writer.write(json.dumps({"name": "Barney Rubble"}), "page2")
+
+    uploaded = []
+
+    def record(_url, **kwargs):
+        uploaded.append(kwargs["data"])
+
+    with aioresponses() as mocked:
+        mocked.post(
+            TestData.UPLOAD_URL, status=200, body=json.dumps({"name": "Fred"}), callback=record
+        )
+        await writer.flush()
+
+    part = uploaded[0]._parts[0][0]  # pylint: disable=W0212
+    assert part.headers["Content-Type"] == tar_writer.CODECS[compression].content_type
+    assert tar_writer.CODECS[compression].filename in part.headers["Content-Disposition"]
+    assert read_archive(writer) == {
+        "page1": {"name": "Fred Flintstone"},
+        "page2": {"name": "Barney Rubble"},
+    }
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_compression_off_the_loop():
+    """ Test that the tar file is created in another thread """
+    c_task = SimpleCatalogTask()
+    writer = tar_writer.TarWriter(TestData.config, c_task, TestData.UPLOAD_URL)
+    await writer.write(json.dumps({"name": "Fred Flintstone"}), "file1")
+    threads = []
+    create_tar = writer.create_tar
+
+    def record_thread():
+        threads.append(threading.get_ident())
+        create_tar()
+
+    writer.create_tar = record_thread
+    with aioresponses() as mocked:
+        mocked.post(TestData.UPLOAD_URL, status=200, body=json.dumps({"name": "Fred"}))
+        await writer.flush()
+
+    assert threads and threads[0] != threading.get_ident()
+    assert writer.compression_seconds > 0.0
+    await writer.cleanup()
+
+
+def test_invalid_compression():
+    """ Test that an unknown codec is rejected """
+    config = compression_config("staged", "lz4")
+    with pytest.raises(Exception) as excinfo:
+        tar_writer.TarWriter(config, SimpleCatalogTask(), TestData.UPLOAD_URL)
+    assert "Invalid tar writer compression lz4" in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_writes_off_the_loop_with_backpressure():
+    """ Test that pages are written in another thread and writers wait
+        once max_pending_writes pages are queued
+    """
+    config = config_with("TAR_WRITER", mode="staged", max_pending_writes=2)
+    writer = tar_writer.TarWriter(config, SimpleCatalogTask(), TestData.UPLOAD_URL)
+    disk_ready = threading.Event()
+    threads = set()
+    write_file = writer.write_file
+
+    def slow_disk(data, filename):
+        disk_ready.wait()
+        threads.add(threading.get_ident())
+        write_file(data, filename)
+
+    writer.write_file = slow_disk
+    await writer.write("{}", "page1")
+    await writer.write("{}", "page2")
+    third = asyncio.create_task(writer.write("{}", "page3"))
+    await asyncio.sleep(0.05)
+    assert not third.done()
+
+    disk_ready.set()
+    await third
+    await writer.wait_for_writes()
+    assert threads == {writer.write_thread.ident}
+    assert sorted(os.listdir(writer.dirname)) == ["page1", "page2", "page3"]
+    await writer.cleanup()
+    assert writer.write_thread is None
+
+
+@pytest.mark.asyncio
+async def test_write_error_raised_on_flush():
+    """ Test that a failed page write fails the flush """
+    writer = tar_writer.TarWriter(TestData.config, SimpleCatalogTask(), TestData.UPLOAD_URL)
+
+    def full_disk(_data, _filename):
+        raise OSError("No space left on device")
+
+    writer.write_file = full_disk
+    await writer.write("{}", "page1")
+    with pytest.raises(OSError) as excinfo:
+        await writer.flush()
+    assert "No space left" in str(excinfo.value)
+    with pytest.raises(OSError):
+        await writer.write("{}", "page2")
+    await writer.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_cleanup_off_the_loop():
+    """ Test that cleanup waits for a busy writer thread without blocking
+        the event loop
+    """
+    writer = tar_writer.TarWriter(TestData.config, SimpleCatalogTask(), TestData.UPLOAD_URL)
+    disk_ready = threading.Event()
+    write_file = writer.write_file
+
+    def slow_disk(data, filename):
+        disk_ready.wait()
+        write_file(data, filename)
+
+    writer.write_file = slow_disk
+    await writer.write("{}", "page1")
+    cleanup = asyncio.create_task(writer.cleanup())
+    await asyncio.sleep(0.05)
+    assert not cleanup.done()
+
+    disk_ready.set()
+    await cleanup
+    assert writer.write_thread is None
+    assert not os.path.exists(writer.dirname)
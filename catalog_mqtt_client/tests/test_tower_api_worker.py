@@ -1,5 +1,6 @@
 """ Test Tower API Worker """
 import queue
+import re
 import asyncio
 import json
 import logging
@@ -18,7 +19,7 @@ class SimpleWriter:
         self.prefix = prefix
         self.prefixUsed = False
 
-    async def write(self, data, fname):
+    async def write(self, data, fname, size=None):
         self.data = json.loads(data)
         self.fname = fname
         self.called += 1
@@ -84,6 +85,45 @@ async def test_get_multiple_pages():
         assert writer.called == 2
 
 
+class BytesWriter:
+    """ Stub writer keeping the page bytes and the size it was given """
+
+    def __init__(self):
+        self.pages = []
+
+    async def write(self, data, fname, size=None):
+        self.pages.append((data, size))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("apply_filter", [None, "results[].{id:id}"])
+async def test_writer_gets_page_bytes(apply_filter):
+    """ Test that the writer gets bytes, the body Tower sent unless a
+        filter changed it
+    """
+    writer = BytesWriter()
+    work_queue = asyncio.Queue()
+    job = dict(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_PAGE)
+    if apply_filter:
+        job["apply_filter"] = apply_filter
+    await work_queue.put(job)
+    worker = tower_api_worker.TowerApiWorker(TestData.config, writer, work_queue)
+    body = json.dumps(TestData.JOB_TEMPLATE_RESPONSE)
+    with aioresponses() as mocked:
+        mocked.get(TestData.DEFAULT_JOB_TEMPLATES_LIST_URL, status=200, body=body)
+        await worker.start()
+
+    [(data, size)] = writer.pages
+    assert isinstance(data, bytes)
+    assert size == len(data)
+    if apply_filter:
+        assert json.loads(data)["results"] == [
+            {"id": item["id"]} for item in TestData.JOB_TEMPLATE_RESPONSE["results"]
+        ]
+    else:
+        assert data == body.encode("utf-8")
+
+
 @pytest.mark.asyncio
 async def test_get_with_related():
     """ Test Get Method plus related"""
@@ -303,3 +343,190 @@ async def test_monitor_400():
         with pytest.raises(Exception) as excinfo:
             await worker.start()
         assert "BAD DATA" in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_workers_stay_busy_through_fan_out():
+    """ Test that all workers pick up the related jobs added by one worker """
+    num_workers = 3
+    num_related = 9
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_FETCH_RELATED)
+    workers = [
+        tower_api_worker.TowerApiWorker(TestData.config, writer, work_queue)
+        for _ in range(num_workers)
+    ]
+    results = [
+        dict(
+            id=i,
+            survey_spec=True,
+            survey_url=f"/api/v2/job_templates/{i}/survey_spec",
+        )
+        for i in range(num_related)
+    ]
+    active = 0
+    peak = 0
+
+    async def slow(_url, **_kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(dict(count=num_related, next=None, results=results)),
+        )
+        mocked.get(
+            re.compile(r"https://www.example.com/api/v2/job_templates/\d+/survey_spec"),
+            status=200,
+            body=json.dumps(TestData.SURVEY_DATA),
+            callback=slow,
+            repeat=True,
+        )
+        await asyncio.gather(*[worker.start() for worker in workers])
+
+    assert writer.called == num_related + 1
+    assert peak == num_workers
+    assert all(worker.jobs_done > 0 for worker in workers)
+    assert work_queue.empty()
+
+
+class OrderedWriter:
+    """ Writer which remembers the order of the pages """
+
+    def __init__(self):
+        self.pages = []
+
+    async def write(self, data, fname, size=None):
+        self.pages.append((fname, json.loads(data)))
+
+
+def paged_response(page, num_pages, page_size, count=True):
+    """ Build a page of job templates """
+    body = dict(
+        next=f"/api/v2/job_templates/?page={page + 1}" if page < num_pages else None,
+        previous=None,
+        results=[dict(id=(page - 1) * page_size + i) for i in range(page_size)],
+    )
+    if count:
+        body["count"] = num_pages * page_size
+    return body
+
+
+@pytest.mark.asyncio
+async def test_get_prefetches_pages_in_order():
+    """ Test that the remaining pages are fetched concurrently and written in order """
+    num_pages = 6
+    writer = OrderedWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(
+        dict(href_slug="api/v2/job_templates?page_size=2", method="get", fetch_all_pages=True)
+    )
+    worker = tower_api_worker.TowerApiWorker(TestData.config, writer, work_queue)
+    active = 0
+    peak = 0
+
+    async def slow(url, **_kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        # Later pages return sooner to check the pages are written in order
+        await asyncio.sleep(0.05 / int(url.query["page"]))
+        active -= 1
+
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(paged_response(1, num_pages, 2)),
+        )
+        for page in range(2, num_pages + 1):
+            mocked.get(
+                f"{TestData.DEFAULT_JOB_TEMPLATES_LIST_URL}?page={page}&page_size=2",
+                status=200,
+                body=json.dumps(paged_response(page, num_pages, 2)),
+                callback=slow,
+            )
+        await worker.start()
+
+    assert [name for name, _ in writer.pages] == [
+        f"api/v2/job_templates/page{page}" for page in range(1, num_pages + 1)
+    ]
+    assert [data["results"][0]["id"] for _, data in writer.pages] == list(
+        range(0, num_pages * 2, 2)
+    )
+    assert peak == tower_api_worker.TowerApiWorker.DEFAULT_PREFETCH_WINDOW
+
+
+@pytest.mark.asyncio
+async def test_get_follows_next_without_count():
+    """ Test that pages are fetched one by one if Tower sends no count """
+    num_pages = 3
+    writer = OrderedWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(
+        dict(href_slug="api/v2/job_templates?page_size=2", method="get", fetch_all_pages=True)
+    )
+    worker = tower_api_worker.TowerApiWorker(TestData.config, writer, work_queue)
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(paged_response(1, num_pages, 2, False)),
+        )
+        for page in range(2, num_pages + 1):
+            mocked.get(
+                f"{TestData.DEFAULT_JOB_TEMPLATES_LIST_URL}?page={page}&page_size=2",
+                status=200,
+                body=json.dumps(paged_response(page, num_pages, 2, False)),
+            )
+        await worker.start()
+
+    assert [name for name, _ in writer.pages] == [
+        f"api/v2/job_templates/page{page}" for page in range(1, num_pages + 1)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_related_fetched_once():
+    """ Test that related objects shared by many results are fetched once """
+    writer = SimpleWriter()
+    work_queue = asyncio.Queue()
+    await work_queue.put(TestData.JOB_TEMPLATE_PAYLOAD_FETCH_RELATED)
+    related = tower_api_worker.RelatedObjects()
+    workers = [
+        tower_api_worker.TowerApiWorker(TestData.config, writer, work_queue, related=related)
+        for _ in range(2)
+    ]
+    shared = dict(TestData.JOB_TEMPLATE_1)
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+            status=200,
+            body=json.dumps(dict(count=3, next=None, results=[shared, shared, shared])),
+        )
+        mocked.get(
+            TestData.SURVEY_URL,
+            status=200,
+            body=json.dumps(TestData.SURVEY_DATA),
+        )
+        await asyncio.gather(*[worker.start() for worker in workers])
+
+    assert writer.called == 2
+    assert related.deduplicated == 2
+
+
+def test_filter_body_compiles_once():
+    """ Test that filter expressions are compiled once and reused """
+    compile_expression = tower_api_worker.jmespath_cache.compile_expression
+    compile_expression.cache_clear()
+    for _ in range(3):
+        result = tower_api_worker.filter_body(TestData.JOB_FILTER, TestData.JOB_1)
+    assert result["url"] == "/api/v2/jobs/500"
+    assert compile_expression.cache_info().misses == len(TestData.JOB_FILTER)
+    assert compile_expression.cache_info().hits == 2 * len(TestData.JOB_FILTER)
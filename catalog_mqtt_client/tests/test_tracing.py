@@ -0,0 +1,105 @@
+""" Test the per task tracing """
+import asyncio
+import configparser
+import json
+import os
+import pytest
+from test_data import TestData, config_with
+from catalog_mqtt_client import tracing
+from catalog_mqtt_client.handlers import json_writer
+
+
+# pylint: disable=R0903
+class SimpleCatalogTask:
+    """ Stub Class to Check incoming data"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def update(self, data):
+        """ Update method to catch data"""
+        self.data = json.loads(data)
+
+
+def test_disabled():
+    """ Test that no trace is created and spans do nothing unless enabled """
+    assert tracing.Trace.from_config(configparser.ConfigParser(), "task") is None
+    with tracing.span("nothing") as span:
+        assert span is None
+    assert tracing.timing() is None
+
+
+@pytest.mark.asyncio
+async def test_nested_spans():
+    """ Test that spans of child tasks are parented and summarized """
+    config = config_with("TRACING", enabled="true", debug_timing="true")
+    trace = tracing.Trace.from_config(config, "task")
+
+    async def child(number):
+        with tracing.span("child", number=number):
+            await asyncio.sleep(0)
+
+    with tracing.activate(trace), tracing.span("root") as root:
+        await asyncio.gather(child(1), child(2))
+        tracing.record("tower.get", 0.5, href_slug="/api/v2/jobs/")
+        summary = tracing.timing()
+
+    assert tracing.timing() is None
+    children = [span for span in trace.spans if span.name == "child"]
+    assert len(children) == 2
+    assert all(span.parent_id == root.span_id for span in children)
+    assert summary["spans"]["child"]["count"] == 2
+    assert summary["spans"]["tower.get"]["total_seconds"] == pytest.approx(0.5, abs=0.01)
+    assert "root" not in summary["spans"]
+
+
+def test_span_error():
+    """ Test that a failed span is marked with the error """
+    trace = tracing.Trace("task")
+    with pytest.raises(Exception):
+        with tracing.activate(trace), tracing.span("failing"):
+            raise Exception("Kaboom")
+
+    assert trace.spans[0].attributes["error"] == "Kaboom"
+    assert trace.spans[0].end_ns is not None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("export_format", ["chrome", "otlp"])
+async def test_export(tmpdir, export_format):
+    """ Test the export to a file in each format """
+    config = config_with("TRACING", enabled="true", export_dir=str(tmpdir), export_format=export_format)
+    trace = tracing.Trace.from_config(config, "task", url="http://www.example.com")
+    with tracing.activate(trace), tracing.span("root"), tracing.span("child", page=2):
+        pass
+    await trace.export()
+
+    with open(os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0])) as file_handle:
+        body = json.load(file_handle)
+    if export_format == "chrome":
+        names = [event["name"] for event in body["traceEvents"]]
+    else:
+        names = [span["name"] for span in body["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+    assert sorted(names) == ["child", "root"]
+
+
+def test_invalid_export_format():
+    """ Test that an unknown export format is rejected """
+    with pytest.raises(Exception) as excinfo:
+        config = config_with("TRACING", enabled="true", export_format="xml")
+        tracing.Trace.from_config(config, "task")
+    assert "Invalid trace export format xml" in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_timing_in_flush():
+    """ Test that the timing breakdown is sent with the final update """
+    c_task = SimpleCatalogTask()
+    trace = tracing.Trace("task", debug_timing=True)
+    with tracing.activate(trace):
+        writer = json_writer.JSONWriter(TestData.config, c_task)
+        await writer.write(json.dumps({"name": "Fred Flintstone"}), "file1")
+        await writer.flush()
+
+    assert c_task.data["output"]["name"] == "Fred Flintstone"
+    assert c_task.data["timing"]["trace_id"] == trace.trace_id
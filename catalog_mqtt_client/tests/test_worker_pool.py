@@ -0,0 +1,165 @@
+""" Test the Worker Pool """
+import asyncio
+import json
+import pytest
+from aioresponses import aioresponses
+from test_data import TestData, config_with
+from catalog_mqtt_client.handlers import worker_pool
+
+
+class SimpleWriter:
+    """ Stub writer which counts the pages written """
+
+    def __init__(self):
+        self.called = 0
+
+    async def write(self, _data, _fname, size=None):
+        """ Count the page """
+        self.called += 1
+
+
+async def fill_queue(count):
+    """ Create a queue with count get jobs for the same job template """
+    work_queue = worker_pool.TimedQueue()
+    for _ in range(count):
+        await work_queue.put(dict(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_RELATED))
+    return work_queue
+
+
+def mock_job_template(mocked, count, callback=None):
+    """ Mock count responses for the job template """
+    for _ in range(count):
+        mocked.get(
+            TestData.JOB_TEMPLATE_ID_1_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_2),
+            callback=callback,
+        )
+
+
+@pytest.mark.asyncio
+async def test_pool_sized_from_jobs():
+    """ Test that the pool starts with a worker per job up to the max """
+    writer = SimpleWriter()
+    work_queue = await fill_queue(6)
+    config = config_with("WORKER_POOL", min_workers=1, max_workers=4, max_tower_concurrency=8)
+    pool = worker_pool.WorkerPool(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mock_job_template(mocked, 6)
+        await pool.run()
+
+    stats = pool.stats()
+    assert writer.called == 6
+    assert stats["jobs_done"] == 6
+    assert stats["peak_workers"] == 4
+    assert 0.0 <= stats["worker_utilisation"] <= 1.0
+
+
+@pytest.mark.asyncio
+async def test_pool_minimum_workers():
+    """ Test that the minimum number of workers is started """
+    writer = SimpleWriter()
+    work_queue = await fill_queue(1)
+    config = config_with("WORKER_POOL", min_workers=3, max_workers=5, max_tower_concurrency=8)
+    pool = worker_pool.WorkerPool(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mock_job_template(mocked, 1)
+        await pool.run()
+
+    assert pool.stats()["workers_started"] == 3
+    assert pool.stats()["jobs_done"] == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_grows_when_queue_backs_up():
+    """ Test that workers are added when new jobs are queued """
+    writer = SimpleWriter()
+    work_queue = await fill_queue(1)
+
+    async def fan_out(_url, **_kwargs):
+        for _ in range(4):
+            work_queue.put_nowait(dict(TestData.JOB_TEMPLATE_PAYLOAD_SINGLE_PAGE))
+        await asyncio.sleep(worker_pool.WorkerPool.SCALE_INTERVAL * 2)
+
+    config = config_with("WORKER_POOL", min_workers=1, max_workers=4, max_tower_concurrency=8)
+    pool = worker_pool.WorkerPool(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mock_job_template(mocked, 1, fan_out)
+        for _ in range(4):
+            mocked.get(
+                TestData.DEFAULT_JOB_TEMPLATES_LIST_URL,
+                status=200,
+                body=json.dumps(TestData.JOB_TEMPLATE_RESPONSE),
+            )
+        await pool.run()
+
+    assert pool.stats()["jobs_done"] == 5
+    assert pool.stats()["peak_workers"] > 1
+
+
+@pytest.mark.asyncio
+async def test_tower_concurrency_ceiling():
+    """ Test that requests to the Tower are capped across workers """
+    writer = SimpleWriter()
+    work_queue = await fill_queue(6)
+    active = 0
+    peak = 0
+
+    async def slow(_url, **_kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+
+    config = config_with("WORKER_POOL", min_workers=1, max_workers=6, max_tower_concurrency=2)
+    pool = worker_pool.WorkerPool(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mocked.get(
+            TestData.JOB_TEMPLATE_ID_1_URL,
+            status=200,
+            body=json.dumps(TestData.JOB_TEMPLATE_2),
+            callback=slow,
+            repeat=True,
+        )
+        await pool.run()
+
+    assert writer.called == 6
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_pool_worker_exception():
+    """ Test that a failing worker stops the pool """
+    work_queue = worker_pool.TimedQueue()
+    await work_queue.put(TestData.INVALID_PAYLOAD)
+    config = config_with("WORKER_POOL", min_workers=2, max_workers=2, max_tower_concurrency=2)
+    pool = worker_pool.WorkerPool(config, None, work_queue)
+    with pytest.raises(Exception) as excinfo:
+        await pool.run()
+    assert "Invalid method bad" in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_pool_shrinks_when_idle():
+    """ Test that idle workers above the minimum stop early """
+    writer = SimpleWriter()
+    work_queue = await fill_queue(4)
+    config = config_with(
+        "WORKER_POOL", min_workers=1, max_workers=4, max_tower_concurrency=8, idle_timeout=0.01
+    )
+
+    async def slow_last(_url, **_kwargs):
+        await asyncio.sleep(0.5)
+
+    pool = worker_pool.WorkerPool(config, writer, work_queue)
+    with aioresponses() as mocked:
+        mock_job_template(mocked, 3)
+        mock_job_template(mocked, 1, slow_last)
+        runner = asyncio.create_task(pool.run())
+        await asyncio.sleep(0.3)
+        assert len(pool.tasks) == 1
+        await runner
+
+    assert pool.stats()["jobs_done"] == 4
+    assert pool.retiring == 0
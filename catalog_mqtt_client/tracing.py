@@ -0,0 +1,260 @@
+""" Lightweight tracing of a catalog task. Spans are recorded while a
+    trace is active in the current context, asyncio tasks created by the
+    handlers inherit it so worker and writer spans end up in the trace
+    of the message they work for. A finished trace can be exported to a
+    local file in the Chrome trace or OTLP JSON format, and a timing
+    breakdown per span name can be attached to the final task update
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+import contextlib
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "catalog_mqtt_client"
+EXPORT_FORMATS = ("chrome", "otlp")
+DEFAULT_EXPORT_FORMAT = "chrome"
+
+CURRENT_TRACE = contextvars.ContextVar("catalog_trace", default=None)
+CURRENT_SPAN = contextvars.ContextVar("catalog_span", default=None)
+
+
+class Span:
+    """ A timed operation within a trace """
+
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread_id = threading.get_ident()
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns = None
+
+    def duration(self):
+        """ Seconds the span took, or has taken so far """
+        return ((self.end_ns or time.perf_counter_ns()) - self.start_ns) / 1e9
+
+
+class Trace:
+    """ The spans recorded while processing a single catalog task """
+
+    def __init__(self, name, debug_timing=False, export_dir=None, export_format=None, **attributes):
+        if export_format is None:
+            export_format = DEFAULT_EXPORT_FORMAT
+        if export_format not in EXPORT_FORMATS:
+            raise Exception(f"Invalid trace export format {export_format}")
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = attributes
+        self.debug_timing = debug_timing
+        self.export_dir = export_dir
+        self.export_format = export_format
+        self.epoch_ns = time.time_ns()
+        self.start_ns = time.perf_counter_ns()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, name, **attributes):
+        """ A new trace if tracing is enabled in the config, else None """
+        if not config.getboolean("TRACING", "enabled", fallback=False):
+            return None
+        return cls(
+            name,
+            debug_timing=config.getboolean("TRACING", "debug_timing", fallback=False),
+            export_dir=config.get("TRACING", "export_dir", fallback=None) or None,
+            export_format=config.get("TRACING", "export_format", fallback=None),
+            **attributes,
+        )
+
+    def start_span(self, name, parent, attributes):
+        """ Record the start of a span """
+        span = Span(name, parent.span_id if parent else None, attributes)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    def unix_ns(self, perf_ns):
+        """ Convert a perf counter reading to nanoseconds since the epoch """
+        return self.epoch_ns + perf_ns - self.start_ns
+
+    def finished(self):
+        """ The spans which have ended """
+        with self.lock:
+            return [span for span in self.spans if span.end_ns is not None]
+
+    def summary(self):
+        """ Count, total and max seconds per span name. Spans of concurrent
+            workers overlap so totals can add up to more than wall_seconds
+        """
+        breakdown = {}
+        for span in self.finished():
+            entry = breakdown.setdefault(
+                span.name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            )
+            duration = span.duration()
+            entry["count"] = entry["count"] + 1
+            entry["total_seconds"] = entry["total_seconds"] + duration
+            entry["max_seconds"] = max(entry["max_seconds"], duration)
+        for entry in breakdown.values():
+            entry["total_seconds"] = round(entry["total_seconds"], 6)
+            entry["max_seconds"] = round(entry["max_seconds"], 6)
+        return {
+            "trace_id": self.trace_id,
+            "wall_seconds": round((time.perf_counter_ns() - self.start_ns) / 1e9, 6),
+            "spans": breakdown,
+        }
+
+    def chrome(self):
+        """ The trace in the Chrome trace event format """
+        pid = os.getpid()
+        events = [
+            {
+                "name": span.name,
+                "ph": "X",
+                "ts": (span.start_ns - self.start_ns) / 1000,
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": dict(span.attributes, span_id=span.span_id, parent_id=span.parent_id),
+            }
+            for span in self.finished()
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": dict(self.attributes, trace_id=self.trace_id, name=self.name),
+        }
+
+    def otlp(self):
+        """ The trace in the OTLP JSON format """
+        spans = []
+        for span in self.finished():
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(self.unix_ns(span.start_ns)),
+                "endTimeUnixNano": str(self.unix_ns(span.end_ns)),
+                "attributes": otlp_attributes(span.attributes),
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": otlp_attributes(
+                            dict(self.attributes, **{"service.name": SERVICE_NAME})
+                        )
+                    },
+                    "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": spans}],
+                }
+            ]
+        }
+
+    def export_path(self):
+        """ The file the trace is exported to """
+        return os.path.join(
+            self.export_dir, f"trace-{self.trace_id}.{self.export_format}.json"
+        )
+
+    def write(self):
+        """ Write the trace to the export file, called from a thread """
+        body = self.chrome() if self.export_format == "chrome" else self.otlp()
+        os.makedirs(self.export_dir, exist_ok=True)
+        with open(self.export_path(), "w") as file_handle:
+            json.dump(body, file_handle)
+
+    async def export(self):
+        """ Export the trace if an export directory is configured, a failed
+            export is logged and doesn't fail the task
+        """
+        if not self.export_dir:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.write)
+            logger.debug("Trace written to %s", self.export_path())
+        except Exception:
+            logger.error("Error exporting trace %s", self.trace_id, exc_info=True)
+
+
+def otlp_attributes(attributes):
+    """ Attributes as OTLP key values """
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        result.append({"key": key, "value": typed})
+    return result
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """ Make trace the current trace, None leaves tracing off """
+    trace_token = CURRENT_TRACE.set(trace)
+    span_token = CURRENT_SPAN.set(None)
+    try:
+        yield trace
+    finally:
+        CURRENT_SPAN.reset(span_token)
+        CURRENT_TRACE.reset(trace_token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ Time the enclosed block as a child of the current span, does
+        nothing unless a trace is active
+    """
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        yield None
+        return
+
+    current = trace.start_span(name, CURRENT_SPAN.get(), attributes)
+    token = CURRENT_SPAN.set(current)
+    try:
+        yield current
+    except Exception as exp:
+        current.attributes["error"] = str(exp) or type(exp).__name__
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        current.end_ns = time.perf_counter_ns()
+
+
+def record(name, seconds, **attributes):
+    """ Add a span which ended now after taking seconds, for operations
+        already timed by the caller
+    """
+    trace = CURRENT_TRACE.get()
+    if trace is None:
+        return
+    current = trace.start_span(name, CURRENT_SPAN.get(), attributes)
+    current.end_ns = time.perf_counter_ns()
+    current.start_ns = current.end_ns - int(seconds * 1e9)
+
+
+def timing():
+    """ The timing breakdown of the current trace if debug timing is
+        enabled, else None
+    """
+    trace = CURRENT_TRACE.get()
+    if trace is None or not trace.debug_timing:
+        return None
+    return trace.summary()
@@ -23,5 +23,10 @@ setup(
     tests_require=["pytest-asyncio","aioresponses","pytest"],
     zip_safe=False,
     classifiers=["Programming Language :: Python :: 3"],
-    extras_require={"dev": ["pytest", "flake8", "pylint", "black"]},
+    extras_require={
+        "dev": ["pytest", "flake8", "pylint", "black"],
+        "zstd": ["zstandard"],
+        "orjson": ["orjson"],
+        "ujson": ["ujson"],
+    },
 )